@@ -29,11 +29,14 @@ def attr_to_dict(attr_str):
     return d
 
 
-def load_GTF(
+def load_GTF_python(
     src,
     attributes=["gene_id", "gene_type", "gene_name"],
     features=["exon", "CDS", "UTR"],
 ):
+    """
+    Line-by-line reference implementation of load_GTF().
+    """
     if type(src) is str:
         if src.endswith(".gz"):
             src = gzip.open(src, "rt")
@@ -53,14 +56,195 @@ def load_GTF(
             continue
 
         attrs = attr_to_dict(attr_str)
-        row = [chrom, feature, int(start) - 1, int(end), strand] + [
+        # GTF is 1-based. Clip invalid start=0 records instead of creating
+        # negative coordinates
+        row = [chrom, feature, max(int(start) - 1, 0), int(end), strand] + [
             attrs[a] for a in attributes
         ]
         data.append(row)
 
     return pd.DataFrame(
         data, columns=["chrom", "feature", "start", "end", "strand"] + attributes
-    ).drop_duplicates()
+    ).drop_duplicates().reset_index(drop=True)
+
+
+GTF_COLUMNS = [
+    "chrom",
+    "source",
+    "feature",
+    "start",
+    "end",
+    "score",
+    "strand",
+    "frame",
+    "attributes",
+]
+
+
+def load_GTF(
+    src,
+    attributes=["gene_id", "gene_type", "gene_name"],
+    features=["exon", "CDS", "UTR"],
+    chunksize=2**20,
+):
+    """
+    Load the requested features of a GTF into a DataFrame with columns
+    chrom, feature, start (0-based), end, strand and one column for each
+    of the requested attributes. The nine GTF columns are split by pandas'
+    C reader, chunk by chunk, and the attributes are only extracted (with
+    vectorized regular expressions) from the rows of the requested features.
+    Same results as load_GTF_python().
+    """
+    import csv
+
+    reader = pd.read_csv(
+        src,
+        sep="\t",
+        header=None,
+        names=GTF_COLUMNS,
+        usecols=["chrom", "feature", "start", "end", "strand", "attributes"],
+        dtype=str,
+        quoting=csv.QUOTE_NONE,
+        na_filter=False,
+        comment=None,
+        chunksize=chunksize,
+        on_bad_lines="skip",
+    )
+    fset = set(features)
+    dfs = []
+    for chunk in reader:
+        # header/comment lines end up with empty columns
+        chunk = chunk[chunk["feature"].isin(fset) & (chunk["attributes"] != "")]
+        if not len(chunk):
+            continue
+
+        df = pd.DataFrame(
+            dict(
+                chrom=chunk["chrom"].values,
+                feature=chunk["feature"].values,
+                # GTF is 1-based. Clip invalid start=0 records instead of
+                # creating negative coordinates
+                start=np.maximum(chunk["start"].values.astype(np.int64) - 1, 0),
+                end=chunk["end"].values.astype(np.int64),
+                strand=chunk["strand"].values,
+            )
+        )
+        attrs = chunk["attributes"]
+        for a in attributes:
+            # a pattern starting with a literal is searched much faster, but
+            # would also match keys such as 'ref_gene_name'. Those (rare)
+            # records are re-extracted with a strict pattern
+            values = attrs.str.extract(rf'{a} "([^"\s]+)";', expand=False)
+            suspect = attrs.str.contains(f'_{a} "', regex=False)
+            if suspect.any():
+                values[suspect] = attrs[suspect].str.extract(
+                    rf'(?:^|[;\s]){a} "([^"\s]+)";', expand=False
+                )
+
+            if values.isna().any():
+                line = attrs[values.isna()].iloc[0]
+                raise KeyError(f"GTF record lacks attribute '{a}': {line}")
+
+            df[a] = values.values
+
+        dfs.append(df)
+
+    if not dfs:
+        return pd.DataFrame(
+            columns=["chrom", "feature", "start", "end", "strand"] + attributes
+        )
+
+    return pd.concat(dfs, ignore_index=True).drop_duplicates().reset_index(drop=True)
+
+
+def gtf_cache_key(gtf, attributes, features):
+    "what a cached GTF parse depends on"
+    st = os.stat(gtf)
+    return dict(
+        path=os.path.abspath(gtf),
+        size=st.st_size,
+        mtime=st.st_mtime,
+        attributes=list(attributes),
+        features=list(features),
+    )
+
+
+def save_GTF_cache(df, fname, key):
+    """
+    Store the parsed GTF columns in an (uncompressed) .npz file. String
+    columns are stored as integer codes plus the unique values, so that no
+    pickling is needed to load them again.
+    """
+    import json
+
+    arrays = dict(_key=np.array(json.dumps(key)))
+    for col in df.columns:
+        values = df[col].values
+        if values.dtype == object:
+            codes, uniques = pd.factorize(values)
+            arrays[f"{col}.codes"] = codes.astype(np.int32)
+            arrays[f"{col}.uniques"] = np.array(uniques, dtype=str)
+        else:
+            arrays[col] = values
+
+    with open(fname, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def load_GTF_cache(fname, key):
+    "returns the DataFrame stored by save_GTF_cache(), or None if stale"
+    import json
+
+    if not os.access(fname, os.R_OK):
+        return None
+
+    with np.load(fname, allow_pickle=False) as npz:
+        if json.loads(str(npz["_key"])) != key:
+            return None
+
+        data = {}
+        for name in npz.files:
+            if name == "_key" or name.endswith(".uniques"):
+                continue
+            if name.endswith(".codes"):
+                col = name[: -len(".codes")]
+                uniques = npz[f"{col}.uniques"].astype(object)
+                data[col] = uniques[npz[name]]
+            else:
+                data[name] = npz[name]
+
+    return pd.DataFrame(data)
+
+
+def load_GTF_cached(
+    gtf,
+    cache="",
+    attributes=["gene_id", "gene_type", "gene_name"],
+    features=["exon", "CDS", "UTR"],
+):
+    """
+    load_GTF() with a columnar cache file. The cache is only used if it was
+    built from a GTF with the same path, size and mtime (and for the same
+    attributes and features). Otherwise, the GTF is parsed and the cache
+    (re-)written.
+    """
+    logger = logging.getLogger("load_GTF_cached")
+    if not cache:
+        return load_GTF(gtf, attributes=attributes, features=features)
+
+    key = gtf_cache_key(gtf, attributes, features)
+    t0 = time()
+    df = load_GTF_cache(cache, key)
+    if df is not None:
+        dt = time() - t0
+        logger.info(f"loaded {len(df)} GTF records from cache '{cache}' in {dt:.3f}s")
+        return df
+
+    df = load_GTF(gtf, attributes=attributes, features=features)
+    save_GTF_cache(df, cache, key)
+    dt = time() - t0
+    logger.info(f"parsed {len(df)} GTF records and stored cache '{cache}' in {dt:.3f}s")
+    return df
 
 
 ## Annotation classification matrix
@@ -96,16 +280,19 @@ class GTFClassifier:
             # "transcript": 3,
         }
         df["feature_idx"] = df["feature"].apply(lambda x: feat2idx[x])
-        self.df = df.values
+        self.df = df[
+            ["strand", "gene_id", "gene_type", "gene_name", "feature_idx"]
+        ].values
 
     def process(self, ids):
         gene_features = defaultdict(lambda: np.zeros(3, dtype=bool))
         gene_names = {}
         gene_types = {}
         # iterate over the overlapping GTF features only once.
-        # sort by gene_id as we go
-        for i in ids:
-            row = self.df[i][5:]
+        # sort by gene_id as we go. Sorted ids make the order of genes
+        # independent of how the (frozen)set of ids was built
+        for i in sorted(ids):
+            row = self.df[i]
             # print(row)
             (strand, gene_id, gene_type, gene_name, feature_idx) = row
             gene_names[gene_id] = gene_name
@@ -194,6 +381,452 @@ class CompiledClassifier:
         return self.joiner(cidx)
 
 
+def gtf_signature(fname):
+    """
+    Identifies the exact GTF a compiled annotation was built from: absolute
+    path, size, mtime and MD5 checksum of the file.
+    """
+    import hashlib
+
+    md5 = hashlib.md5()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            md5.update(block)
+
+    st = os.stat(fname)
+    return dict(
+        path=os.path.abspath(fname),
+        size=st.st_size,
+        mtime=st.st_mtime,
+        md5=md5.hexdigest(),
+    )
+
+
+class PackedClassifications:
+    """
+    Read-only sequence of pre-classified (gf, gn, gs, gt) annotations, one
+    per cid, stored as NumPy arrays: ann_offsets[cid]:ann_offsets[cid + 1]
+    are the rows of ann belonging to a cid, each row holds four ids into a
+    string table (str_offsets, str_data). Entries are decoded on first access.
+    """
+
+    def __init__(self, ann_offsets, ann, str_offsets, str_data):
+        self.ann_offsets = ann_offsets
+        self.ann = ann
+        self.str_offsets = str_offsets
+        self.str_data = str_data
+        self.decoded = [None] * (len(ann_offsets) - 1)
+        self.strings = [None] * (len(str_offsets) - 1)
+
+    @classmethod
+    def pack(cls, classifications):
+        "pack a sequence of (gf, gn, gs, gt) tuples"
+        str_ids = {}
+        ann_offsets = [0]
+        ann = []
+        for gf, gn, gs, gt in classifications:
+            for row in zip(gf, gn, gs, gt):
+                ann.append([str_ids.setdefault(x, len(str_ids)) for x in row])
+            ann_offsets.append(len(ann))
+
+        data = [x.encode("utf-8") for x in str_ids]
+        str_offsets = np.r_[0, np.cumsum([len(x) for x in data])]
+        return cls(
+            np.array(ann_offsets, dtype=np.int64),
+            np.array(ann, dtype=np.int32).reshape(-1, 4),
+            str_offsets.astype(np.int64),
+            np.frombuffer(b"".join(data), dtype=np.uint8),
+        )
+
+    def arrays(self):
+        return dict(
+            ann_offsets=self.ann_offsets,
+            ann=self.ann,
+            str_offsets=self.str_offsets,
+            str_data=self.str_data,
+        )
+
+    def string(self, i):
+        s = self.strings[i]
+        if s is None:
+            a, b = self.str_offsets[i : i + 2]
+            s = self.str_data[a:b].tobytes().decode("utf-8")
+            self.strings[i] = s
+
+        return s
+
+    def __len__(self):
+        return len(self.decoded)
+
+    def __getitem__(self, cid):
+        res = self.decoded[cid]
+        if res is None:
+            a, b = self.ann_offsets[cid : cid + 2]
+            cols = self.ann[a:b].T.tolist()
+            res = tuple([tuple([self.string(i) for i in col]) for col in cols])
+            self.decoded[cid] = res
+
+        return res
+
+
+class CompiledLookup:
+    """
+    Sorted-array lookup engine for compiled annotations. The segments of a
+    compiled GenomeAnnotation do not overlap, so for each (chrom, strand)
+    their starts and their ends are both sorted and the segments overlapping
+    a block [x0, x1) are found with two np.searchsorted() calls. This
+    replaces one NCLS query and frozenset per block and read with a few
+    array operations per batch of reads.
+
+    Results are (gf, gn, gs, gt) tuples, identical to
+    CompiledClassifier.process() on the overlapping segment indices (in
+    genomic order).
+
+    A CompiledLookup can be stored in a single binary file (see save()) which
+    is memory-mapped by load(). This takes milliseconds and the pages are
+    shared read-only between all processes that load the same file.
+    """
+
+    logger = logging.getLogger("CompiledLookup")
+    strand_size = 1 << 36
+    magic = b"SPACEMAKE_CANN\x00\x00"
+    format_version = 1
+
+    def __init__(self, starts, ends, cids, offsets, classifications, source=None):
+        """
+        :param starts: start coordinates of all segments, sorted. Segments
+            of each (chrom, strand) are shifted by its offset
+        :param ends: end coordinates, shifted the same way
+        :param cids: classification id of each segment
+        :param offsets: (chrom, strand) -> offset
+        :param classifications: sequence of (gf, gn, gs, gt) tuples,
+            indexed by cid
+        :param source: gtf_signature() of the GTF the annotation was compiled
+            from, if known
+        """
+        self.starts = starts
+        self.ends = ends
+        self.cids = cids
+        self.offsets = offsets
+        self.classifications = classifications
+        self.source = source
+        self.empty = ((), (), (), ())
+        self.join_cache = {}
+
+    @classmethod
+    def from_df(cls, df, classifications, source=None):
+        """
+        Build from the compiled DataFrame (chrom, strand, start, end, cid)
+        and the pre-classifications.
+        """
+        # classifications may come as (n, 4) object array of lists or as
+        # (n, 4, k) object array, depending on how numpy stacked them
+        classifications = [tuple([tuple(x) for x in c]) for c in classifications]
+
+        # all strands are laid out one after another in a single coordinate
+        # space, so that one searchsorted() call resolves reads from any
+        # strand. offsets[(chrom, strand)] is the start of each strand.
+        offsets = {}
+        starts = [np.zeros(0, np.int64)]
+        ends = [np.zeros(0, np.int64)]
+        cids = [np.zeros(0, np.int64)]
+        t0 = time()
+        for k, ((chrom, strand), d) in enumerate(
+            df.groupby(["chrom", "strand"], sort=False)
+        ):
+            d = d.sort_values("start")
+            s = d["start"].values.astype(np.int64)
+            e = d["end"].values.astype(np.int64)
+            assert (s[1:] >= e[:-1]).all()
+            assert e.max() < cls.strand_size
+
+            offset = k * cls.strand_size
+            offsets[(chrom, strand)] = offset
+            starts.append(s + offset)
+            ends.append(e + offset)
+            cids.append(d["cid"].values.astype(np.int64))
+
+        lookup = cls(
+            np.concatenate(starts),
+            np.concatenate(ends),
+            np.concatenate(cids),
+            offsets,
+            classifications,
+            source=source,
+        )
+        dt = time() - t0
+        cls.logger.info(
+            f"built sorted arrays of {len(df)} segments on {len(offsets)} strands in {dt:.3f}s"
+        )
+        return lookup
+
+    @staticmethod
+    def get_filename(path):
+        return os.path.join(path, "compiled_index.bin")
+
+    @staticmethod
+    def file_exists(path):
+        return os.access(CompiledLookup.get_filename(path), os.R_OK)
+
+    def save(self, fname):
+        """
+        Store as one binary file: a magic string, the length of a JSON
+        header, the JSON header itself and then the raw arrays, each aligned
+        to 64 bytes. The header holds the format version, the source GTF
+        signature, the (chrom, strand) offsets and dtype, shape and position
+        of each array. Besides the arrays used for lookups (gstart, gend,
+        gcid), the segments are stored as plain columns chrom, strand,
+        start, end and cid.
+        """
+        import json
+
+        keys = sorted(self.offsets.items(), key=lambda x: x[1])
+        chroms = sorted(set([chrom for (chrom, strand), offset in keys]))
+        chrom_ids = {chrom: i for i, chrom in enumerate(chroms)}
+
+        key_idx = self.starts // self.strand_size
+        key_chrom = np.array(
+            [chrom_ids[chrom] for (chrom, strand), offset in keys], dtype=np.int32
+        )
+        key_strand = np.array(
+            [strand == "-" for (chrom, strand), offset in keys], dtype=np.int8
+        )
+        key_offset = np.array([offset for key, offset in keys], dtype=np.int64)
+        key_pos = np.searchsorted(key_offset, key_idx * self.strand_size)
+
+        if isinstance(self.classifications, PackedClassifications):
+            packed = self.classifications
+        else:
+            packed = PackedClassifications.pack(self.classifications)
+
+        arrays = dict(
+            gstart=self.starts.astype(np.int64),
+            gend=self.ends.astype(np.int64),
+            gcid=self.cids.astype(np.int64),
+            chrom=key_chrom[key_pos],
+            strand=key_strand[key_pos],
+            start=(self.starts - key_offset[key_pos]).astype(np.int64),
+            end=(self.ends - key_offset[key_pos]).astype(np.int64),
+            cid=self.cids.astype(np.int32),
+        )
+        arrays.update(packed.arrays())
+
+        layout = {}
+        pos = 0
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            arrays[name] = arr
+            layout[name] = (arr.dtype.str, arr.shape, pos)
+            pos += (arr.nbytes + 63) // 64 * 64
+
+        header = dict(
+            version=self.format_version,
+            source=self.source,
+            chroms=chroms,
+            strands=[[chrom, strand, offset] for (chrom, strand), offset in keys],
+            arrays=layout,
+        )
+        hdata = json.dumps(header).encode("utf-8")
+        data_start = (len(self.magic) + 8 + len(hdata) + 63) // 64 * 64
+
+        t0 = time()
+        with open(fname, "wb") as f:
+            f.write(self.magic)
+            f.write(np.uint64(len(hdata)).tobytes())
+            f.write(hdata)
+            for name, arr in arrays.items():
+                dtype, shape, pos = layout[name]
+                f.seek(data_start + pos)
+                f.write(arr.tobytes())
+
+        dt = time() - t0
+        self.logger.debug(f"stored binary compiled index '{fname}' in {dt:.3f}s")
+
+    @classmethod
+    def load(cls, fname):
+        "memory-map a file written by save()"
+        import mmap
+        import json
+
+        t0 = time()
+        with open(fname, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[: len(cls.magic)] != cls.magic:
+            raise ValueError(f"'{fname}' is not a compiled annotation index")
+
+        n = len(cls.magic)
+        hlen = int(np.frombuffer(mm, dtype=np.uint64, count=1, offset=n)[0])
+        header = json.loads(mm[n + 8 : n + 8 + hlen].decode("utf-8"))
+        if header["version"] != cls.format_version:
+            raise ValueError(
+                f"'{fname}' has format version {header['version']}, "
+                f"expected {cls.format_version}"
+            )
+
+        data_start = (n + 8 + hlen + 63) // 64 * 64
+        arrays = {}
+        for name, (dtype, shape, pos) in header["arrays"].items():
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(
+                mm, dtype=dtype, count=count, offset=data_start + pos
+            ).reshape(shape)
+
+        offsets = {(chrom, strand): offset for chrom, strand, offset in header["strands"]}
+        lookup = cls(
+            arrays["gstart"],
+            arrays["gend"],
+            arrays["gcid"],
+            offsets,
+            PackedClassifications(
+                arrays["ann_offsets"],
+                arrays["ann"],
+                arrays["str_offsets"],
+                arrays["str_data"],
+            ),
+            source=header["source"],
+        )
+        lookup.mmap = mm
+        lookup.fname = fname
+        dt = time() - t0
+        cls.logger.info(
+            f"memory-mapped compiled index '{fname}' with {len(lookup.starts)} segments "
+            f"and {len(lookup.classifications)} classifications in {dt:.3f}s"
+        )
+        return lookup
+
+    def __reduce__(self):
+        if getattr(self, "fname", None):
+            # memory-mapped: the other process maps the same file
+            return (CompiledLookup.load, (self.fname,))
+
+        return super().__reduce__()
+
+    def matches_source(self, gtf):
+        """
+        True if the index was compiled from the GTF file gtf, or if the
+        source is unknown. The checksum is only computed if size or mtime
+        changed.
+        """
+        if not self.source or not gtf:
+            return True
+
+        st = os.stat(gtf)
+        if st.st_size == self.source["size"] and st.st_mtime == self.source["mtime"]:
+            return True
+
+        return gtf_signature(gtf)["md5"] == self.source["md5"]
+
+    def join(self, cids):
+        """
+        merge the pre-classified annotations of several segments, reporting
+        each (gf, gn, gs, gt) combination only once. Rarely needed.
+        """
+        if cids in self.join_cache:
+            return self.join_cache[cids]
+
+        seen = set()
+        gf = []
+        gn = []
+        gs = []
+        gt = []
+        for cid in cids:
+            for ann in zip(*self.classifications[cid]):
+                if not ann in seen:
+                    seen.add(ann)
+                    gf.append(ann[0])
+                    gn.append(ann[1])
+                    gs.append(ann[2])
+                    gt.append(ann[3])
+
+        res = (tuple(gf), tuple(gn), tuple(gs), tuple(gt))
+        self.join_cache[cids] = res
+        return res
+
+    def query_blocks(self, chrom, strand, blocks):
+        return self.query_batch([(chrom, strand, blocks)])[0]
+
+    def query_batch(self, queries):
+        """
+        Annotate a batch of reads at once.
+
+        :param queries: (chrom, strand, blocks) for each read, where blocks
+            are the aligned (start, end) pairs, as returned by
+            pysam.AlignedSegment.get_blocks()
+        :type queries: list
+        :return: a (gf, gn, gs, gt) tuple for each query
+        :rtype: list
+        """
+        results = [self.empty] * len(queries)
+
+        rids = []
+        offsets = []
+        n_blocks = []
+        coords = []
+        for i, (chrom, strand, blocks) in enumerate(queries):
+            offset = self.offsets.get((chrom, strand), None)
+            if offset is None or not blocks:
+                continue
+
+            rids.append(i)
+            offsets.append(offset)
+            n_blocks.append(len(blocks))
+            coords.extend(blocks)
+
+        if not rids:
+            return results
+
+        rids = np.array(rids)
+        coords = np.array(coords, dtype=np.int64).reshape(-1, 2)
+        coords += np.repeat(offsets, n_blocks)[:, np.newaxis]
+
+        # segments [lo, hi) overlap the block (start < x1 and end > x0)
+        lo = np.searchsorted(self.ends, coords[:, 0], side="right")
+        hi = np.searchsorted(self.starts, coords[:, 1], side="left")
+        n = np.maximum(hi - lo, 0)
+        hit = n > 0
+
+        # reduce over the blocks of each read
+        first = np.r_[0, np.cumsum(n_blocks)[:-1]]
+        n_max = np.maximum.reduceat(n, first)
+        seg_min = np.minimum.reduceat(np.where(hit, lo, len(self.starts)), first)
+        seg_max = np.maximum.reduceat(np.where(hit, lo, -1), first)
+
+        # fast path: all blocks fall into the same, single segment
+        single = (n_max == 1) & (seg_min == seg_max)
+        classifications = self.classifications
+        for i, cid in zip(rids[single].tolist(), self.cids[seg_min[single]].tolist()):
+            results[i] = classifications[cid]
+
+        # everything else that overlaps any segment at all
+        multi = np.flatnonzero((n_max > 0) & ~single)
+        if not len(multi):
+            return results
+
+        lo = lo.tolist()
+        hi = hi.tolist()
+        first = first.tolist()
+        rids = rids.tolist()
+        for j in multi.tolist():
+            k0 = first[j]
+            if n_blocks[j] == 1:
+                segs = slice(lo[k0], hi[k0])
+            else:
+                segs = set()
+                for k in range(k0, k0 + n_blocks[j]):
+                    segs.update(range(lo[k], hi[k]))
+                segs = sorted(segs)
+
+            # unique cids in genomic order
+            read_cids = tuple(dict.fromkeys(self.cids[segs].tolist()))
+            if len(read_cids) == 1:
+                results[rids[j]] = classifications[read_cids[0]]
+            else:
+                results[rids[j]] = self.join(read_cids)
+
+        return results
+
+
 ## Helper functions for working with NCLS
 def query(nc, x0, x1):
     """
@@ -256,14 +889,75 @@ def decompose(nc):
                 break
 
 
+def sweep_decompose(starts, ends, ids):
+    """
+    Sweep-line version of decompose(). All start and end positions of the
+    intervals (start, end, id) of one strand are sorted once and the set of
+    active ids is updated while sweeping over them, in O(n log n) instead of
+    one NCLS query per breakpoint. Yields the same maximal, non-overlapping
+    segments of constant, non-empty id sets as decompose().
+
+    :param starts: interval starts
+    :param ends: interval ends (exclusive)
+    :param ids: interval ids (target_ids)
+    :yield: (start, end, frozenset(target_ids) )
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    n = len(starts)
+    if not n:
+        return
+
+    pos = np.concatenate([starts, ends])
+    order = np.argsort(pos, kind="stable")
+    pos = pos[order].tolist()
+    # event >= n: end of interval event - n
+    events = order.tolist()
+    ids = np.asarray(ids).tolist()
+
+    active = set()
+    add = active.add
+    discard = active.discard
+    last_pos = pos[0]
+    last_key = frozenset()
+    p = pos[0]
+    for x, e in zip(pos, events):
+        if x != p:
+            # all events at p have been applied
+            key = frozenset(active)
+            if key != last_key:
+                if last_key:
+                    # ensure we do not yield the empty set
+                    yield last_pos, p, last_key
+                last_key = key
+                last_pos = p
+            p = x
+
+        if e < n:
+            add(ids[e])
+        else:
+            discard(ids[e - n])
+
+    # after the last position, all intervals have ended
+    if last_key:
+        yield last_pos, p, last_key
+
+
+def _sweep_strand(args):
+    "process pool helper for GenomeAnnotation.compile()"
+    strand_key, (starts, ends, ids) = args
+    return strand_key, list(sweep_decompose(starts, ends, ids))
+
+
 class GenomeAnnotation:
     """
-    NCLS-based lookup of genome annotation
+    NCLS-based lookup of genome annotation. Compiled annotations are
+    looked up through a CompiledLookup engine instead.
     """
 
     logger = logging.getLogger("GenomeAnnotation")
 
-    def __init__(self, df, processor, is_compiled=False):
+    def __init__(self, df, processor, is_compiled=False, engine=None):
         """
         [summary]
 
@@ -273,15 +967,27 @@ class GenomeAnnotation:
             the indices point into the dataframe to all
             overlapping features
         :type processor: function that takes frozenset(indices) as sole argument
+        :param engine: optional lookup engine for compiled annotations which
+            answers query_blocks() and query_batch() instead of the NCLS
+        :type engine: CompiledLookup
         """
         # self.df = df
         self.processor = processor
+        self.is_compiled = is_compiled
+        self.engine = engine
+        self.source = None
+        self.memo = None
+        self.strand_map = {}
+        self.strand_intervals = {}
+        self.empty = frozenset([])
+        if df is None:
+            # memory-mapped compiled index. Only the engine is available
+            self.strand_keys = list(engine.offsets.keys())
+            return
 
         # find all unique combinations of chrom + strand
         strands = df[["chrom", "strand"]].drop_duplicates().values
         self.strand_keys = [tuple(s) for s in strands]
-        self.strand_map = {}
-        self.empty = frozenset([])
 
         t0 = time()
         for strand_key in sorted(self.strand_keys):
@@ -290,15 +996,34 @@ class GenomeAnnotation:
             d = df.query(f"chrom == '{chrom}' and strand == '{strand}'")
             nested_list = ncls.NCLS(d["start"], d["end"], d.index)
             self.strand_map[strand_key] = nested_list
+            self.strand_intervals[strand_key] = (
+                d["start"].values,
+                d["end"].values,
+                d.index.values,
+            )
 
         dt = time() - t0
         self.logger.info(
             f"constructed nested lists of {len(df)} features on {len(self.strand_keys)} strands in {dt:.3f}s"
         )
-        self.is_compiled = is_compiled
+
+    @staticmethod
+    def compiled_index_exists(path):
+        return CompiledLookup.file_exists(path) or CompiledClassifier.files_exist(path)
 
     @classmethod
     def from_compiled_index(cls, path):
+        """
+        Load a compiled annotation. The binary index written by compile() is
+        memory-mapped. Older indices consisting of non_overlapping.csv and
+        classifications.npy are still read if no binary index is found.
+        """
+        if CompiledLookup.file_exists(path):
+            engine = CompiledLookup.load(CompiledLookup.get_filename(path))
+            gc = cls(None, None, is_compiled=True, engine=engine)
+            gc.source = engine.source
+            return gc
+
         cdf_path, cclass_path = CompiledClassifier.get_filenames(path)
         t0 = time()
         cdf = pd.read_csv(cdf_path, sep="\t")
@@ -310,22 +1035,33 @@ class GenomeAnnotation:
         ## Create a secondary Annotator which uses the non-overlapping combinations
         ## and the pre-classified annotations for the actual tagging
         cl = CompiledClassifier(cdf, classifications)
-        gc = cls(cdf, lambda idx: cl.process(idx), is_compiled=True)
+        gc = cls(
+            cdf,
+            lambda idx: cl.process(idx),
+            is_compiled=True,
+            engine=CompiledLookup.from_df(cdf, classifications),
+        )
         return gc
 
+    def matches_source(self, gtf):
+        "False if the (compiled) annotation is known to stem from another GTF"
+        if self.engine is None:
+            return True
+
+        return self.engine.matches_source(gtf)
+
     @classmethod
-    def from_GTF(cls, gtf, df_cache=""):
+    def from_GTF(cls, gtf, cache=""):
         # load GTF the first time. Need to build compiled annotation
         t0 = time()
-        df = load_GTF(gtf)
+        df = load_GTF_cached(gtf, cache=cache)
         dt = time() - t0
         cls.logger.info(f"loaded {len(df)} GTF records in {dt:.3f} seconds")
-        if df_cache:
-            df.to_csv(df_cache, sep="\t")
 
         ## Build NCLS with original GTF features
         cl = GTFClassifier(df)
         ga = cls(df, lambda idx: cl.process(idx))
+        ga.source = gtf_signature(gtf)
         return ga
 
     @classmethod
@@ -368,10 +1104,59 @@ class GenomeAnnotation:
         return self.processor(idx)
 
     def query_blocks(self, chrom, strand, blocks):
+        if self.engine is not None:
+            return self.engine.query_blocks(chrom, strand, blocks)
+
         idx = self.query_idx_blocks(chrom, strand, blocks)
         return self.processor(idx)
 
-    def compile(self, path=""):
+    def set_memo(self, size):
+        """
+        Memoize the annotation tags of up to size distinct
+        (chrom, strand, blocks) combinations (see query_tags()).
+        size=0 turns memoization off.
+        """
+        self.memo = TagMemo(size) if size else None
+        return self.memo
+
+    def memo_stats(self):
+        if self.memo is None:
+            return ""
+
+        return ", " + self.memo.summary()
+
+    def query_batch(self, queries):
+        """
+        query_blocks() for a list of (chrom, strand, blocks) tuples.
+        Compiled annotations resolve the whole batch at once.
+        """
+        if self.engine is not None:
+            return self.engine.query_batch(queries)
+
+        return [self.query_blocks(*q) for q in queries]
+
+    def decompose_strands(self, n_workers=1):
+        """
+        sweep_decompose() all strands, fanning out over n_workers processes
+        if n_workers > 1. Yields (strand_key, [(start, end, idx), ...])
+        in the order of self.strand_map.
+        """
+        jobs = [(key, self.strand_intervals[key]) for key in self.strand_map]
+        if n_workers > 1 and len(jobs) > 1:
+            import multiprocessing as mp
+
+            # largest strands first
+            jobs = sorted(jobs, key=lambda job: -len(job[1][0]))
+            with mp.Pool(min(n_workers, len(jobs))) as pool:
+                results = dict(pool.imap_unordered(_sweep_strand, jobs))
+
+            for key in self.strand_map:
+                yield key, results[key]
+        else:
+            for job in jobs:
+                yield _sweep_strand(job)
+
+    def compile(self, path="", n_workers=1):
         chroms = []
         strands = []
         cstarts = []
@@ -381,10 +1166,10 @@ class GenomeAnnotation:
         cid_lkup = {}
 
         t0 = time()
-        for strand_key, nc in self.strand_map.items():
+        for strand_key, segments in self.decompose_strands(n_workers=n_workers):
             chrom, strand = strand_key
-            self.logger.info(f"decomposing {chrom} {strand}")
-            for start, end, idx in decompose(nc):
+            self.logger.info(f"decomposed {chrom} {strand}")
+            for start, end, idx in segments:
                 # print(f"start={start} end={end} idx={idx}")
                 chroms.append(chrom)
                 strands.append(strand)
@@ -417,69 +1202,401 @@ class GenomeAnnotation:
             f"pre-classified {n} feature combinations in {dt:.3f} seconds"
         )
 
+        engine = CompiledLookup.from_df(cdf, classifications, source=self.source)
         if path:
-            cdf_path, cclass_path = CompiledClassifier.get_filenames(path)
-            ## Store the compiled DataFrame and pre-classifications
+            ## Store the compiled segments and pre-classifications
             t0 = time()
-            cdf.to_csv(cdf_path, sep="\t", index=False)
-            np.save(cclass_path, classifications)
+            engine.save(CompiledLookup.get_filename(path))
             dt = time() - t0
             self.logger.debug(f"stored compiled annotation index in {dt:.3f} seconds")
 
         ## Create a secondary Annotator which uses the non-overlapping combinations
         ## and the pre-classified annotations for the actual tagging
         cl = CompiledClassifier(cdf, classifications)
-        gc = GenomeAnnotation(cdf, lambda idx: cl.process(idx), is_compiled=True)
+        gc = GenomeAnnotation(
+            cdf,
+            lambda idx: cl.process(idx),
+            is_compiled=True,
+            engine=engine,
+        )
+        gc.source = self.source
 
         return gc
 
-    def annotate_BAM(self, src, out, antisense=False, interval=5):
+    def query_reads(self, queries, antisense=False):
+        """
+        query_batch() and, with antisense=True, also query_batch() against
+        the opposite strands, with both results concatenated.
+        """
+        results = self.query_batch(queries)
+        if antisense:
+            as_queries = [(c, AS_STRAND[s], b) for c, s, b in queries]
+            as_results = self.query_batch(as_queries)
+            # concatenate into new lists. The results may be shared
+            # between reads and must not be modified in place
+            results = [
+                [list(x) + list(x_as) for x, x_as in zip(res, res_as)]
+                if len(res_as[0])
+                else res
+                for res, res_as in zip(results, as_results)
+            ]
+
+        return results
+
+    def query_tags(self, queries, antisense=False, dropseq=False):
+        """
+        Final annotation tags of a list of (chrom, strand, blocks) reads as
+        (tags, encoded_tags) pairs (see annotation_tags() or, with
+        dropseq=True, dropseq_tags() and spacemake.bam.encode_tags()). With a memo (see set_memo()), reads
+        aligning to the exact same blocks as a recently seen read skip the
+        lookup as well as the string joins. Only the remaining reads are
+        passed on to query_reads().
+        """
+        from spacemake.bam import encode_tags
+
+        tag_func = dropseq_tags if dropseq else annotation_tags
+
+        def make_tags(res):
+            tags = tag_func(*res)
+            return tags, encode_tags(tags)
+
+        memo = self.memo
+        if memo is None:
+            return [make_tags(res) for res in self.query_reads(queries, antisense)]
+
+        tags = []
+        missing = []
+        keys = []
+        for i, (chrom, strand, blocks) in enumerate(queries):
+            key = (chrom, strand, tuple(blocks))
+            t = memo.get(key)
+            if t is None:
+                missing.append(i)
+                keys.append(key)
+
+            tags.append(t)
+
+        results = self.query_reads([queries[i] for i in missing], antisense)
+        for i, key, res in zip(missing, keys, results):
+            t = make_tags(res)
+            memo.put(key, t)
+            tags[i] = t
+
+        return tags
+
+    def annotate_BAM(
+        self,
+        src,
+        out,
+        antisense=False,
+        interval=5,
+        batch_size=10000,
+        level=0,
+        memo_size=100000,
+        dropseq=False,
+    ):
         import pysam
 
-        as_strand = {"+": "-", "-": "+"}
         self.logger.info(
             f"beginning BAM annotation: {src} -> {out}. is_compiled={self.is_compiled}"
         )
         bam = pysam.AlignmentFile(src)
-        out = pysam.AlignmentFile(out, "wbu", template=bam)
+        mode = "wbu" if level == 0 else f"wb{level}"
+        out = pysam.AlignmentFile(out, mode, template=bam)
+        self.set_memo(memo_size)
+
+        def tag_batch(reads):
+            mapped = [read for read in reads if not read.is_unmapped]
+            queries = []
+            for read in mapped:
+                chrom = read.reference_name
+                strand = "-" if read.is_reverse else "+"
+                queries.append((chrom, strand, read.get_blocks()))
+
+            results = self.query_tags(queries, antisense=antisense, dropseq=dropseq)
+            for read, (tags, _) in zip(mapped, results):
+                for tag, value in tags:
+                    read.set_tag(tag, value)
+
+            for read in reads:
+                out.write(read)
+
         t0 = time()
         T = interval
-        for n, read in enumerate(bam.fetch(until_eof=True)):
-            if not read.is_unmapped:
-                chrom = bam.get_reference_name(read.tid)
-                strand = "-" if read.is_reverse else "+"
+        n = 0
+        dt = 0
+        batch = []
+        for read in bam.fetch(until_eof=True):
+            batch.append(read)
+            if len(batch) < batch_size:
+                continue
 
-                gf, gn, gs, gt = self.query_blocks(chrom, strand, read.get_blocks())
-                if antisense:
-                    gf_as, gn_as, gs_as, gt_as = self.query_blocks(
-                        chrom, as_strand[strand], read.get_blocks()
-                    )
-                    gf += gf_as
-                    gn += gn_as
-                    gs += gs_as
-                    gt += gt_as
-
-                if len(gf):
-                    read.tags += [
-                        ("gF", ",".join(gf)),
-                        ("gN", ",".join(gn)),
-                        ("gS", ",".join(gs)),
-                        ("gT", ",".join(gt)),
-                    ]
-                else:
-                    read.tags += [("gF", "INTERGENIC")]
-
-            out.write(read)
+            tag_batch(batch)
+            n += len(batch)
+            batch = []
             dt = time() - t0
             if dt > T:
                 self.logger.info(
                     f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
+                    f"{self.memo_stats()}"
                 )
                 T += interval
 
+        tag_batch(batch)
+        n += len(batch)
+        dt = time() - t0
         self.logger.info(
             f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
+            f"{self.memo_stats()}"
         )
+        out.close()
+
+    def annotate_BAM_parallel(
+        self,
+        src,
+        out,
+        antisense=False,
+        interval=5,
+        n_workers=4,
+        n_chunk=10000,
+        threads_read=2,
+        threads_write=4,
+        level=0,
+        memo_size=100000,
+        dropseq=False,
+    ):
+        """
+        annotate_BAM() with n_workers processes. Records are passed around
+        as raw bytes (see spacemake.bam) in chunks of n_chunk, and the output
+        keeps the order of the input. Works on streams (src='/dev/stdin').
+        Each worker keeps its own memo of memo_size annotations.
+        Compiled annotations loaded from a binary index are shared between
+        all processes through the memory-mapped file.
+        """
+        from functools import partial
+        from spacemake.parallel import parallel_map
+
+        self.logger.info(
+            f"beginning parallel BAM annotation with {n_workers} workers: {src} -> {out}. "
+            f"is_compiled={self.is_compiled}"
+        )
+        t0 = time()
+        _, worker_stats, (n, memo) = parallel_map(
+            partial(read_BAM_chunks, src, n_chunk=n_chunk, threads=threads_read),
+            partial(
+                annotate_chunks,
+                ga=self,
+                antisense=antisense,
+                memo_size=memo_size,
+                dropseq=dropseq,
+            ),
+            partial(
+                write_BAM_chunks,
+                out=out,
+                level=level,
+                threads=threads_write,
+                interval=interval,
+            ),
+            n_workers=n_workers,
+            with_meta=True,
+            meta_to_workers=True,
+            name="annotate_BAM",
+        )
+        dt = time() - t0
+        self.logger.info(
+            f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
+            f"{', ' + memo.summary() if memo_size else ''}"
+        )
+        return n
+
+
+AS_STRAND = {"+": "-", "-": "+"}
+
+
+class TagMemo:
+    """
+    Bounded LRU memo (chrom, strand, blocks) -> annotation tags. Many
+    alignments hit the exact same blocks (PCR duplicates, highly expressed
+    genes), so their tags only need to be looked up and joined once.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def add_stats(self, stats):
+        "sum up counters, e.g. from several worker processes"
+        self.hits += stats["hits"]
+        self.misses += stats["misses"]
+        self.evictions += stats["evictions"]
+
+    def summary(self):
+        n = self.hits + self.misses
+        rate = 100.0 * self.hits / n if n else 0
+        return f"memo hit-rate {rate:.1f}% ({self.evictions} evictions)"
+
+
+def annotation_tags(gf, gn, gs, gt):
+    "(tag, value) pairs for the annotation of one read"
+    if len(gf):
+        return [
+            ("gF", ",".join(gf)),
+            ("gN", ",".join(gn)),
+            ("gS", ",".join(gs)),
+            ("gT", ",".join(gt)),
+        ]
+    else:
+        return [("gF", "INTERGENIC")]
+
+
+# gF values -> Drop-seq tools locus functions
+DROPSEQ_FUNCTION = {
+    "CDS": "CODING",
+    "UTR": "UTR",
+    "non-coding": "CODING",
+    "intron": "INTRONIC",
+}
+DROPSEQ_FUNCTION_PRIO = ["CODING", "UTR", "INTRONIC"]
+
+
+def dropseq_tags(gf, gn, gs, gt):
+    """
+    (tag, value) pairs for the annotation of one read, named and valued
+    as Drop-seq tools' TagReadWithGeneFunction does: gene names (gn),
+    gene strands (gs) and the best locus function per gene (gf), plus the
+    highest-ranking locus function of the read (XF). This is what
+    DigitalExpression and filter_mm_reads.py look at.
+    """
+    if not len(gf):
+        return [("XF", "INTERGENIC")]
+
+    # one entry per gene (the compiled annotation may report several
+    # segments of the same gene), with its highest-ranking function
+    best = {}
+    for f, n, s in zip(gf, gn, gs):
+        f = DROPSEQ_FUNCTION[f]
+        rank = DROPSEQ_FUNCTION_PRIO.index(f)
+        prev = best.get((n, s))
+        if prev is None or rank < DROPSEQ_FUNCTION_PRIO.index(prev):
+            best[(n, s)] = f
+
+    xf = min(best.values(), key=DROPSEQ_FUNCTION_PRIO.index)
+    return [
+        ("gn", ",".join([n for n, s in best.keys()])),
+        ("gs", ",".join([s for n, s in best.keys()])),
+        ("gf", ",".join(best.values())),
+        ("XF", xf),
+    ]
+
+
+## parallel_map() parts for GenomeAnnotation.annotate_BAM_parallel()
+def read_BAM_chunks(src, n_chunk=10000, threads=2):
+    "source: header (meta data) first, then blobs of raw records"
+    from spacemake.bam import BAMReader
+
+    bam = BAMReader(src, threads=threads)
+    yield dict(header_text=bam.header_text, references=bam.references)
+    yield from bam.chunks(n_chunk)
+    bam.close()
+
+
+def annotate_chunks(
+    chunks, ga=None, antisense=False, memo_size=100000, dropseq=False, meta=None
+):
+    """
+    worker: adds the annotation tags to each record of each blob. Yields
+    the memo counters of each blob along with the blob.
+    """
+    from spacemake.bam import record_offsets, record_blocks, append_tags
+
+    references = [name for name, length in meta["references"]]
+    memo = ga.set_memo(memo_size)
+    stats = memo.stats() if memo else {}
+    n = 0
+    for blob in chunks:
+        offsets = record_offsets(blob)
+        records = [blob[a:b] for a, b in zip(offsets, offsets[1:])]
+        mapped = []
+        queries = []
+        for i, rec in enumerate(records):
+            ref_id, flag, blocks = record_blocks(rec)
+            if flag & 4:
+                continue
+
+            mapped.append(i)
+            queries.append((references[ref_id], "-" if flag & 16 else "+", blocks))
+
+        results = ga.query_tags(queries, antisense=antisense, dropseq=dropseq)
+        for i, (_, encoded) in zip(mapped, results):
+            records[i] = append_tags(records[i], encoded)
+
+        n += len(records)
+        if memo:
+            last = stats
+            stats = memo.stats()
+            delta = {k: v - last[k] for k, v in stats.items()}
+        else:
+            delta = {}
+
+        yield len(records), b"".join(records), delta
+
+    return n
+
+
+def write_BAM_chunks(results, out="", level=0, threads=4, interval=5, meta=None):
+    """
+    sink: writes the tagged records in order and adds up the memo
+    counters of all workers. Returns the number of records and the
+    combined counters as a TagMemo.
+    """
+    from spacemake.bam import BAMWriter
+
+    logger = logging.getLogger("annotate_BAM")
+    bam = BAMWriter(
+        out, meta["header_text"], meta["references"], level=level, threads=threads
+    )
+    memo = TagMemo()
+    t0 = time()
+    T = interval
+    n = 0
+    for n_rec, blob, stats in results:
+        bam.write(blob)
+        n += n_rec
+        if stats:
+            memo.add_stats(stats)
+
+        dt = time() - t0
+        if dt > T:
+            logger.info(
+                f"processed {n} alignments in {dt:.2f} seconds ({n/dt:.2f} reads/second)"
+                f"{', ' + memo.summary() if stats else ''}"
+            )
+            T += interval
+
+    bam.close()
+    return n, memo
 
 
 if __name__ == "__main__":
@@ -489,10 +1606,18 @@ if __name__ == "__main__":
         required=True,
         help="path to the original annotation (e.g. gencodev38.gtf.gz)",
     )
+    parser.add_argument(
+        "--gtf-cache",
+        default="",
+        help="path to a columnar cache of the relevant GTF features. Re-used as long "
+        "as path, size and mtime of the GTF do not change "
+        "(default=<compiled>/gtf_cache.npz if --compiled is set)",
+    )
     parser.add_argument(
         "--tabular",
         default="",
-        help="path to tabular version of the relevant features only (e.g. gencodev38.tsv)",
+        help="DEPRECATED (use --gtf-cache): path to an existing tabular version of "
+        "the relevant features only (e.g. gencodev38.tsv)",
     )
     parser.add_argument(
         "--compiled",
@@ -504,6 +1629,12 @@ if __name__ == "__main__":
         action="store_true",
         help="enable using the compiled version of GenomeAnnotation (faster)",
     )
+    parser.add_argument(
+        "--threads-compile",
+        type=int,
+        default=1,
+        help="number of processes used to compile the annotation (default=1)",
+    )
     parser.add_argument(
         "--antisense",
         default=False,
@@ -514,27 +1645,105 @@ if __name__ == "__main__":
         "--dropseqtools",
         default=False,
         action="store_true",
-        help="emulate dropseqtools behavior",
+        help="emit the gn, gs, gf and XF tags of Drop-seq tools' TagReadWithGeneFunction "
+        "instead of gN, gS, gF and gT, for use with DigitalExpression. Implies --antisense, "
+        "as DigitalExpression decides on the strand itself",
     )
 
-    parser.add_argument("--bam-in", help="path for the input BAM to be tagged")
+    parser.add_argument(
+        "--bam-in",
+        default="/dev/stdin",
+        help="path for the input BAM to be tagged (default=/dev/stdin)",
+    )
     parser.add_argument(
         "--bam-out",
-        help="path for the tagged BAM output",
+        default="/dev/stdout",
+        help="path for the tagged BAM output (default=/dev/stdout)",
+    )
+    parser.add_argument(
+        "--bam-out-level",
+        type=int,
+        default=0,
+        help="compression level of the BAM output (default=0, uncompressed)",
+    )
+    parser.add_argument(
+        "--threads-work",
+        type=int,
+        default=1,
+        help="number of worker processes for the annotation (default=1)",
+    )
+    parser.add_argument(
+        "--threads-read",
+        type=int,
+        default=2,
+        help="number of threads for BAM decompression if --threads-work > 1 (default=2)",
+    )
+    parser.add_argument(
+        "--threads-write",
+        type=int,
+        default=4,
+        help="number of threads for BAM compression if --threads-work > 1 (default=4)",
+    )
+    parser.add_argument(
+        "--n-chunk",
+        type=int,
+        default=10000,
+        help="number of alignments per chunk of work (default=10000)",
+    )
+    parser.add_argument(
+        "--memo-size",
+        type=int,
+        default=100000,
+        help="number of distinct alignment block combinations for which the "
+        "annotation tags are memoized (per worker). 0 turns it off (default=100000)",
     )
     args = parser.parse_args()
 
-    if CompiledClassifier.files_exist(args.compiled) and args.use_compiled:
+    ga = None
+    if args.use_compiled and GenomeAnnotation.compiled_index_exists(args.compiled):
         ga = GenomeAnnotation.from_compiled_index(args.compiled)
+        if not ga.matches_source(args.gtf):
+            logging.warning(
+                f"compiled index in '{args.compiled}' was built from a different "
+                f"version of '{args.gtf}'. Re-compiling."
+            )
+            ga = None
 
-    elif args.tabular and os.access(args.tabular, os.R_OK):
-        ga = GenomeAnnotation.from_uncompiled_df(args.tabular)
+    if ga is None:
+        if args.tabular and os.access(args.tabular, os.R_OK):
+            ga = GenomeAnnotation.from_uncompiled_df(args.tabular)
+        else:
+            gtf_cache = args.gtf_cache
+            if not gtf_cache and args.compiled:
+                os.makedirs(args.compiled, exist_ok=True)
+                gtf_cache = os.path.join(args.compiled, "gtf_cache.npz")
 
-    else:
-        ga = GenomeAnnotation.from_GTF(args.gtf, df_cache=args.tabular)
+            ga = GenomeAnnotation.from_GTF(args.gtf, cache=gtf_cache)
 
     # perform compilation if that's what we want
     if not ga.is_compiled and args.use_compiled:
-        ga = ga.compile(args.compiled)
-
-    ga.annotate_BAM(args.bam_in, args.bam_out, antisense=args.antisense)
+        ga = ga.compile(args.compiled, n_workers=args.threads_compile)
+
+    if args.threads_work > 1:
+        ga.annotate_BAM_parallel(
+            args.bam_in,
+            args.bam_out,
+            antisense=args.antisense or args.dropseqtools,
+            n_workers=args.threads_work,
+            n_chunk=args.n_chunk,
+            threads_read=args.threads_read,
+            threads_write=args.threads_write,
+            level=args.bam_out_level,
+            memo_size=args.memo_size,
+            dropseq=args.dropseqtools,
+        )
+    else:
+        ga.annotate_BAM(
+            args.bam_in,
+            args.bam_out,
+            antisense=args.antisense or args.dropseqtools,
+            batch_size=args.n_chunk,
+            level=args.bam_out_level,
+            memo_size=args.memo_size,
+            dropseq=args.dropseqtools,
+        )
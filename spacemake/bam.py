@@ -0,0 +1,620 @@
+"""
+Minimal support for reading and writing BAM records as raw bytes, without
+going through pysam.AlignedSegment and its SAM text representation. Only
+what is needed for unaligned BAM (uBAM) and for tagging aligned records
+is implemented.
+"""
+
+__version__ = "0.9"
+__author__ = ["Marvin Jens"]
+__license__ = "GPL"
+__email__ = ["marvin.jens@mdc-berlin.de"]
+
+import struct
+
+# 4-bit nucleotide codes as used in BAM. Everything unknown becomes N (15).
+# Two bases are packed into one byte, the first one in the high nibble.
+NT16 = "=ACMGRSVTWYHKDBN"
+_codes = [15] * 256
+for _i, _c in enumerate(NT16):
+    _codes[ord(_c)] = _i
+    _codes[ord(_c.lower())] = _i
+NT16_LO = bytes(_codes)
+NT16_HI = bytes([c << 4 for c in _codes])
+
+# Phred+33 quality string -> raw Phred scores
+QUAL_TABLE = bytes([max(i - 33, 0) for i in range(256)])
+
+# bin for unmapped reads without a position: reg2bin(-1, 0)
+UNMAPPED_BIN = 4680
+FLAG_UNMAPPED = 4
+
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq,
+# next_refID, next_pos, tlen
+CORE = struct.Struct("<iiBBHHHiiii")
+
+
+def encode_seq(seq):
+    """
+    Pack a sequence string into 4-bit codes (two bases per byte).
+    """
+    raw = seq.encode("ascii")
+    hi = raw[0::2].translate(NT16_HI)
+    lo = raw[1::2].translate(NT16_LO)
+    if len(lo) < len(hi):
+        lo += b"\0"
+
+    # bytewise OR of the two nibble strings via big integers
+    return (int.from_bytes(hi, "big") | int.from_bytes(lo, "big")).to_bytes(
+        len(hi), "big"
+    )
+
+
+def encode_qual(qual, l_seq):
+    if not qual or qual == "*":
+        return b"\xff" * l_seq
+
+    return qual.encode("ascii").translate(QUAL_TABLE)
+
+
+def encode_tags(tags):
+    """
+    Encode a list of (tag, value) pairs. All values are stored as type Z
+    (string), just like pysam does for str values.
+    """
+    return b"".join(
+        [
+            tag.encode("ascii") + b"Z" + str(value).encode("ascii") + b"\0"
+            for tag, value in tags
+        ]
+    )
+
+
+def encode_unaligned(qname, seq, qual, tags=[], flag=FLAG_UNMAPPED):
+    """
+    Build the binary BAM record of an unaligned read, including the
+    leading block_size field, so that records can simply be concatenated
+    and written to a BAMWriter.
+    """
+    return pack_unaligned(
+        qname.encode("ascii"),
+        seq,
+        encode_qual(qual, len(seq)),
+        encode_tags(tags),
+        flag=flag,
+    )
+
+
+def pack_unaligned(name, seq, qual, tags, flag=FLAG_UNMAPPED):
+    """
+    Same as encode_unaligned(), but name, qual (raw Phred scores) and tags
+    are already in their binary form, e.g. from decode_record().
+    """
+    name = name + b"\0"
+    l_seq = len(seq)
+    data = b"".join(
+        [
+            CORE.pack(-1, -1, len(name), 0, UNMAPPED_BIN, 0, flag, l_seq, -1, -1, 0),
+            name,
+            encode_seq(seq),
+            qual,
+            tags,
+        ]
+    )
+    return struct.pack("<i", len(data)) + data
+
+
+# packed 4-bit codes -> hex digits -> bases
+_HEX_TO_NT16 = str.maketrans("0123456789abcdef", NT16)
+
+
+def decode_seq(packed, l_seq):
+    import binascii
+
+    return binascii.hexlify(packed).decode("ascii").translate(_HEX_TO_NT16)[:l_seq]
+
+
+def record_offsets(blob):
+    """
+    Start offsets of the records in a blob of concatenated BAM records
+    (each including its block_size field), plus the end of the blob.
+    """
+    offsets = [0]
+    pos = 0
+    n = len(blob)
+    unpack = struct.Struct("<i").unpack_from
+    while pos < n:
+        pos += 4 + unpack(blob, pos)[0]
+        offsets.append(pos)
+
+    return offsets
+
+
+def decode_record(rec):
+    """
+    Splits a binary BAM record (including block_size) into
+    (flag, name, seq, qual, tags). seq is decoded to a string, name, qual
+    (raw Phred scores) and tags stay binary. Alignment information
+    (position, CIGAR, ...) is dropped.
+    """
+    (
+        ref_id,
+        pos,
+        l_read_name,
+        mapq,
+        bin_,
+        n_cigar_op,
+        flag,
+        l_seq,
+        next_ref_id,
+        next_pos,
+        tlen,
+    ) = CORE.unpack_from(rec, 4)
+    i = 4 + CORE.size
+    name = rec[i : i + l_read_name - 1]
+    i += l_read_name + 4 * n_cigar_op
+    l_packed = (l_seq + 1) // 2
+    seq = decode_seq(rec[i : i + l_packed], l_seq)
+    i += l_packed
+    qual = rec[i : i + l_seq]
+    tags = rec[i + l_seq :]
+    return flag, name, seq, qual, tags
+
+
+# CIGAR operations which consume the reference: M, D, N, =, X
+# and those of them which are part of an aligned block: M, =, X
+CIGAR_REF = {0, 2, 3, 7, 8}
+CIGAR_BLOCK = {0, 7, 8}
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag
+POS = struct.Struct("<iiBBHHH")
+
+
+def record_blocks(rec):
+    """
+    Position of an aligned BAM record (including block_size). Returns
+    (ref_id, flag, blocks), where blocks are the aligned (start, end)
+    reference intervals, as pysam.AlignedSegment.get_blocks() reports them.
+    """
+    ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag = POS.unpack_from(rec, 4)
+    i = 4 + CORE.size + l_read_name
+    if n_cigar_op == 1:
+        # most common case, e.g. 60M
+        c = struct.unpack_from("<I", rec, i)[0]
+        if c & 15 in CIGAR_BLOCK:
+            return ref_id, flag, [(pos, pos + (c >> 4))]
+        return ref_id, flag, []
+
+    blocks = []
+    for c in struct.unpack_from(f"<{n_cigar_op}I", rec, i):
+        op = c & 15
+        l = c >> 4
+        if op in CIGAR_BLOCK:
+            blocks.append((pos, pos + l))
+            pos += l
+        elif op in CIGAR_REF:
+            pos += l
+
+    return ref_id, flag, blocks
+
+
+# sizes of the fixed-size tag value types A, c, C, s, S, i, I, f
+TAG_SIZES = {ord(t): size for t, size in zip("AcCsSiIf", [1, 1, 1, 2, 2, 4, 4, 4])}
+
+
+def record_tag(rec, tag):
+    """
+    Raw value of the string (Z) tag (e.g. b"CB") of a BAM record (including
+    block_size), or None if the record does not have it.
+    """
+    core = CORE.unpack_from(rec, 4)
+    l_read_name, n_cigar_op, l_seq = core[2], core[5], core[7]
+    i = 4 + CORE.size + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+    n = len(rec)
+    while i < n:
+        name = rec[i : i + 2]
+        typ = rec[i + 2]
+        i += 3
+        if typ == 90 or typ == 72:  # Z, H
+            end = rec.index(b"\0", i)
+            if name == tag:
+                return rec[i:end]
+            i = end + 1
+        elif typ == 66:  # B
+            (count,) = struct.unpack_from("<i", rec, i + 1)
+            i += 5 + count * TAG_SIZES[rec[i]]
+        else:
+            i += TAG_SIZES[typ]
+
+    return None
+
+
+def record_string_tags(rec):
+    """
+    All string (Z, H) tags of a BAM record (including block_size) as a
+    list of raw (name, value) pairs. Tags of other types are skipped.
+    """
+    core = CORE.unpack_from(rec, 4)
+    l_read_name, n_cigar_op, l_seq = core[2], core[5], core[7]
+    i = 4 + CORE.size + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+    n = len(rec)
+    tags = []
+    while i < n:
+        name = rec[i : i + 2]
+        typ = rec[i + 2]
+        i += 3
+        if typ == 90 or typ == 72:  # Z, H
+            end = rec.index(b"\0", i)
+            tags.append((name, rec[i:end]))
+            i = end + 1
+        elif typ == 66:  # B
+            (count,) = struct.unpack_from("<i", rec, i + 1)
+            i += 5 + count * TAG_SIZES[rec[i]]
+        else:
+            i += TAG_SIZES[typ]
+
+    return tags
+
+
+class RawAlignment:
+    """
+    The parts of pysam.AlignedSegment which spacemake.quant classifies
+    alignments by, decoded on demand from a BAM record (including
+    block_size). Only string tags are visible to get_tags().
+    """
+
+    def __init__(self, rec, ref_names):
+        core = CORE.unpack_from(rec, 4)
+        self.rec = rec
+        self.ref_names = ref_names
+        self.tid = core[0]
+        self.flag = core[6]
+        self.l_read_name = core[2]
+        self.n_cigar_op = core[5]
+        self.l_seq = core[7]
+        self.i_cigar = 4 + CORE.size + self.l_read_name
+        self.i_seq = self.i_cigar + 4 * self.n_cigar_op
+
+    @property
+    def reference_name(self):
+        return self.ref_names[self.tid] if self.tid >= 0 else None
+
+    @property
+    def is_reverse(self):
+        return bool(self.flag & 16)
+
+    @property
+    def qname(self):
+        i = 4 + CORE.size
+        return self.rec[i : i + self.l_read_name - 1].decode("ascii")
+
+    @property
+    def cigartuples(self):
+        if not self.n_cigar_op:
+            return None
+
+        ops = struct.unpack_from(f"<{self.n_cigar_op}I", self.rec, self.i_cigar)
+        return [(c & 15, c >> 4) for c in ops]
+
+    @property
+    def query_sequence(self):
+        if not self.l_seq:
+            return None
+
+        packed = self.rec[self.i_seq : self.i_seq + (self.l_seq + 1) // 2]
+        return decode_seq(packed, self.l_seq)
+
+    def has_tag(self, tag):
+        return record_tag(self.rec, tag.encode("ascii")) is not None
+
+    def get_tag(self, tag):
+        value = record_tag(self.rec, tag.encode("ascii"))
+        if value is None:
+            raise KeyError(f"tag '{tag}' not present")
+
+        return value.decode("ascii")
+
+    def get_tags(self):
+        return [
+            (name.decode("ascii"), value.decode("ascii"))
+            for name, value in record_string_tags(self.rec)
+        ]
+
+
+def append_tags(rec, tags):
+    """
+    Append binary tags (see encode_tags()) to a BAM record (including
+    block_size). Existing tags are not checked for duplicates.
+    """
+    (block_size,) = struct.unpack_from("<i", rec, 0)
+    return struct.pack("<i", block_size + len(tags)) + rec[4:] + tags
+
+
+def encode_header(text, references=[]):
+    """
+    Binary BAM header from the SAM header text and a list of
+    (name, length) tuples for the reference sequences.
+    """
+    text = (text.rstrip("\n") + "\n").encode("ascii")
+    parts = [b"BAM\1", struct.pack("<i", len(text)), text]
+    parts.append(struct.pack("<i", len(references)))
+    for name, length in references:
+        name = name.encode("ascii") + b"\0"
+        parts.append(struct.pack("<i", len(name)) + name + struct.pack("<i", length))
+
+    return b"".join(parts)
+
+
+# BGZF (blocked gzip) output. Blocks hold at most this much uncompressed data
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_HEADER = struct.Struct("<BBBBIBBHBBHH")
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzf_block(data, level=6):
+    """
+    Compress up to BGZF_BLOCK_SIZE bytes into one complete BGZF block.
+    """
+    import zlib
+
+    z = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = z.compress(data) + z.flush()
+    # BSIZE is the total block size minus 1 (18 bytes header, 8 bytes footer)
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    footer = struct.pack("<II", zlib.crc32(data), len(data))
+    return header + cdata + footer
+
+
+class BGZFWriter:
+    """
+    Writes a BGZF stream, compressing blocks in a pool of threads (zlib
+    releases the GIL). Blocks are written to the file in order. At most
+    max_pending blocks are in flight to keep memory use bounded.
+    """
+
+    def __init__(self, fname, level=6, threads=4, max_pending=None):
+        from collections import deque
+
+        self.fname = fname
+        self.level = level
+        self.f = open(fname, "wb")
+        self.buf = b""
+        self.pending = deque()
+        self.max_pending = max_pending or 4 * threads
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.pool = ThreadPoolExecutor(threads)
+        else:
+            self.pool = None
+
+    def _submit(self, data):
+        if self.pool is None:
+            self.f.write(bgzf_block(data, self.level))
+            return
+
+        self.pending.append(self.pool.submit(bgzf_block, data, self.level))
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, data):
+        if self.buf:
+            data = self.buf + data
+
+        i = 0
+        while len(data) - i >= BGZF_BLOCK_SIZE:
+            self._submit(data[i : i + BGZF_BLOCK_SIZE])
+            i += BGZF_BLOCK_SIZE
+
+        self.buf = data[i:]
+
+    def close(self):
+        if self.f.closed:
+            return
+
+        if self.buf:
+            self._submit(self.buf)
+            self.buf = b""
+
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+
+        if self.pool is not None:
+            self.pool.shutdown()
+
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BGZFReader:
+    """
+    Reads a BGZF stream. Blocks are decompressed in a pool of threads,
+    a few blocks ahead of what has been read so far.
+    """
+
+    def __init__(self, fname, threads=2, lookahead=None):
+        from collections import deque
+
+        self.fname = fname
+        self.f = open(fname, "rb")
+        self.pending = deque()
+        self.lookahead = lookahead or 4 * threads
+        self.eof = False
+        self.buf = b""
+        self.pos = 0
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.pool = ThreadPoolExecutor(threads)
+        else:
+            self.pool = None
+
+    def _read_block(self):
+        "compressed data of the next block, or None at the end of the file"
+        header = self.f.read(12)
+        if len(header) < 12:
+            return None
+
+        if header[:4] != b"\x1f\x8b\x08\x04":
+            raise ValueError(f"'{self.fname}' is not in BGZF format")
+
+        (xlen,) = struct.unpack("<H", header[10:12])
+        extra = self.f.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            si1, si2, slen = struct.unpack_from("<BBH", extra, i)
+            if si1 == 66 and si2 == 67:
+                (bsize,) = struct.unpack_from("<H", extra, i + 4)
+            i += 4 + slen
+
+        if bsize is None:
+            raise ValueError(f"'{self.fname}' is not in BGZF format (no BSIZE)")
+
+        # 8 bytes footer (CRC32, ISIZE) are not checked
+        data = self.f.read(bsize - xlen - 19 + 8)
+        return data[:-8]
+
+    def _fill(self):
+        while not self.eof and len(self.pending) < self.lookahead:
+            cdata = self._read_block()
+            if cdata is None:
+                self.eof = True
+            elif self.pool is None:
+                self.pending.append(_inflate(cdata))
+            else:
+                self.pending.append(self.pool.submit(_inflate, cdata))
+
+    def _next_data(self):
+        self._fill()
+        if not self.pending:
+            return b""
+
+        data = self.pending.popleft()
+        return data if self.pool is None else data.result()
+
+    def ensure(self, n):
+        """
+        Make sure that at least n bytes are buffered after the current
+        position (fewer only at the end of the stream).
+        """
+        if len(self.buf) - self.pos >= n:
+            return True
+
+        parts = [self.buf[self.pos :]]
+        have = len(parts[0])
+        while have < n:
+            data = self._next_data()
+            if not data:
+                if self.eof and not self.pending:
+                    break
+                continue
+
+            parts.append(data)
+            have += len(data)
+
+        self.buf = b"".join(parts)
+        self.pos = 0
+        return have >= n
+
+    def read(self, n):
+        self.ensure(n)
+        data = self.buf[self.pos : self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        if self.pool is not None:
+            # shutdown(cancel_futures=True) needs Python >= 3.9
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.pool.shutdown()
+        self.f.close()
+
+
+def _inflate(cdata):
+    import zlib
+
+    return zlib.decompress(cdata, -15)
+
+
+class BAMReader(BGZFReader):
+    """
+    Reads the header of a BAM file upon creation (header_text and
+    references) and then hands out the records as raw bytes in chunks,
+    see chunks().
+    """
+
+    def __init__(self, fname, **kw):
+        super().__init__(fname, **kw)
+        if self.read(4) != b"BAM\1":
+            raise ValueError(f"'{fname}' is not a BAM file")
+
+        (l_text,) = struct.unpack("<i", self.read(4))
+        self.header_text = self.read(l_text).rstrip(b"\0").decode("ascii")
+        (n_ref,) = struct.unpack("<i", self.read(4))
+        self.references = []
+        for i in range(n_ref):
+            (l_name,) = struct.unpack("<i", self.read(4))
+            name = self.read(l_name).rstrip(b"\0").decode("ascii")
+            (l_ref,) = struct.unpack("<i", self.read(4))
+            self.references.append((name, l_ref))
+
+    def chunks(self, n_records=1000):
+        """
+        Yields blobs of up to n_records concatenated records, each
+        including its block_size field. See record_offsets().
+        """
+        unpack = struct.Struct("<i").unpack_from
+        while True:
+            parts = []
+            n = 0
+            while n < n_records:
+                if not self.ensure(4):
+                    if len(self.buf) > self.pos:
+                        raise ValueError(f"truncated BAM record in '{self.fname}'")
+                    break
+
+                (block_size,) = unpack(self.buf, self.pos)
+                if not self.ensure(4 + block_size):
+                    raise ValueError(f"truncated BAM record in '{self.fname}'")
+
+                # take as many complete records as are buffered already
+                buf = self.buf
+                start = end = self.pos
+                while n < n_records and end + 4 <= len(buf):
+                    next_end = end + 4 + unpack(buf, end)[0]
+                    if next_end > len(buf):
+                        break
+                    end = next_end
+                    n += 1
+
+                parts.append(buf[start:end])
+                self.pos = end
+
+            if n:
+                yield b"".join(parts)
+
+            if n < n_records:
+                break
+
+    def __iter__(self):
+        return self.chunks()
+
+
+class BAMWriter(BGZFWriter):
+    """
+    BGZF writer for BAM files. Writes the binary header upon creation.
+    Records (see encode_unaligned()) can then be passed to write(), either
+    one by one or concatenated.
+    """
+
+    def __init__(self, fname, header, references=[], **kw):
+        super().__init__(fname, **kw)
+        self.write(encode_header(str(header), references))
@@ -7,17 +7,23 @@ __version__ = "0.9"
 __author__ = ["Marvin Jens"]
 __license__ = "GPL"
 
-import multiprocessing as mp
+from functools import partial
 from spacemake.parallel import (
-    put_or_abort,
-    queue_iter,
-    join_with_empty_queues,
     chunkify,
+    count_dict_sum,
+    parallel_map,
     ExceptionLogging,
-    log_qerr,
 )
 from time import time
 import pysam
+from spacemake.bam import (
+    BAMReader,
+    BAMWriter,
+    decode_record,
+    encode_tags,
+    pack_unaligned,
+    record_offsets,
+)
 import logging
 
 
@@ -96,6 +102,18 @@ def parse_cmdline():
         default=20000,
     )
 
+    parser.add_argument(
+        "--match-cache-size",
+        help="number of adapter match results to keep in each worker's LRU cache. Reads made up of adapter, polyA, etc. repeat a lot (default=100000)",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--transport",
+        help="'raw' passes raw BAM records between reader, workers and writer and keeps all tags of the input. 'records' converts every read to a python object (default=raw)",
+        choices=["raw", "records"],
+        default="raw",
+    )
     parser.add_argument(
         "--stats-out",
         help="write tab-separated table with trimming results here",
@@ -109,7 +127,7 @@ def load_adapters(right, left):
     from spacemake.util import fasta_chunks
 
     adapters_right = []
-    if args.adapters_right:
+    if right:
         for seq_id, seq in fasta_chunks(open(right)):
             name = seq_id.split()[0]
             adapters_right.append(
@@ -117,7 +135,7 @@ def load_adapters(right, left):
             )
 
     adapters_left = []
-    if args.adapters_left:
+    if left:
         for seq_id, seq in fasta_chunks(open(left)):
             name = seq_id.split()[0]
             adapters_left.append(
@@ -127,11 +145,35 @@ def load_adapters(right, left):
     return adapters_right, adapters_left
 
 
-def make_header(bam):
+class AdapterMatcher:
+    """
+    Loads the adapters once (per process) and memoizes their matches in a
+    bounded LRU cache, keyed by the exact sequence that is searched. Match
+    results are reduced to (rstart, rstop) or None.
+    """
+
+    def __init__(self, right, left, cache_size=100000):
+        from functools import lru_cache
+
+        self.right, self.left = load_adapters(right, left)
+        self.adapters = {"right": self.right, "left": self.left}
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    def _match(self, side, i, seq):
+        match = self.adapters[side][i][2].match_to(seq)
+        if match:
+            return match.rstart, match.rstop
+
+    def cache_stats(self):
+        info = self.match.cache_info()
+        return {"match_cache_hit": info.hits, "match_cache_miss": info.misses}
+
+
+def make_header(bam_header):
     import os
     import sys
 
-    header = bam.header.to_dict()
+    header = bam_header.to_dict()
     progname = os.path.basename(__file__)
     # if "PG" in header:
     # for pg in header['PG']:
@@ -157,7 +199,7 @@ class SimpleRead:
         self.query_name = name
         self.query_sequence = seq
         self.query_qualities = qual
-        self.tags = {}
+        self.tags = tags
 
     @classmethod
     def from_BAM(cls, read):
@@ -189,14 +231,74 @@ class SimpleRead:
             yield aln
 
 
-def process_reads(read_source, args, stats={}, total={}, lhist={}):
-    adapters_right, adapters_left = load_adapters(
-        args.adapters_right, args.adapters_left
+def quality_trim_ends(reads, min_qual):
+    """
+    Quality trimming for a whole chunk of reads: each read is cut before
+    its last (3'-most) base with quality < min_qual. The qualities are packed
+    into a padded (n, L) uint8 matrix which is scanned in one go. Returns
+    the new end of every read.
+    """
+    quals = [read.query_qualities for read in reads]
+    lengths = np.array([len(read.query_sequence) for read in reads], dtype=np.int64)
+    qlens = np.array([0 if q is None else len(q) for q in quals], dtype=np.int64)
+    L = max(qlens.max(initial=0), 1)
+
+    Q = np.full((len(reads), L), 255, dtype=np.uint8)
+    mask = np.arange(L)[np.newaxis, :] < qlens[:, np.newaxis]
+    Q[mask] = np.frombuffer(
+        b"".join([bytes(q) for q in quals if q is not None]), dtype=np.uint8
     )
-    for read in read_source:
+    low = Q < min_qual
+    # index of the last low quality base
+    last = L - 1 - low[:, ::-1].argmax(axis=1)
+    return np.where(low.any(axis=1), lengths - (qlens - last), lengths)
+
+
+def quality_trimmed(read_source, min_qual, n_chunk=20000):
+    "yields (read, new end after quality trimming)"
+    for n, reads in chunkify(read_source, n_chunk=n_chunk):
+        yield from zip(reads, quality_trim_ends(reads, min_qual).tolist())
+
+
+class RawRead:
+    """
+    The parts of a raw BAM record (see spacemake.bam.decode_record()) that
+    process_reads() needs, with the same interface as SimpleRead. The
+    original tags are kept in binary form and tags from set_tag() are
+    appended to them in to_record().
+    """
+
+    __slots__ = ["query_name", "query_sequence", "query_qualities", "raw_tags", "tags"]
+
+    def __init__(self, rec):
+        (
+            flag,
+            self.query_name,
+            self.query_sequence,
+            self.query_qualities,
+            self.raw_tags,
+        ) = decode_record(rec)
+        self.tags = {}
+
+    def set_tag(self, tag, value):
+        self.tags[tag] = value
+
+    def to_record(self):
+        return pack_unaligned(
+            self.query_name,
+            self.query_sequence,
+            bytes(self.query_qualities),
+            self.raw_tags + encode_tags(self.tags.items()),
+        )
+
+
+def process_reads(read_source, args, stats={}, total={}, lhist={}, matcher=None):
+    if matcher is None:
+        matcher = AdapterMatcher(
+            args.adapters_right, args.adapters_left, args.match_cache_size
+        )
+    for read, q_end in quality_trimmed(read_source, args.min_qual, args.n_chunk):
         read_seq = read.query_sequence
-        read_qual = read.query_qualities
-        # print(read_qual)
         start = 0
         end = len(read_seq)
 
@@ -208,17 +310,11 @@ def process_reads(read_source, args, stats={}, total={}, lhist={}):
         trimmed_names_left = []
         trimmed_bases_left = []
 
-        # quality trimming
-        qtrim = np.array(read_qual) < args.min_qual
-        # print(qtrim)
-        # print(
-        #     f"qtrim.argmax()={qtrim.argmax()} qtrim[::-1].argmax()={qtrim[::-1].argmax()}"
-        # )
-        if qtrim.sum():
+        # quality trimming (see quality_trim_ends())
+        if q_end < end:
             # the first position where q < min_q (from the 3' end) should be the new end.
-            new_end = end - (qtrim[::-1].argmax() + 1)
-            n_trimmed = end - new_end
-            end = new_end
+            n_trimmed = end - q_end
+            end = q_end
             trimmed_bases_right.append(n_trimmed)
             trimmed_names_right.append("Q")
 
@@ -228,10 +324,11 @@ def process_reads(read_source, args, stats={}, total={}, lhist={}):
 
         # right end adapter trimming
         if (end - start) >= args.min_length:
-            for adap_name, adap_seq, adap in adapters_right:
-                match = adap.match_to(read_seq[start:end])
+            for i, (adap_name, adap_seq, adap) in enumerate(matcher.right):
+                match = matcher.match("right", i, read_seq[start:end])
                 if match:
-                    new_end = min(end, match.rstart)
+                    rstart, rstop = match
+                    new_end = min(end, rstart)
                     n_trimmed = end - new_end
                     end = new_end
                     trimmed_bases_right.append(n_trimmed)
@@ -243,11 +340,12 @@ def process_reads(read_source, args, stats={}, total={}, lhist={}):
 
         # left end adapter trimming
         if (end - start) >= args.min_length:
-            for adap_name, adap_seq, adap in adapters_left:
-                match = adap.match_to(read_seq[start:end])
+            for i, (adap_name, adap_seq, adap) in enumerate(matcher.left):
+                match = matcher.match("left", i, read_seq[start:end])
                 if match:
                     # print(adap_name, adap, match)
-                    new_start = max(start, match.rstop)
+                    rstart, rstop = match
+                    new_start = max(start, rstop)
                     n_trimmed = new_start - start
                     start = new_start
                     trimmed_bases_left.append(n_trimmed)
@@ -263,6 +361,9 @@ def process_reads(read_source, args, stats={}, total={}, lhist={}):
             total["bp_kept"] += end
             lhist[end] += 1
             # print(f"keeping read up to {end}")
+            # pysam builds a new array on every access, so only get the
+            # qualities if they are really needed
+            read_qual = read.query_qualities
             read.query_sequence = read_seq[start:end]
             read.query_qualities = read_qual[start:end]
             if trimmed_names_right:
@@ -309,7 +410,7 @@ def main_single(args):
     bam_out = pysam.AlignmentFile(
         args.bam_out,
         f"w{args.bam_out_mode}",
-        header=make_header(bam_in),
+        header=make_header(bam_in.header),
         threads=args.threads_write,
     )
 
@@ -317,6 +418,9 @@ def main_single(args):
     total = defaultdict(int)
     lhist = defaultdict(int)
 
+    matcher = AdapterMatcher(
+        args.adapters_right, args.adapters_left, args.match_cache_size
+    )
     t0 = time()
     for read in process_reads(
         skim_reads(bam_in.fetch(until_eof=True), args.skim),
@@ -324,6 +428,7 @@ def main_single(args):
         stats=stats,
         total=total,
         lhist=lhist,
+        matcher=matcher,
     ):
         bam_out.write(read)
 
@@ -332,105 +437,154 @@ def main_single(args):
         f"processed {stats['N_input']} reads in {dt:.1f} seconds ({stats['N_input']/dt:.1f} reads/second)."
     )
 
+    cache = matcher.cache_stats()
+    log_cache_stats(cache, logger)
     if args.stats_out:
-        with open(args.stats_out, "wt") as f:
-            f.write("key\tcount\tpercent\n")
-            for k, v in sorted(stats.items(), key=lambda x: -x[1]):
-                f.write(f"reads\t{k}\t{v}\t{100.0 * v/stats['N_input']:.2f}\n")
+        write_stats(args.stats_out, stats, total, lhist, cache)
+
+
+def log_cache_stats(cache, logger):
+    n = cache["match_cache_hit"] + cache["match_cache_miss"]
+    if n:
+        logger.info(
+            f"adapter match cache hit rate {100.0 * cache['match_cache_hit'] / n:.2f} % "
+            f"of {n} lookups"
+        )
 
-            for k, v in sorted(total.items(), key=lambda x: -x[1]):
-                f.write(f"bases\t{k}\t{v}\t{100.0 * v/total['bp_input']:.2f}\n")
 
-            for k, v in sorted(lhist.items()):
-                f.write(f"L_final\t{k}\t{v}\t{100.0 * v/stats['N_kept']:.2f}\n")
+def write_stats(fname, stats, total, lhist, cache):
+    with open(fname, "wt") as f:
+        f.write("key\tcount\tpercent\n")
+        for k, v in sorted(stats.items(), key=lambda x: -x[1]):
+            f.write(f"reads\t{k}\t{v}\t{100.0 * v/stats['N_input']:.2f}\n")
+
+        for k, v in sorted(total.items(), key=lambda x: -x[1]):
+            f.write(f"bases\t{k}\t{v}\t{100.0 * v/total['bp_input']:.2f}\n")
+
+        for k, v in sorted(lhist.items()):
+            f.write(f"L_final\t{k}\t{v}\t{100.0 * v/stats['N_kept']:.2f}\n")
+
+        n_lookup = max(sum(cache.values()), 1)
+        for k, v in sorted(cache.items()):
+            f.write(f"cache\t{k}\t{v}\t{100.0 * v/n_lookup:.2f}\n")
 
 
 ## Parallel implementation
-def parallel_read(Qsam, args, Qerr, abort_flag, stat_list):
+def parallel_read(args):
     """
-    reads from BAM file, converts to string, groups the records into chunks for
-    faster parallel processing, and puts these on a mp.Queue()
+    Source for parallel_map(): first yields the header for the output,
+    then groups the records into chunks for faster parallel processing.
+    With --transport=raw, chunks are blobs of raw BAM records, otherwise
+    lists of SimpleRead objects.
     """
-    with ExceptionLogging("read_BAM", Qerr=Qerr, exc_flag=abort_flag) as el:
-        bam_header = stat_list[-1]
-        bam_in = pysam.AlignmentFile(
-            args.bam_in, "rb", check_sq=False, threads=args.threads_read
+    if args.transport == "raw":
+        bam_in = BAMReader(args.bam_in, threads=args.threads_read)
+        yield make_header(pysam.AlignmentHeader.from_text(bam_in.header_text))
+
+        n = 0
+        for n_chunk, blob in enumerate(bam_in.chunks(args.n_chunk)):
+            if args.skim > 1:
+                offsets = record_offsets(blob)
+                blob = b"".join(
+                    [
+                        blob[start:end]
+                        for i, (start, end) in enumerate(zip(offsets, offsets[1:]))
+                        if (n + i) % args.skim == 0
+                    ]
+                )
+                n += len(offsets) - 1
+
+            logging.debug(f"dispatching chunk {n_chunk} of {len(blob)} bytes")
+            yield blob
+
+        bam_in.close()
+        return
+
+    bam_in = pysam.AlignmentFile(
+        args.bam_in, "rb", check_sq=False, threads=args.threads_read
+    )
+    yield make_header(bam_in.header)
+    if args.skim:
+        read_source = SimpleRead.iter_BAM(
+            skim_reads(bam_in.fetch(until_eof=True), args.skim)
         )
-        bam_header.append(make_header(bam_in))
+    else:
+        read_source = SimpleRead.iter_BAM(bam_in.fetch(until_eof=True))
 
-        # read_source = BAM_to_string(skim_reads(bam_in.fetch(until_eof=True), args.skim))
-        if args.skim:
-            read_source = SimpleRead.iter_BAM(
-                skim_reads(bam_in.fetch(until_eof=True), args.skim)
+    for n_chunk, chunk in chunkify(read_source, n_chunk=args.n_chunk):
+        logging.debug(f"dispatching chunk {n_chunk} of {len(chunk)} reads")
+        yield chunk
+
+
+def parallel_trim(chunks, args):
+    """
+    Worker for parallel_map(): trims chunks of reads. Returns the counts.
+    """
+    _stats = defaultdict(int)
+    _total = defaultdict(int)
+    _lhist = defaultdict(int)
+    # adapters are loaded once per worker, and the match cache persists
+    # across chunks
+    matcher = AdapterMatcher(
+        args.adapters_right, args.adapters_left, args.match_cache_size
+    )
+    for reads in chunks:
+        if args.transport == "raw":
+            offsets = record_offsets(reads)
+            reads = [
+                RawRead(reads[start:end]) for start, end in zip(offsets, offsets[1:])
+            ]
+
+        trimmed = list(
+            process_reads(
+                reads,
+                args,
+                stats=_stats,
+                total=_total,
+                lhist=_lhist,
+                matcher=matcher,
             )
+        )
+        if args.transport == "raw":
+            yield len(trimmed), b"".join([read.to_record() for read in trimmed])
         else:
-            read_source = SimpleRead.iter_BAM(bam_in.fetch(until_eof=True))
+            yield trimmed
 
-        for chunk in chunkify(read_source, n_chunk=args.n_chunk):
-            logging.debug(
-                f"placing {chunk[0]} {len(chunk[1])} in queue of depth {Qsam.qsize()}"
-            )
-            if put_or_abort(Qsam, chunk, abort_flag):
-                el.logger.warning("shutdown flag was raised!")
-                break
+    return _stats, _total, _lhist, matcher.cache_stats()
 
 
-def parallel_trim(Qsam, Qres, args, Qerr, abort_flag, stat_list):
-    with ExceptionLogging("worker", Qerr=Qerr, exc_flag=abort_flag) as el:
-        el.logger.debug(
-            f"parallel_trim() starting up with Qsam={Qsam}, Qres={Qres} and args={args}"
-        )
+def bam_out_level(mode):
+    "zlib compression level from a pysam output mode such as 'b0' or 'bu'"
+    level = mode[1:]
+    if level == "u":
+        # uncompressed BAM
+        return 0
 
-        _stats = defaultdict(int)
-        _total = defaultdict(int)
-        _lhist = defaultdict(int)
-
-        for n_chunk, reads in queue_iter(Qsam, abort_flag):
-            result = list(
-                process_reads(
-                    reads,
-                    args,
-                    stats=_stats,
-                    total=_total,
-                    lhist=_lhist,
-                )
-            )
-            Qres.put((n_chunk, result))
-
-        el.logger.debug("synchronizing cache and counts")
-        stats, total, lhist = stat_list[:3]
-        stats.append(_stats)
-        total.append(_total)
-        lhist.append(_lhist)
-
-
-def process_ordered_results(res_queue, args, Qerr, abort_flag, stat_list, timeout=10):
-    with ExceptionLogging("collector", Qerr=Qerr, exc_flag=abort_flag) as el:
-        import heapq
-        import time
-
-        heap = []
-        n_chunk_needed = 0
-        t0 = time.time()
-        t1 = t0
-        n_rec = 0
-
-        logger = el.logger
-        # out = Output(args)
-        bam_header = stat_list[-1]
-        while (not len(bam_header)) and timeout > 0:
-            if abort_flag:
-                logger.info("aborting during startup...")
-                return
-
-            logger.info("waiting for header to get ready")
-            time.sleep(1)
-            timeout -= 1
-
-        if timeout < 0:
-            raise ValueError("header was not made available. Did the dispatcher die?")
-
-        header = bam_header.pop()
+    return int(level) if level.isdigit() else 6
+
+
+def write_ordered_results(results, args, meta=None):
+    """
+    Sink for parallel_map(): writes the trimmed reads to the output BAM.
+    meta is the header dictionary.
+    """
+    import time
+
+    logger = logging.getLogger("collector")
+    t0 = time.time()
+    t1 = t0
+    n_rec = 0
+
+    header = pysam.AlignmentHeader.from_dict(meta)
+    if args.transport == "raw":
+        bam_out = BAMWriter(
+            args.bam_out,
+            str(header),
+            list(zip(header.references, header.lengths)),
+            level=bam_out_level(args.bam_out_mode),
+            threads=args.threads_write,
+        )
+    else:
         bam_out = pysam.AlignmentFile(
             args.bam_out,
             f"w{args.bam_out_mode}",
@@ -438,193 +592,65 @@ def process_ordered_results(res_queue, args, Qerr, abort_flag, stat_list, timeou
             threads=args.threads_write,
         )
 
-        for n_chunk, results in queue_iter(res_queue, abort_flag):
-            heapq.heappush(heap, (n_chunk, results))
-
-            # as long as the root of the heap is the next needed chunk
-            # pass results on to storage
-            while heap and (heap[0][0] == n_chunk_needed):
-                n_chunk, results = heapq.heappop(heap)  # retrieves heap[0]
-                for aln in SimpleRead.iter_to_BAM(results, header=bam_out.header):
-                    #     # print("record in process_ordered_results", record)
-                    bam_out.write(aln)
-                    n_rec += 1
-
-                n_chunk_needed += 1
-
-            # debug output on average throughput
-            t2 = time.time()
-            if t2 - t1 > 30:
-                dT = t2 - t0
-                rate = n_rec / dT
-                logger.info(
-                    "processed {0} reads in {1:.0f} seconds (average {2:.0f} reads/second).".format(
-                        n_rec, dT, rate
-                    )
-                )
-                t1 = t2
-
-        # out.close()
-        # by the time None pops from the queue, all chunks
-        # should have been processed!
-        if not abort_flag.value:
-            assert len(heap) == 0
+    for reads in results:
+        if args.transport == "raw":
+            n, blob = reads
+            bam_out.write(blob)
+            n_rec += n
         else:
-            logger.warning(
-                f"{len(heap)} chunks remained on the heap due to missing data upon abort."
+            for aln in SimpleRead.iter_to_BAM(reads, header=bam_out.header):
+                bam_out.write(aln)
+                n_rec += 1
+
+        # debug output on average throughput
+        t2 = time.time()
+        if t2 - t1 > 30:
+            dT = t2 - t0
+            rate = n_rec / dT
+            logger.info(
+                "processed {0} reads in {1:.0f} seconds (average {2:.0f} reads/second).".format(
+                    n_rec, dT, rate
+                )
             )
+            t1 = t2
 
-        dT = time.time() - t0
-        logger.info(
-            "finished processing {0} reads in {1:.0f} seconds (average {2:.0f} reads/second)".format(
-                n_rec, dT, n_rec / dT
-            )
+    bam_out.close()
+    dT = time.time() - t0
+    logger.info(
+        "finished processing {0} reads in {1:.0f} seconds (average {2:.0f} reads/second)".format(
+            n_rec, dT, n_rec / dT
         )
-
-
-## TODO: push these two into parallel/util modules
-
-
-def count_dict_sum(sources):
-    dst = defaultdict(float)
-    for src in sources:
-        for k, v in src.items():
-            dst[k] += v
-
-    return dst
+    )
+    return n_rec
 
 
 def main_parallel(args):
     logging.basicConfig(level=logging.DEBUG)
 
-    # queues for communication between processes
-    Qsam = mp.Queue(args.threads_work * 10)  # reads from parallel_read->parallel_trim
-    Qres = mp.Queue()  # extracted BCs from process_combinatorial->collector
-    Qerr = mp.Queue()  # child-processes can report errors back to the main process here
-
-    # Proxy objects to allow workers to report statistics about the run
-    manager = mp.Manager()
-    abort_flag = mp.Value("b")
-    abort_flag.value = False
-
-    stats = manager.list()
-    total = manager.list()
-    lhist = manager.list()
-    bam_header = manager.list()
-    stat_lists = [stats, total, lhist, bam_header]
-    print(stat_lists[-1])
-    with ExceptionLogging("main_combinatorial", exc_flag=abort_flag) as el:
-
-        # read BAM in chunks and put them in Qsam
-        dispatcher = mp.Process(
-            target=parallel_read,
-            name="dispatcher",
-            args=(Qsam, args, Qerr, abort_flag, stat_lists),
-        )
-
-        dispatcher.start()
-        el.logger.info("Started dispatch")
-
-        # workers consume chunks of BAM from Qsam
-        # process them, and put the results in Qres
-        workers = []
-        for i in range(args.threads_work):
-            w = mp.Process(
-                target=parallel_trim,
-                name=f"worker_{i}",
-                args=(Qsam, Qres, args, Qerr, abort_flag, stat_lists),
-            )
-            w.start()
-            workers.append(w)
-
-        el.logger.info("Started workers")
-
-        collector = mp.Process(
-            target=process_ordered_results,
-            name="output",
-            args=(Qres, args, Qerr, abort_flag, stat_lists),
-        )
-        collector.start()
-        el.logger.info("Started collector")
-        # wait until all sequences have been thrown onto Qfq
-        qfq, qerr = join_with_empty_queues(dispatcher, [Qsam, Qerr], abort_flag)
-        el.logger.info("The dispatcher exited")
-        if qfq or qerr:
-            el.logger.info(f"{len(qfq)} chunks were drained from Qfq upon abort.")
-            log_qerr(qerr)
-
-        # signal all workers to finish
-        el.logger.info("Signalling all workers to finish")
-        for n in range(args.threads_work):
-            Qsam.put(None)  # each worker consumes exactly one None
-
-        for w in workers:
-            # make sure all results are on Qres by waiting for
-            # workers to exit. Or, empty queues if aborting.
-            qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
-            if qres or qerr:
-                el.logger.info(f"{len(qres)} chunks were drained from Qres upon abort.")
-                log_qerr(qerr)
-
-        el.logger.info(
-            "All worker processes have joined. Signalling collector to finish."
+    with ExceptionLogging("main_parallel") as el:
+        if args.transport == "raw" and not args.bam_out_mode.startswith("b"):
+            el.logger.info("non-BAM output: falling back to --transport=records")
+            args.transport = "records"
+
+        _, worker_stats, n_rec = parallel_map(
+            partial(parallel_read, args),
+            partial(parallel_trim, args=args),
+            partial(write_ordered_results, args=args),
+            n_workers=args.threads_work,
+            queue_depth=10,
+            with_meta=True,
+            name="cutadapt_bam",
         )
-        # signal the collector to stop
-        Qres.put(None)
+        el.logger.info("All processes have joined. Merging worker statistics.")
 
-        # and wait until all output has been generated
-        collector.join()
-        el.logger.info("Collector has joined. Merging worker statistics.")
+        cache = count_dict_sum([c for st, tot, lh, c in worker_stats])
+        log_cache_stats(cache, el.logger)
 
     if args.stats_out:
-        stats = count_dict_sum(stats)
-        total = count_dict_sum(total)
-        lhist = count_dict_sum(lhist)
-
-        with open(args.stats_out, "wt") as f:
-            f.write("key\tcount\tpercent\n")
-            for k, v in sorted(stats.items(), key=lambda x: -x[1]):
-                f.write(f"reads\t{k}\t{v}\t{100.0 * v/stats['N_input']:.2f}\n")
-
-            for k, v in sorted(total.items(), key=lambda x: -x[1]):
-                f.write(f"bases\t{k}\t{v}\t{100.0 * v/total['bp_input']:.2f}\n")
-
-            for k, v in sorted(lhist.items()):
-                f.write(f"L_final\t{k}\t{v}\t{100.0 * v/stats['N_kept']:.2f}\n")
-
-        # N = count_dict_sum(Ns)
-        # if N["total"]:
-        #     el.logger.info(
-        #         f"Run completed. Overall combinatorial barcode assignment "
-        #         f"rate was {100.0 * N['called']/N['total']}"
-        #     )
-        # else:
-        #     el.logger.error("No reads were processed!")
-
-        # if args.update_cache:
-        #     qcount1 = count_dict_sum(qcounts1)
-        #     qcount2 = count_dict_sum(qcounts2)
-        #     cache1 = dict_merge(qcaches1)
-        #     cache2 = dict_merge(qcaches2)
-        #     store_cache(args.bc1_cache, cache1, qcount1)
-        #     store_cache(args.bc2_cache, cache2, qcount2)
-
-        # if args.save_stats:
-        #     bccount1 = count_dict_sum(bccounts1)
-        #     bccount2 = count_dict_sum(bccounts2)
-        #     with open(args.save_stats, "w") as f:
-        #         for k, v in sorted(N.items()):
-        #             f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
-
-        #         for k, v in sorted(bccount1.items()):
-        #             f.write(
-        #                 f"BC1\t{k}\t{v}\t{100.0 * v/max(bccount1['total'], 1):.2f}\n"
-        #             )
-
-        #         for k, v in sorted(bccount2.items()):
-        #             f.write(
-        #                 f"BC2\t{k}\t{v}\t{100.0 * v/max(bccount2['total'], 1):.2f}\n"
-        #             )
+        stats = count_dict_sum([st for st, tot, lh, c in worker_stats])
+        total = count_dict_sum([tot for st, tot, lh, c in worker_stats])
+        lhist = count_dict_sum([lh for st, tot, lh, c in worker_stats])
+        write_stats(args.stats_out, stats, total, lhist, cache)
 
 
 if __name__ == "__main__":
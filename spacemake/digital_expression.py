@@ -0,0 +1,542 @@
+"""
+Native replacement for Drop-seq tools' DigitalExpression. Counts the
+molecules of each gene in each cell barcode of a BAM tagged with gn, gs and
+gf (see spacemake.annotator --dropseqtools or TagReadWithGeneFunction) into
+a spacemake.quant.PackedDGE and writes the sparse raw DGE (h5ad) together
+with the DigitalExpression summary, without the dense text matrix. For
+samples with many tiles (pucks), the BAM is read only once and split into
+the DGEs of all tiles.
+"""
+
+__version__ = "0.9"
+__author__ = ["Marvin Jens"]
+__license__ = "GPL"
+__email__ = ["marvin.jens@mdc-berlin.de"]
+
+import os
+import sys
+import logging
+import argparse
+import numpy as np
+import pysam
+from collections import defaultdict
+
+from spacemake.quant import PackedDGE
+
+EXONIC = frozenset(["CODING", "UTR"])
+
+
+def load_whitelist(fname):
+    "cell barcodes, one per line (e.g. CELL_BC_FILE of DigitalExpression)"
+    with open(fname) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class BarcodeIndex:
+    """
+    Cell barcode whitelists (tiles) as 2-bit packed uint64 keys (see
+    spacemake.preprocess.counts.pack_2bit), one sorted array of keys per
+    barcode length with a parallel array of the position of the whitelist
+    each key comes from. A barcode that is on several tiles has one key per
+    tile. Lookups are binary searches, so that the whitelists of a
+    multi-puck sample take ~12 bytes per barcode instead of a set or dict
+    of strings. Barcodes that can not be packed (N bases, longer than 32 nt)
+    are kept in a plain dictionary.
+    """
+
+    # str.translate() table to read a barcode as a base 4 number, which is
+    # the key pack_2bit() gives it
+    _digits = str.maketrans("ACGT", "0123")
+
+    def __init__(self, whitelists):
+        "whitelists: lists of barcodes, their positions are the tile ids"
+        keys = defaultdict(list)
+        tiles = defaultdict(list)
+        self.other = defaultdict(list)
+        for i, barcodes in enumerate(whitelists):
+            for l, bc_keys, ok, group in self.pack(barcodes):
+                for j in np.flatnonzero(~ok).tolist():
+                    self.other[group[j]].append(i)
+
+                keys[l].append(bc_keys[ok])
+                tiles[l].append(np.full(ok.sum(), i, dtype=np.int32))
+
+        self.keys = {}
+        self.tiles = {}
+        for l in keys:
+            k = np.concatenate(keys[l])
+            t = np.concatenate(tiles[l])
+            order = np.lexsort((t, k))
+            k = k[order]
+            t = t[order]
+            # the same barcode listed twice in one whitelist
+            keep = np.r_[True, (k[1:] != k[:-1]) | (t[1:] != t[:-1])]
+            self.keys[l] = k[keep]
+            self.tiles[l] = t[keep]
+
+        self.other = {bc: sorted(set(t)) for bc, t in self.other.items()}
+
+    @staticmethod
+    def pack(barcodes):
+        """
+        Yields (length, keys, ok, group) for the barcodes of each length
+        (see pack_2bit()). Barcodes longer than 32 nt have no keys.
+        """
+        from spacemake.preprocess.counts import pack_2bit, MAX_PACKED_LEN
+
+        lengths = np.array([len(bc) for bc in barcodes], dtype=np.int64)
+        for l in np.unique(lengths).tolist():
+            if (lengths == l).all():
+                group = barcodes
+            else:
+                group = [bc for bc in barcodes if len(bc) == l]
+
+            if l > MAX_PACKED_LEN or not l:
+                bc_keys = np.zeros(len(group), dtype=np.uint64)
+                ok = np.zeros(len(group), dtype=bool)
+            else:
+                buf = "".join(group).encode("ascii", errors="replace")
+                M = np.frombuffer(buf, dtype=np.uint8).reshape(len(group), l)
+                bc_keys, ok = pack_2bit(M)
+
+            yield l, bc_keys, ok, group
+
+    def __len__(self):
+        "number of distinct barcodes"
+        n = len(self.other)
+        for keys in self.keys.values():
+            n += int(np.count_nonzero(keys[1:] != keys[:-1])) + (len(keys) > 0)
+
+        return n
+
+    def __contains__(self, bc):
+        keys = self.keys.get(len(bc))
+        if keys is None or bc in self.other:
+            return bc in self.other
+
+        try:
+            key = np.uint64(int(bc.translate(self._digits), 4))
+        except ValueError:
+            return False
+
+        i = keys.searchsorted(key)
+        return bool(i < len(keys) and keys[i] == key)
+
+    def lookup(self, barcodes):
+        """
+        (positions into barcodes, tile ids), one pair for each tile that each
+        of the barcodes is on, ordered by position
+        """
+        pos = [np.zeros(0, dtype=np.int64)]
+        tiles = [np.zeros(0, dtype=np.int32)]
+        barcodes = list(barcodes)
+        lengths = np.array([len(bc) for bc in barcodes], dtype=np.int64)
+        for l, bc_keys, ok, group in self.pack(barcodes):
+            idx = np.flatnonzero(lengths == l)
+            for j in np.flatnonzero(~ok).tolist():
+                t = self.other.get(group[j], [])
+                pos.append(np.full(len(t), idx[j], dtype=np.int64))
+                tiles.append(np.array(t, dtype=np.int32))
+
+            keys = self.keys.get(l)
+            if keys is None:
+                continue
+
+            idx = idx[ok]
+            bc_keys = bc_keys[ok]
+            lo = np.searchsorted(keys, bc_keys, side="left")
+            n = np.searchsorted(keys, bc_keys, side="right") - lo
+            first = np.repeat(lo - np.cumsum(n) + n, n)
+            pos.append(np.repeat(idx, n))
+            tiles.append(self.tiles[l][first + np.arange(n.sum())])
+
+        pos = np.concatenate(pos)
+        tiles = np.concatenate(tiles)
+        order = np.lexsort((tiles, pos))
+        return pos[order], tiles[order]
+
+
+def load_tile_index(tile_bc_files):
+    "BarcodeIndex of the whitelists (tiles) of a multi-puck sample"
+    return BarcodeIndex(load_whitelist(fname) for fname in tile_bc_files)
+
+
+class DigitalExpression:
+    """
+    Mirrors DigitalExpression with its default settings:
+
+      * only primary alignments with mapping quality >= read_mq are counted
+      * only cell barcodes from the whitelist (if one is given)
+      * a read is assigned to a gene if exactly one gene on the same strand
+        as the read has one of the locus_functions. Exonic (CODING, UTR)
+        hits take precedence over intronic ones.
+      * UMIs of the same gene and cell which are within edit_distance
+        substitutions count as one molecule (see quant.collapse_umis())
+    """
+
+    def __init__(
+        self,
+        whitelist=None,
+        cell_tag="CB",
+        umi_tag="MI",
+        locus_functions=["CODING", "UTR"],
+        read_mq=10,
+        edit_distance=1,
+        max_mem=0,
+        tmp_dir=None,
+    ):
+        self.logger = logging.getLogger("spacemake.digital_expression")
+        if whitelist is not None and not isinstance(whitelist, BarcodeIndex):
+            whitelist = BarcodeIndex([whitelist])
+
+        self.whitelist = whitelist
+        self.cell_tag = cell_tag
+        self.umi_tag = umi_tag
+        self.locus_functions = frozenset(locus_functions)
+        self.read_mq = read_mq
+        self.edit_distance = edit_distance
+        self.dge = PackedDGE(max_mem=max_mem, tmp_dir=tmp_dir)
+        self.gene_cache = {}
+        self.stats = dict(n_aln=0, n_skipped=0, n_no_cell=0, n_no_gene=0, n_counted=0)
+
+    def assign_gene(self, gn, gs, gf, strand):
+        "the gene a read on strand is counted for, or None"
+        key = (gn, gs, gf, strand)
+        gene = self.gene_cache.get(key, False)
+        if gene is not False:
+            return gene
+
+        genes = set()
+        exonic = set()
+        for name, s, func in zip(gn.split(","), gs.split(","), gf.split(",")):
+            if s != strand or func not in self.locus_functions:
+                continue
+
+            genes.add(name)
+            if func in EXONIC:
+                exonic.add(name)
+
+        if exonic:
+            genes = exonic
+
+        gene = genes.pop() if len(genes) == 1 else None
+        self.gene_cache[key] = gene
+        return gene
+
+    def count(self, bam_in):
+        stats = self.stats
+        bam = pysam.AlignmentFile(bam_in, check_sq=False)
+        for aln in bam.fetch(until_eof=True):
+            stats["n_aln"] += 1
+            # unmapped, secondary or supplementary
+            if aln.flag & 0x904 or aln.mapping_quality < self.read_mq:
+                stats["n_skipped"] += 1
+                continue
+
+            if not aln.has_tag(self.cell_tag):
+                stats["n_no_cell"] += 1
+                continue
+
+            cell = aln.get_tag(self.cell_tag)
+            if self.whitelist is not None and cell not in self.whitelist:
+                stats["n_no_cell"] += 1
+                continue
+
+            gene = None
+            if aln.has_tag("gn") and aln.has_tag("gs") and aln.has_tag("gf"):
+                gene = self.assign_gene(
+                    aln.get_tag("gn"),
+                    aln.get_tag("gs"),
+                    aln.get_tag("gf"),
+                    "-" if aln.is_reverse else "+",
+                )
+
+            if gene is None:
+                stats["n_no_gene"] += 1
+                continue
+
+            self.dge.add_read(gene=gene, cell=cell, umi=aln.get_tag(self.umi_tag))
+            stats["n_counted"] += 1
+
+        self.logger.info(
+            f"counted {stats['n_counted']} of {stats['n_aln']} alignments. "
+            f"skipped: {stats['n_skipped']} (flag or mapping quality), "
+            f"{stats['n_no_cell']} (cell barcode), {stats['n_no_gene']} (no unique gene)"
+        )
+        return self
+
+    def counted(self):
+        return self.dge.counted(self.edit_distance)
+
+
+def counted_to_matrix(counted, reads_instead=False):
+    """
+    (cells x genes) csr_matrix of molecule (or read) counts from
+    PackedDGE.counted(), the gene names and a summary with the cell barcodes
+    and their n_reads, n_umi and n_genes. Cells are ordered by decreasing
+    number of reads, genes by name.
+    """
+    import scipy.sparse
+
+    cell, gene, channel = PackedDGE.decode_keys(counted["keys"])
+    umi_counts = counted["umi_counts"]
+    read_counts = counted["read_counts"]
+    n_cells = len(counted["cells"])
+
+    n_reads = np.bincount(cell, weights=read_counts, minlength=n_cells).astype(int)
+    n_umi = np.bincount(cell, weights=umi_counts, minlength=n_cells).astype(int)
+    n_genes = np.bincount(cell, minlength=n_cells)
+
+    cells = np.array(counted["cells"], dtype=object)
+    order = np.lexsort((cells, -n_reads))
+    order = order[n_reads[order] > 0]
+    cell_rank = np.full(n_cells, -1, dtype=np.int64)
+    cell_rank[order] = np.arange(len(order))
+
+    genes, gene_rank = PackedDGE.ranks(counted["genes"])
+    X = scipy.sparse.csr_matrix(
+        (
+            read_counts if reads_instead else umi_counts,
+            (cell_rank[cell], gene_rank[gene]),
+        ),
+        shape=(len(order), len(genes)),
+    )
+    summary = dict(
+        cell_bc=list(cells[order]),
+        n_reads=n_reads[order],
+        n_umi=n_umi[order],
+        n_genes=n_genes[order],
+    )
+    return X, genes, summary
+
+
+def select_counted(counted, idx):
+    """
+    The part of counted() at the key positions idx, with only the cells and
+    genes that remain
+    """
+    cell, gene, channel = PackedDGE.decode_keys(counted["keys"][idx])
+    cell_ids, cell = np.unique(cell, return_inverse=True)
+    gene_ids, gene = np.unique(gene, return_inverse=True)
+    selected = dict(counted)
+    selected.update(
+        cells=[counted["cells"][i] for i in cell_ids.tolist()],
+        genes=[counted["genes"][i] for i in gene_ids.tolist()],
+        keys=PackedDGE.encode_keys(cell, gene, channel),
+        umi_counts=counted["umi_counts"][idx],
+        read_counts=counted["read_counts"][idx],
+    )
+    return selected
+
+
+def split_counted(counted, tile_index, n_tiles):
+    """
+    Yields (tile, counted) for the tile positions 0..n_tiles-1 of the
+    BarcodeIndex tile_index, with the cells of that tile. A cell barcode that
+    is on several tiles is counted for each of them.
+    """
+    pos, flat = tile_index.lookup(counted["cells"])
+    n = np.bincount(pos, minlength=len(counted["cells"]))
+    ptr = np.r_[0, np.cumsum(n)]
+
+    # one entry per (key, tile of its cell)
+    cell, _, _ = PackedDGE.decode_keys(counted["keys"])
+    rep = n[cell]
+    idx = np.repeat(np.arange(len(cell)), rep)
+    within = np.arange(len(idx)) - np.repeat(np.cumsum(rep) - rep, rep)
+    tile = flat[ptr[cell[idx]] + within]
+
+    order = np.argsort(tile, kind="stable")
+    bounds = np.searchsorted(tile[order], np.arange(n_tiles + 1))
+    for i in range(n_tiles):
+        yield i, select_counted(counted, idx[order[bounds[i] : bounds[i + 1]]])
+
+
+def write_summary(summary, fname, cmd=""):
+    "the per cell summary in the format of DigitalExpression SUMMARY="
+    from time import asctime
+
+    with open(fname, "wt") as f:
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write(f"# {cmd}\n")
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write(f"# Started on: {asctime()}\n")
+        f.write("\n")
+        f.write(
+            "## METRICS CLASS\t"
+            "org.broadinstitute.dropseqrna.barnyard.DigitalExpression$DESummary\n"
+        )
+        f.write("CELL_BARCODE\tNUM_GENIC_READS\tNUM_TRANSCRIPTS\tNUM_GENES\n")
+        for row in zip(
+            summary["cell_bc"],
+            summary["n_reads"].tolist(),
+            summary["n_umi"].tolist(),
+            summary["n_genes"].tolist(),
+        ):
+            f.write("\t".join([str(x) for x in row]) + "\n")
+
+
+def write_dge(counted, dge_out, summary_out, reads_instead=False, cmd=""):
+    "sparse raw DGE (h5ad) and DigitalExpression summary from counted()"
+    from spacemake.preprocess.dge import make_dge_adata
+
+    X, genes, summary = counted_to_matrix(counted, reads_instead=reads_instead)
+    write_summary(summary, summary_out, cmd=cmd)
+    adata = make_dge_adata(X, summary["cell_bc"], genes, n_reads=summary["n_reads"])
+    adata.write(dge_out)
+    return adata
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        "digital_expression",
+        description="sparse digital gene expression (DGE) matrix from a gn/gs/gf "
+        "tagged BAM, in place of Drop-seq tools' DigitalExpression",
+    )
+    parser.add_argument(
+        "--bam-in",
+        default="/dev/stdin",
+        help="path of the tagged BAM (default=/dev/stdin)",
+    )
+    parser.add_argument(
+        "--output",
+        default="",
+        help="path of the sparse DGE (h5ad)",
+    )
+    parser.add_argument(
+        "--summary",
+        default="",
+        help="path of the per cell summary (format of DigitalExpression SUMMARY=)",
+    )
+    parser.add_argument(
+        "--cell-bc-file",
+        default="",
+        help="only count these cell barcodes, one per line (default='' -> all)",
+    )
+    parser.add_argument(
+        "--tile-bc-files",
+        default=[],
+        nargs="+",
+        help="cell barcode whitelists of all tiles (pucks) of a sample. The BAM is "
+        "read once and one DGE and summary per tile is written to --output-dir, "
+        "instead of --output and --summary",
+    )
+    parser.add_argument(
+        "--tile-ids",
+        default=[],
+        nargs="+",
+        help="names of the tiles in the order of --tile-bc-files "
+        "(default=file names without extension)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default="",
+        help="directory for <tile>.raw.h5ad and <tile>.summary.txt with --tile-bc-files",
+    )
+    parser.add_argument(
+        "--cell-tag",
+        default="CB",
+        help="BAM tag of the cell barcode (default=CB)",
+    )
+    parser.add_argument(
+        "--umi-tag",
+        default="MI",
+        help="BAM tag of the UMI (default=MI)",
+    )
+    parser.add_argument(
+        "--locus-function",
+        default="CODING,UTR",
+        help="comma-separated gene functions (gf) a read may have to be counted "
+        "(default=CODING,UTR)",
+    )
+    parser.add_argument(
+        "--read-mq",
+        default=10,
+        type=int,
+        help="minimum mapping quality (default=10)",
+    )
+    parser.add_argument(
+        "--edit-distance",
+        default=1,
+        type=int,
+        help="collapse UMIs of the same gene and cell within this many substitutions "
+        "(default=1)",
+    )
+    parser.add_argument(
+        "--reads-instead",
+        default=False,
+        action="store_true",
+        help="count reads instead of molecules (UMIs)",
+    )
+    parser.add_argument(
+        "--max-mem",
+        default=0,
+        type=int,
+        help="approximate memory budget (MB) for counting. Beyond that, sorted runs "
+        "are spilled to disk (default=0 -> off)",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="directory for the runs spilled with --max-mem (default=system temp dir)",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    logger = logging.getLogger("spacemake.digital_expression")
+    whitelist = None
+    if args.tile_bc_files:
+        tile_ids = args.tile_ids or [
+            os.path.splitext(os.path.basename(fname))[0] for fname in args.tile_bc_files
+        ]
+        if len(tile_ids) != len(args.tile_bc_files):
+            raise ValueError("need as many --tile-ids as --tile-bc-files")
+
+        tile_index = load_tile_index(args.tile_bc_files)
+        whitelist = tile_index
+        logger.info(
+            f"loaded {len(tile_index)} cell barcodes of {len(tile_ids)} tiles"
+        )
+    elif args.cell_bc_file:
+        whitelist = load_whitelist(args.cell_bc_file)
+
+    de = DigitalExpression(
+        whitelist=whitelist,
+        cell_tag=args.cell_tag,
+        umi_tag=args.umi_tag,
+        locus_functions=args.locus_function.split(","),
+        read_mq=args.read_mq,
+        edit_distance=args.edit_distance,
+        max_mem=args.max_mem * 2**20,
+        tmp_dir=args.tmp_dir,
+    )
+    de.count(args.bam_in)
+    counted = de.counted()
+    cmd = " ".join(sys.argv)
+    if not args.tile_bc_files:
+        write_dge(
+            counted,
+            args.output,
+            args.summary,
+            reads_instead=args.reads_instead,
+            cmd=cmd,
+        )
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for i, tile_counted in split_counted(counted, tile_index, len(tile_ids)):
+        tile = tile_ids[i]
+        logger.info(f"writing DGE of tile '{tile}' ({len(tile_counted['cells'])} cells)")
+        write_dge(
+            tile_counted,
+            os.path.join(args.output_dir, f"{tile}.raw.h5ad"),
+            os.path.join(args.output_dir, f"{tile}.summary.txt"),
+            reads_instead=args.reads_instead,
+            cmd=cmd,
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(parse_args())
@@ -5,6 +5,7 @@ __email__ = ["marvin.jens@mdc-berlin.de"]
 
 import logging
 import time
+from collections import defaultdict, deque
 
 
 def put_or_abort(Q, item, abort_flag, timeout=1):
@@ -70,6 +71,8 @@ def join_with_empty_queues(proc, Qs, abort_flag, timeout=1):
     to terminate properly.
     """
 
+    import queue
+
     def drain(Q):
         content = []
         while not Q.empty():
@@ -110,6 +113,22 @@ def chunkify(src, n_chunk=1000):
         yield n, chunk
 
 
+def count_dict_sum(sources):
+    dst = defaultdict(float)
+    for src in sources:
+        for k, v in src.items():
+            dst[k] += v
+
+    return dst
+
+
+def dict_merge(sources):
+    dst = {}
+    for src in sources:
+        dst.update(src)
+    return dst
+
+
 def log_qerr(qerr):
     "helper function for reporting errors in sub processes"
     for name, lines in qerr:
@@ -158,3 +177,310 @@ class ExceptionLogging:
             if self.exc_flag:
                 self.logger.error(f"raising exception flag {self.exc_flag}")
                 self.exc_flag.value = True
+
+
+## Generic parallel pipeline
+def _next_or_return(gen):
+    """
+    next() for generators that also want to report a value via their
+    return statement. Returns (True, item) or (False, return value).
+    """
+    try:
+        return True, next(gen)
+    except StopIteration as e:
+        return False, e.value
+
+
+def _dispatch(
+    source,
+    n_workers,
+    with_meta,
+    Qwork,
+    Qres,
+    Qerr,
+    Qret,
+    abort_flag,
+    Qmeta=(),
+    routed=False,
+):
+    with ExceptionLogging("dispatcher", Qerr=Qerr, exc_flag=abort_flag) as el:
+        src = iter(source())
+        if with_meta:
+            # the first item goes straight to the collector
+            more, meta = _next_or_return(src)
+            put_or_abort(Qres, (-1, meta), abort_flag)
+            # and, if requested, to each of the workers
+            for Q in Qmeta:
+                put_or_abort(Q, meta, abort_flag)
+
+        n = 0
+        while True:
+            more, item = _next_or_return(src)
+            if not more:
+                break
+
+            if routed:
+                i, item = item
+            else:
+                i = 0
+
+            if put_or_abort(Qwork[i], (n, item), abort_flag):
+                el.logger.warning("shutdown flag was raised!")
+                break
+
+            n += 1
+
+        el.logger.debug(f"dispatched {n} chunks")
+        Qret.put(("source", 0, item if not more else None))
+        # each worker consumes exactly one None
+        for i in range(n_workers):
+            put_or_abort(Qwork[i], None, abort_flag)
+
+
+def _work(worker, i, Qwork, Qres, Qerr, Qret, abort_flag, Qmeta=None):
+    with ExceptionLogging(f"worker_{i}", Qerr=Qerr, exc_flag=abort_flag) as el:
+        numbers = deque()
+
+        def items():
+            for n, item in queue_iter(Qwork, abort_flag):
+                numbers.append(n)
+                yield item
+
+        kw = {}
+        if Qmeta is not None:
+            for meta in queue_iter(Qmeta, abort_flag):
+                kw["meta"] = meta
+                break
+
+            if abort_flag.value:
+                return
+
+        results = worker(items(), **kw)
+        while True:
+            more, res = _next_or_return(results)
+            if not more:
+                break
+
+            # workers have to yield exactly one result per item
+            if put_or_abort(Qres, (numbers.popleft(), res), abort_flag):
+                el.logger.warning("shutdown flag was raised!")
+                break
+
+        Qret.put(("worker", i, res if not more else None))
+        put_or_abort(Qres, None, abort_flag)
+
+
+def _collect(sink, n_workers, ordered, with_meta, Qres, Qerr, Qret, abort_flag):
+    with ExceptionLogging("collector", Qerr=Qerr, exc_flag=abort_flag) as el:
+        import heapq
+
+        heap = []
+
+        def items():
+            n_running = n_workers
+            while n_running and not abort_flag.value:
+                yield from queue_iter(Qres, abort_flag)
+                # a worker has finished
+                n_running -= 1
+
+        incoming = items()
+        kw = {}
+        if with_meta:
+            # results may overtake the meta data sent by the dispatcher
+            for n, res in incoming:
+                if n < 0:
+                    kw["meta"] = res
+                    break
+                heapq.heappush(heap, (n, res))
+
+        def results():
+            n_needed = 0
+            if not ordered:
+                while heap:
+                    yield heapq.heappop(heap)[1]
+
+            for n, res in incoming:
+                if not ordered:
+                    yield res
+                    continue
+
+                heapq.heappush(heap, (n, res))
+                # as long as the root of the heap is the next needed
+                # chunk pass results on to the sink
+                while heap and heap[0][0] == n_needed:
+                    yield heapq.heappop(heap)[1]
+                    n_needed += 1
+
+            while heap and heap[0][0] == n_needed:
+                yield heapq.heappop(heap)[1]
+                n_needed += 1
+
+        ret = sink(results(), **kw)
+        # by the time all workers have finished, all chunks
+        # should have been processed!
+        if abort_flag.value:
+            el.logger.warning(
+                f"{len(heap)} chunks remained on the heap due to missing data upon abort."
+            )
+        else:
+            assert len(heap) == 0
+
+        Qret.put(("sink", 0, ret))
+
+
+def parallel_map(
+    source,
+    worker,
+    sink,
+    n_workers=1,
+    ordered=True,
+    queue_depth=5,
+    with_meta=False,
+    meta_to_workers=False,
+    routed=False,
+    name="parallel_map",
+):
+    """
+    Runs a map over chunks of data with n_workers processes:
+
+        source() -> chunks -> worker(chunks) -> results -> sink(results)
+
+    * source is called in a dispatcher process and returns an iterable of
+      chunks (lists of reads, blocks of bytes, ...).
+    * worker is a generator function, called once in each worker process
+      with an iterator over the chunks assigned to it. It has to yield
+      exactly one result per chunk. Expensive setup goes before the loop.
+    * sink is called in a collector process with an iterator over all
+      results. If ordered=True, results come in the order of the chunks
+      from the source, otherwise as soon as they are ready.
+
+    With with_meta=True, the first item from the source is not a chunk
+    but meta data (such as a file header that only the source can read,
+    e.g. from stdin). It is passed on to the sink as sink(results, meta=...).
+    With meta_to_workers=True, each worker receives it as well, as
+    worker(chunks, meta=...).
+
+    With routed=True, the source yields (worker index, chunk) pairs and
+    each chunk goes to this one worker only, for instance to keep all data
+    of the same key (cell barcode, ...) in the same process.
+
+    The return values of all of these (e.g. a generator's return statement
+    with counts/statistics) are sent back to the calling process. Use
+    functools.partial() to pass arguments such as the parsed command line.
+    Queues hold at most n_workers * queue_depth chunks, so memory use stays
+    bounded. If any of the processes fails, all others are shut down and a
+    RuntimeError is raised.
+
+    Returns: (source return value, [worker return values], sink return value)
+    """
+    import multiprocessing as mp
+
+    logger = logging.getLogger(name)
+    if routed:
+        Qworks = [mp.Queue(queue_depth) for i in range(n_workers)]
+    else:
+        Qworks = [mp.Queue(n_workers * queue_depth)]
+    Qres = mp.Queue(n_workers * queue_depth)
+    Qerr = mp.Queue()  # child-processes can report errors back to us here
+    Qret = mp.Queue()  # and their return values
+    abort_flag = mp.Value("b")
+    abort_flag.value = False
+    # one small queue per worker to hand out the meta data
+    Qmeta = [mp.Queue(1) for i in range(n_workers)] if meta_to_workers else []
+
+    procs = [
+        mp.Process(
+            target=_dispatch,
+            name="dispatcher",
+            args=(
+                source,
+                n_workers,
+                with_meta,
+                Qworks if routed else Qworks * n_workers,
+                Qres,
+                Qerr,
+                Qret,
+                abort_flag,
+                Qmeta,
+                routed,
+            ),
+        )
+    ]
+    for i in range(n_workers):
+        procs.append(
+            mp.Process(
+                target=_work,
+                name=f"worker_{i}",
+                args=(
+                    worker,
+                    i,
+                    Qworks[i] if routed else Qworks[0],
+                    Qres,
+                    Qerr,
+                    Qret,
+                    abort_flag,
+                    Qmeta[i] if meta_to_workers else None,
+                ),
+            )
+        )
+    procs.append(
+        mp.Process(
+            target=_collect,
+            name="collector",
+            args=(sink, n_workers, ordered, with_meta, Qres, Qerr, Qret, abort_flag),
+        )
+    )
+    for p in procs:
+        p.start()
+
+    logger.info(f"started dispatcher, {n_workers} workers and collector")
+
+    # return values can be large. Receive them while waiting for the
+    # processes to exit, otherwise they may never be able to.
+    returned = {"source": [None], "worker": [None] * n_workers, "sink": [None]}
+    qerr = []
+    n_drained = 0
+    for p in procs:
+        while p.exitcode is None:
+            p.join(0.1)
+            for role, i, value in drain_queue(Qret):
+                returned[role][i] = value
+
+            qerr.extend(drain_queue(Qerr))
+            for q in procs:
+                if q.exitcode and not abort_flag.value:
+                    # killed (OOM, signal) without a chance to raise the flag
+                    # itself. The others would wait for its results forever.
+                    logger.error(f"{q.name} exited with code {q.exitcode}")
+                    abort_flag.value = True
+
+            if abort_flag.value:
+                n_drained += len(drain_queue(Qres))
+                for Qwork in Qworks:
+                    n_drained += len(drain_queue(Qwork))
+
+    for role, i, value in drain_queue(Qret):
+        returned[role][i] = value
+
+    qerr.extend(drain_queue(Qerr))
+    if any([p.exitcode for p in procs]):
+        abort_flag.value = True
+
+    if abort_flag.value:
+        log_qerr(qerr)
+        logger.info(f"{n_drained} chunks were drained from the queues upon abort.")
+        raise RuntimeError(f"{name} was aborted due to an error in a sub-process")
+
+    return returned["source"][0], returned["worker"], returned["sink"][0]
+
+
+def drain_queue(Q):
+    "get everything that is currently on a queue without blocking"
+    import queue
+
+    content = []
+    while True:
+        try:
+            content.append(Q.get_nowait())
+        except queue.Empty:
+            return content
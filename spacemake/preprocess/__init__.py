@@ -1,6 +1,6 @@
 from .cmdline import cmdline
 from .dge import calculate_adata_metrics,\
     calculate_shannon_entropy_scompression, dge_to_sparse_adata,\
-    attach_barcode_file, parse_barcode_file, load_external_dge,\
+    make_dge_adata, attach_barcode_file, parse_barcode_file, load_external_dge,\
     attach_puck_variables, attach_puck
 
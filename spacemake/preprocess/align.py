@@ -0,0 +1,143 @@
+__version__ = "0.9"
+__author__ = ["Marvin Jens"]
+__license__ = "GPL"
+__email__ = ["marvin.jens@mdc-berlin.de"]
+
+import numpy as np
+from collections import namedtuple
+
+PrimerAlignment = namedtuple(
+    "PrimerAlignment", ["score", "start", "end", "tstart", "tend", "seqB"]
+)
+PrimerAlignment.__doc__ = """
+Local alignment of a primer to a read. start and end are read coordinates
+(end exclusive), tstart and tend are the number of primer bases left
+unaligned before the start and after the end of the alignment. seqB is the
+read itself.
+"""
+
+# Every DP cell holds score << _ORIGIN_BITS | origin, where origin is the
+# (primer pos., read pos.) where the local alignment starts. This way the
+# origins are carried along by all max() operations and no traceback is
+# needed. Ties between equal scores go to the later origin.
+_ORIGIN_BITS = 24
+_READ_BITS = 16
+_ORIGIN_MASK = (1 << _ORIGIN_BITS) - 1
+_READ_MASK = (1 << _READ_BITS) - 1
+
+
+class PrimerAligner:
+    """
+    Local (Smith-Waterman/Gotoh) alignment of one short, fixed primer
+    against many reads at once. The DP runs over the primer rows while all
+    reads and read positions are processed as NumPy arrays. Horizontal gaps
+    (read bases not in the primer) are resolved with a running maximum,
+    which is exact for affine gap costs as long as opening a gap costs at
+    least as much as extending it.
+
+    Scores default to those used with pairwise2.align.localmd() before.
+    """
+
+    def __init__(self, primer, match=2, mismatch=-1.5, gap_open=-3, gap_extend=-1):
+        assert gap_open <= gap_extend <= 0
+        assert len(primer) < (1 << (_ORIGIN_BITS - _READ_BITS))
+        self.primer = primer
+        # work with integers. All default scores are multiples of 0.5
+        self.scale = 2
+        self.match = int(match * self.scale)
+        self.mismatch = int(mismatch * self.scale)
+        self.gap_open = int(gap_open * self.scale)
+        self.gap_extend = int(gap_extend * self.scale)
+        self.primer_codes = np.frombuffer(primer.encode("ascii"), dtype=np.uint8)
+
+    def encode_reads(self, reads):
+        """
+        (n, L) uint8 matrix of the reads, padded with 0 to the longest read,
+        and the read lengths.
+        """
+        lengths = np.array([len(r) for r in reads], dtype=np.int64)
+        L = max(lengths.max(), 1)
+        padded = "".join([r.ljust(L, "\0") for r in reads]).encode("ascii")
+        return np.frombuffer(padded, dtype=np.uint8).reshape(len(reads), L), lengths
+
+    def align_batch(self, reads):
+        """
+        Returns arrays of score, start, end, tstart and tend (see
+        PrimerAlignment) for the best local alignment of each read.
+        """
+        n = len(reads)
+        if not n:
+            z = np.zeros(0, dtype=np.int64)
+            return np.zeros(0), z, z, z, z
+
+        M, lengths = self.encode_reads(reads)
+        L = M.shape[1]
+        assert L < (1 << _READ_BITS)
+        valid = np.arange(L)[np.newaxis, :] < lengths[:, np.newaxis]
+        # substitution scores can never make a path through padding positive
+        blocked = -(self.match * len(self.primer) + 1)
+        go = self.gap_open << _ORIGIN_BITS
+        ge = self.gap_extend << _ORIGIN_BITS
+        cols = np.arange(L + 1, dtype=np.int64)
+
+        # substitution scores for each distinct primer base
+        subst = {}
+        for p in set(self.primer_codes):
+            S = np.where(M == p, self.match, self.mismatch)
+            S[~valid] = blocked
+            subst[p] = S.astype(np.int64) << _ORIGIN_BITS
+
+        # H: best local alignment ending in a cell, F: same, but ending
+        # with a gap in the read. Column 0 is the boundary before the read.
+        # A new alignment can start after any cell with score 0.
+        H = cols[np.newaxis, :].repeat(n, axis=0)  # score 0, origin (0, j)
+        F = np.full((n, L + 1), blocked << _ORIGIN_BITS, dtype=np.int64)
+
+        best = np.zeros(n, dtype=np.int64)
+        best_i = np.zeros(n, dtype=np.int64)
+        best_j = np.zeros(n, dtype=np.int64)
+        rows = np.arange(n)
+
+        for i, p in enumerate(self.primer_codes, start=1):
+            # diagonal (match or mismatch)
+            D = np.empty_like(H)
+            D[:, 0] = blocked << _ORIGIN_BITS
+            D[:, 1:] = H[:, :-1] + subst[p]
+
+            # vertical: primer base i is not in the read
+            F = np.maximum(H + go, F + ge)
+
+            # cells with nothing better start a new alignment here
+            zero = (i << _READ_BITS) | cols
+            H0 = np.maximum(np.maximum(D, F), zero[np.newaxis, :])
+
+            # horizontal: read bases not in the primer. E[j] is the best
+            # H0[k] + go + ge * (j - k - 1) over k < j, found with a
+            # running maximum of H0[k] - ge * k
+            run = np.maximum.accumulate(H0 - ge * cols, axis=1)
+            E = np.empty_like(H)
+            E[:, 0] = blocked << _ORIGIN_BITS
+            E[:, 1:] = run[:, :-1] + (go - ge) + ge * cols[1:]
+
+            H = np.maximum(H0, E)
+            H[:, 0] = zero[0]
+
+            j = H.argmax(axis=1)
+            h = H[rows, j]
+            better = h > best
+            best = np.where(better, h, best)
+            best_i = np.where(better, i, best_i)
+            best_j = np.where(better, j, best_j)
+
+        score = (best >> _ORIGIN_BITS) / self.scale
+        origin = best & _ORIGIN_MASK
+        tstart = origin >> _READ_BITS
+        start = origin & _READ_MASK
+        tend = len(self.primer) - best_i
+        return score, start, best_j, tstart, tend
+
+    def align(self, read):
+        score, start, end, tstart, tend = self.align_batch([read])
+        return PrimerAlignment(
+            score[0], int(start[0]), int(end[0]), int(tstart[0]), int(tend[0]), read
+        )
@@ -0,0 +1,213 @@
+__version__ = "0.9"
+__author__ = ["Marvin Jens"]
+__license__ = "GPL"
+__email__ = ["marvin.jens@mdc-berlin.de"]
+
+import logging
+import numpy as np
+from collections import defaultdict
+
+# 2-bit codes for A, C, G, T. Everything else (N, ...) can not be packed
+_CODES = np.full(256, 255, dtype=np.uint8)
+for _i, _c in enumerate(b"ACGT"):
+    _CODES[_c] = _i
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+MAX_PACKED_LEN = 32
+
+
+def pack_2bit(M):
+    """
+    Packs a (n, l) uint8 matrix of sequences with l <= 32 into uint64 keys.
+    Returns the keys and a mask of the rows which only contain ACGT.
+    Numerical order of the keys is the lexicographic order of the sequences.
+    """
+    codes = _CODES[M]
+    ok = (codes < 4).all(axis=1)
+    keys = np.zeros(len(M), dtype=np.uint64)
+    two = np.uint64(2)
+    for j in range(M.shape[1]):
+        keys = (keys << two) | (codes[:, j] & 3).astype(np.uint64)
+
+    return keys, ok
+
+
+def unpack_2bit(keys, l):
+    "inverse of pack_2bit(). Returns a list of strings"
+    n = len(keys)
+    if not n or not l:
+        return [""] * n
+
+    M = np.empty((n, l), dtype=np.uint8)
+    three = np.uint64(3)
+    for j in range(l):
+        M[:, l - 1 - j] = (keys >> np.uint64(2 * j)) & three
+
+    buf = _BASES[M].tobytes().decode("ascii")
+    return [buf[i : i + l] for i in range(0, n * l, l)]
+
+
+def merge_sorted_counts(keys1, counts1, keys2, counts2):
+    """
+    Merges two sets of unique keys with their counts into one, again
+    sorted by key. Counts of keys present in both are summed.
+    """
+    keys = np.concatenate([keys1, keys2])
+    counts = np.concatenate([counts1, counts2])
+    order = np.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    counts = counts[order]
+    if not len(keys):
+        return keys, counts
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+class PackedCounter:
+    """
+    Counts (cell barcode) sequences with little memory. Sequences are
+    collected in a buffer and, once buffer_size are reached, packed into
+    2-bit uint64 keys, reduced with np.unique() and merged into sorted arrays
+    of keys and counts (one pair of arrays per sequence length). Sequences
+    that can not be packed (N bases, longer than 32 nt) are counted in a
+    plain dictionary.
+
+    Counters pickle in their compact form and can be combined with merge(),
+    so that they can be returned from worker processes.
+    """
+
+    def __init__(self, buffer_size=2**20):
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.keys = {}  # length -> sorted uint64 keys
+        self.counts = {}  # length -> int64 counts
+        self.other = defaultdict(int)
+
+    def add(self, seq):
+        self.buffer.append(seq)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def add_batch(self, seqs):
+        self.buffer.extend(seqs)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def _merge(self, l, keys, counts):
+        if l in self.keys:
+            keys, counts = merge_sorted_counts(
+                self.keys[l], self.counts[l], keys, counts
+            )
+
+        self.keys[l] = keys
+        self.counts[l] = counts
+
+    def flush(self):
+        "pack and merge the buffered sequences"
+        if not self.buffer:
+            return
+
+        seqs = self.buffer
+        self.buffer = []
+        lengths = np.array([len(s) for s in seqs])
+        for l in np.unique(lengths).tolist():
+            if len(seqs) == 1 or (lengths[0] == l and (lengths == l).all()):
+                group = seqs
+            else:
+                group = [s for s in seqs if len(s) == l]
+
+            if l > MAX_PACKED_LEN or not l:
+                for s in group:
+                    self.other[s] += 1
+                continue
+
+            buf = "".join(group).encode("ascii", errors="replace")
+            M = np.frombuffer(buf, dtype=np.uint8).reshape(len(group), l)
+            keys, ok = pack_2bit(M)
+            if not ok.all():
+                for i in np.flatnonzero(~ok).tolist():
+                    self.other[group[i]] += 1
+                keys = keys[ok]
+
+            keys, counts = np.unique(keys, return_counts=True)
+            self._merge(l, keys, counts.astype(np.int64))
+
+    def merge(self, other):
+        "add the counts of another PackedCounter to this one"
+        self.flush()
+        other.flush()
+        for l, keys in other.keys.items():
+            self._merge(l, keys, other.counts[l])
+
+        for seq, count in other.other.items():
+            self.other[seq] += count
+
+        return self
+
+    def __getstate__(self):
+        self.flush()
+        return self.__dict__
+
+    def __len__(self):
+        "number of distinct sequences"
+        self.flush()
+        return sum([len(k) for k in self.keys.values()]) + len(self.other)
+
+    def total(self):
+        "number of sequences counted"
+        self.flush()
+        return sum([int(c.sum()) for c in self.counts.values()]) + sum(
+            self.other.values()
+        )
+
+    def items(self):
+        """
+        All (sequence, count) pairs, sorted by sequence. In the common case
+        of only one sequence length and no unpackable sequences, the packed
+        arrays are already in this order and are decoded step by step.
+        """
+        self.flush()
+        if len(self.keys) == 1 and not self.other:
+            ((l, keys),) = self.keys.items()
+            counts = self.counts[l]
+            step = 2**16
+            for i in range(0, len(keys), step):
+                seqs = unpack_2bit(keys[i : i + step], l)
+                yield from zip(seqs, counts[i : i + step].tolist())
+        else:
+            items = list(self.other.items())
+            for l, keys in self.keys.items():
+                items.extend(zip(unpack_2bit(keys, l), self.counts[l].tolist()))
+
+            yield from sorted(items)
+
+    def top(self, n):
+        """
+        The n most frequent sequences as a list of (sequence, count), most
+        frequent first. E.g. a whitelist of the top cell barcodes, without
+        another pass over the BAM.
+        """
+        self.flush()
+        cands = sorted(self.other.items(), key=lambda x: -x[1])[:n]
+        for l, keys in self.keys.items():
+            counts = self.counts[l]
+            if len(counts) > n:
+                idx = np.argpartition(-counts, n - 1)[:n]
+            else:
+                idx = np.arange(len(counts))
+
+            cands.extend(zip(unpack_2bit(keys[idx], l), counts[idx].tolist()))
+
+        return sorted(cands, key=lambda x: (-x[1], x[0]))[:n]
+
+    def write(self, fname):
+        "gzipped, tab-separated 'cell_bc\traw_read_count' table"
+        import gzip
+
+        logger = logging.getLogger("spacemake.preprocess.counts.PackedCounter")
+        logger.info(f"writing {len(self)} barcode counts to '{fname}'")
+        with gzip.open(fname, "wt") as f:
+            f.write("cell_bc\traw_read_count\n")
+            for seq, count in self.items():
+                f.write(f"{seq}\t{count}\n")
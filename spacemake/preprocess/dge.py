@@ -63,7 +63,7 @@ def calculate_shannon_entropy_scompression(adata):
         return len(compressed_barcode)
 
     bc = adata.obs.index.to_numpy()
-    bc_len = len(bc[0])
+    bc_len = len(bc[0]) if len(bc) else 0
     theoretical_barcodes = np.random.choice(
         ["A", "C", "T", "G"], size=(bc.shape[0], bc_len)
     )
@@ -99,7 +99,6 @@ def dge_to_sparse_adata(dge_path, dge_summary_path):
 
     with gzip.open(dge_path, "rt") as dge:
         first_line = dge.readline().strip().split("\t")
-        has_mt = False
         barcodes = first_line[1:]
         N_bc = len(barcodes)
         X = None
@@ -113,9 +112,6 @@ def dge_to_sparse_adata(dge_path, dge_summary_path):
             _gene_name = vals[:_idx_tab]
             gene_names.append(_gene_name)
 
-            if _gene_name.lower().startswith("mt-"):
-                has_mt = True
-                
             # store counts as np.array
             _vals = np.fromstring(vals[_idx_tab:], dtype=np.int32, count=N_bc, sep='\t').flatten()
             _idx_nonzero = np.argwhere(_vals != 0).flatten()
@@ -130,34 +126,52 @@ def dge_to_sparse_adata(dge_path, dge_summary_path):
             else:
                  X = hstack([X, gene_sp])
 
-        if not has_mt:
-            # ensure we have an entry for mitochondrial transcripts even if it's just all zeros
-            print(
-                "need to add mt-missing because no mitochondrial stuff was among the genes for annotation"
-            )
-            gene_names.append("mt-missing")
-            X = hstack([X, np.zeros(X.shape[0])[:, None]])
-
-        X = X.tocsr()
-        X = X.astype(np.float32)
-        adata = anndata.AnnData(
-            X, obs=pd.DataFrame(index=barcodes), var=pd.DataFrame(index=gene_names)
+        adata = make_dge_adata(X, barcodes, gene_names, dge_summary_path)
+
+        if adata.X.sum() == 0:
+            logger.warn(f"The DGE from {dge_path} is empty")
+
+        return adata
+
+
+def make_dge_adata(X, barcodes, gene_names, dge_summary_path=None, n_reads=None):
+    """
+    AnnData of a (barcodes x genes) count matrix X, with the metrics that
+    spacemake attaches to every raw DGE. Adds an all-zero 'mt-missing' gene
+    if there are no mitochondrial genes. n_reads per barcode are taken from
+    the DigitalExpression summary at dge_summary_path or passed directly.
+    """
+    import anndata
+    import numpy as np
+    import pandas as pd
+    from scipy.sparse import csr_matrix, hstack
+
+    gene_names = list(gene_names)
+    if not any([g.lower().startswith("mt-") for g in gene_names]):
+        # ensure we have an entry for mitochondrial transcripts even if it's just all zeros
+        print(
+            "need to add mt-missing because no mitochondrial stuff was among the genes for annotation"
         )
+        gene_names.append("mt-missing")
+        X = hstack([X, csr_matrix((X.shape[0], 1))])
 
-        # name the index
-        adata.obs.index.name = "cell_bc"
+    X = csr_matrix(X)
+    X = X.astype(np.float32)
+    adata = anndata.AnnData(
+        X, obs=pd.DataFrame(index=list(barcodes)), var=pd.DataFrame(index=gene_names)
+    )
 
-        # attach metrics such as: total_counts, pct_mt_counts, etc
-        # also attach n_genes, and calculate pcr
-        calculate_adata_metrics(adata, dge_summary_path)
+    # name the index
+    adata.obs.index.name = "cell_bc"
 
-        # calculate per shannon_entropy and string_compression per bead
-        calculate_shannon_entropy_scompression(adata)
+    # attach metrics such as: total_counts, pct_mt_counts, etc
+    # also attach n_genes, and calculate pcr
+    calculate_adata_metrics(adata, dge_summary_path, n_reads=n_reads)
 
-        if adata.X.sum() == 0:
-            logger.warn(f"The DGE from {dge_path} is empty")
+    # calculate per shannon_entropy and string_compression per bead
+    calculate_shannon_entropy_scompression(adata)
 
-        return adata
+    return adata
 
 
 def load_external_dge(dge_path):
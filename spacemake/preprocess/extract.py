@@ -0,0 +1,192 @@
+__version__ = "0.9"
+__author__ = ["Marvin Jens"]
+__license__ = "GPL"
+__email__ = ["marvin.jens@mdc-berlin.de"]
+
+import ast
+import logging
+import numpy as np
+
+# variables which may appear in extraction expressions and which are
+# sequences of the reads themselves (the others are barcode matches)
+READ_VARIABLES = ["r1", "r2"]
+
+
+class ExtractionPlan:
+    """
+    Precompiled barcode/UMI extraction expression, such as "r1[8:20][::-1]"
+    or "r1[0:12] + r2[:8]". Supported are variable names followed by any
+    chain of slices or indices, string constants, None, and concatenation
+    of those with +. Parsing fails with a ValueError for anything else.
+
+    The plan is applied to a dictionary of variable values for single reads
+    and, if only read sequences are used, to whole chunks of reads of equal
+    length at once (see extract_batch()).
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.parts = self._parse(ast.parse(expr.strip(), mode="eval").body)
+        self.variables = set([var for var, sels in self.parts if var is not None])
+        self.batchable = self.variables <= set(READ_VARIABLES)
+        if len(self.parts) > 1:
+            self.extract = self._extract_concat
+        elif self.parts[0][0] is not None and len(self.parts[0][1]) == 1:
+            # the most common case, e.g. "r1[0:12]"
+            var, (sel,) = self.parts[0]
+            self.extract = lambda values: values[var][sel]
+        else:
+            self.extract = self._extract_single
+
+    def _unsupported(self, node):
+        raise ValueError(
+            f"unsupported syntax in extraction expression '{self.expr}': "
+            f"{ast.dump(node)}"
+        )
+
+    def _int(self, node):
+        if node is None:
+            return None
+        if isinstance(node, ast.Constant) and type(node.value) is int:
+            return node.value
+        if (
+            isinstance(node, ast.UnaryOp)
+            and isinstance(node.op, ast.USub)
+            and isinstance(node.operand, ast.Constant)
+            and type(node.operand.value) is int
+        ):
+            return -node.operand.value
+
+        self._unsupported(node)
+
+    def _parse(self, node):
+        """
+        Returns a list of (variable, [selectors]) tuples, one for each part of
+        a concatenation. Constants are represented as (None, value).
+        """
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return self._parse(node.left) + self._parse(node.right)
+
+        if isinstance(node, ast.Constant) and (
+            node.value is None or type(node.value) is str
+        ):
+            return [(None, node.value)]
+
+        sels = []
+        while isinstance(node, ast.Subscript):
+            sl = node.slice
+            if isinstance(sl, getattr(ast, "Index", ())):
+                # python < 3.9
+                sl = sl.value
+
+            if isinstance(sl, ast.Slice):
+                sel = slice(
+                    self._int(sl.lower), self._int(sl.upper), self._int(sl.step)
+                )
+                sels.insert(0, sel)
+            else:
+                sels.insert(0, self._int(sl))
+            node = node.value
+
+        if isinstance(node, ast.Name):
+            return [(node.id, sels)]
+
+        self._unsupported(node)
+
+    @staticmethod
+    def _select(value, sels):
+        for sel in sels:
+            value = value[sel]
+        return value
+
+    def _extract_single(self, values):
+        var, sels = self.parts[0]
+        if var is None:
+            return sels
+
+        return self._select(values[var], sels)
+
+    def _extract_concat(self, values):
+        res = []
+        for var, sels in self.parts:
+            if var is None:
+                res.append(sels)
+            else:
+                res.append(self._select(values[var], sels))
+
+        return "".join(res)
+
+    def column_indices(self, lengths):
+        """
+        Positions of the extracted bases if the variables have the given
+        lengths, as a list of (variable, index array) tuples. Constants are
+        (None, value). Slicing np.arange() has exactly the semantics of
+        slicing the strings themselves.
+        """
+        cols = []
+        for var, sels in self.parts:
+            if var is None:
+                cols.append((None, sels))
+            else:
+                idx = self._select(np.arange(lengths[var]), sels)
+                cols.append((var, np.atleast_1d(idx)))
+
+        return cols
+
+    def extract_batch(self, matrices):
+        """
+        Extract from a whole chunk of reads at once. matrices maps the read
+        variables ('r1', 'r2') to (n_reads, read_length) uint8 matrices of
+        the read sequences. Returns a list of strings (or Nones).
+        """
+        n = len(next(iter(matrices.values())))
+        lengths = {var: M.shape[1] for var, M in matrices.items()}
+        cols = self.column_indices(lengths)
+        if len(cols) == 1 and cols[0][0] is None:
+            return [cols[0][1]] * n
+
+        blocks = []
+        for var, idx in cols:
+            if var is None:
+                const = np.frombuffer(idx.encode("ascii"), dtype=np.uint8)
+                blocks.append(np.broadcast_to(const, (n, len(const))))
+            else:
+                blocks.append(matrices[var][:, idx])
+
+        sub = np.ascontiguousarray(np.concatenate(blocks, axis=1))
+        w = sub.shape[1]
+        if w == 0:
+            return [""] * n
+
+        buf = sub.tobytes().decode("ascii")
+        return [buf[i : i + w] for i in range(0, n * w, w)]
+
+
+def compile_expression(expr):
+    """
+    Returns an ExtractionPlan for expr, or None if expr is outside of the
+    supported grammar and has to be evaluated with eval().
+    """
+    try:
+        return ExtractionPlan(expr)
+    except (ValueError, SyntaxError) as err:
+        logging.getLogger("spacemake.preprocess.extract").info(
+            f"falling back to eval() for '{expr}': {err}"
+        )
+        return None
+
+
+def read_matrix(seqs):
+    """
+    Turn a list of equal-length sequences into a (n, l) uint8 matrix.
+    Returns None if the lengths differ.
+    """
+    if not seqs:
+        return None
+
+    l = len(seqs[0])
+    if any(len(s) != l for s in seqs):
+        return None
+
+    buf = "".join(seqs).encode("ascii")
+    return np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), l)
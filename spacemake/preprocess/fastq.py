@@ -18,14 +18,19 @@ from collections import defaultdict
 #from Bio import pairwise2
 from Bio import SeqIO
 
+from functools import partial
 from spacemake.parallel import (
-    put_or_abort,
-    queue_iter,
-    join_with_empty_queues,
     chunkify,
+    count_dict_sum,
+    dict_merge,
+    parallel_map,
     ExceptionLogging,
 )
-from spacemake.util import read_fq
+from spacemake.util import read_fq, read_fq_blocks, parse_fq_block
+from spacemake.bam import encode_unaligned, BAMWriter
+from spacemake.preprocess.extract import compile_expression, read_matrix
+from spacemake.preprocess.align import PrimerAligner, PrimerAlignment
+from spacemake.preprocess.counts import PackedCounter
 
 NO_CALL = "NNNNNNNN"
 
@@ -50,6 +55,86 @@ def read_source(args):
             yield id1, seq1, id1, "READ2 IS NOT AVAILABLE", "READ2 IS NOT AVAILABLE"
 
 
+def raw_source(args, threads=1):
+    """
+    Record-aligned blocks of raw FASTQ bytes from read1 and read2, numbered
+    like the output of chunkify(). Parsing is left to the workers, see
+    unpack_reads(). threads are used to decompress each of the inputs.
+    """
+    blocks1 = read_fq_blocks(args.read1, n_records=args.chunk_size, threads=threads)
+    if args.read2:
+        blocks2 = read_fq_blocks(
+            args.read2, n_records=args.chunk_size, threads=threads
+        )
+        for n, (block1, block2) in enumerate(zip(blocks1, blocks2)):
+            yield n, (block1, block2)
+    else:
+        for n, block1 in enumerate(blocks1):
+            yield n, (block1, None)
+
+
+def unpack_reads(reads):
+    """
+    Turns a chunk of reads as sent by process_fastq() into a list of
+    (id1, seq1, id2, seq2, qual2) tuples, the same as read_source() yields.
+    """
+    if type(reads) is not tuple:
+        # already parsed (--transport=records)
+        return reads
+
+    block1, block2 = reads
+    names1, seqs1, quals1 = parse_fq_block(block1)
+    if block2 is None:
+        na = "READ2 IS NOT AVAILABLE"
+        return [(name, seq, name, na, na) for name, seq in zip(names1, seqs1)]
+
+    names2, seqs2, quals2 = parse_fq_block(block2)
+    return list(zip(names1, seqs1, names2, seqs2, quals2))
+
+
+def check_transport(args):
+    "raw transport is only possible for FASTQ input"
+    if args.transport == "raw" and (
+        args.read1.endswith(".bam") or args.read2.endswith(".bam")
+    ):
+        logging.info("BAM input: falling back to --transport=records")
+        args.transport = "records"
+
+
+class StageRates:
+    """
+    Shared counters of the reads handled and the seconds spent busy (not
+    waiting on a queue) by the dispatcher, the workers and the collector.
+    Their ratio is the throughput that each stage could sustain on its own,
+    so the slowest stage is the bottleneck.
+    """
+
+    stages = ["dispatcher", "workers", "collector"]
+
+    def __init__(self):
+        self.n_reads = {stage: mp.Value("l", 0) for stage in self.stages}
+        self.busy = {stage: mp.Value("d", 0.0) for stage in self.stages}
+
+    def add(self, stage, n, dt):
+        with self.n_reads[stage].get_lock():
+            self.n_reads[stage].value += n
+        with self.busy[stage].get_lock():
+            self.busy[stage].value += dt
+
+    def report(self, n_workers=1):
+        rates = []
+        for stage in self.stages:
+            busy = self.busy[stage].value
+            if stage == "workers":
+                # the workers share the load
+                busy /= n_workers
+
+            rate = self.n_reads[stage].value / busy if busy else 0
+            rates.append(f"{stage} {rate:.0f}")
+
+        return "max. reads/second of each stage: " + ", ".join(rates)
+
+
 def hamming(seqA, seqB, costs, match=2):
     score = 0
     for a, b, c in zip(seqA, seqB, costs):
@@ -64,10 +149,103 @@ def hamming(seqA, seqB, costs, match=2):
     return score
 
 
+## 2D uint8 encoding of barcode sequences for vectorized scoring
+BASE_CODES = np.full(256, 4, dtype=np.uint8)  # anything else is treated like N
+for _i, _b in enumerate(b"ACGT"):
+    BASE_CODES[_b] = _i
+BASE_CODE_A = 0
+N_BASE_CODES = 5
+
+
+def encode_bases(seqs, l):
+    """
+    Convert a list of sequences, all of length l, into a (len(seqs), l) uint8
+    matrix of base codes.
+    """
+    buf = "".join(seqs).encode("ascii")
+    return BASE_CODES[np.frombuffer(buf, dtype=np.uint8)].reshape(len(seqs), l)
+
+
+def onehot_bases(codes):
+    """
+    One-hot encode a (n, l) matrix of base codes into a (n, l * N_BASE_CODES)
+    float matrix.
+    """
+    n, l = codes.shape
+    onehot = np.zeros((n, l, N_BASE_CODES), dtype=np.float64)
+    onehot.reshape(-1, N_BASE_CODES)[np.arange(n * l), codes.ravel()] = 1
+    return onehot.reshape(n, l * N_BASE_CODES)
+
+
+class SeedIndex:
+    """
+    Pigeonhole seed index over all reference barcodes of one length.
+    From the position-specific costs we derive the maximal number of
+    mismatches d a reference can have and still reach min_score. Splitting
+    the barcode into d + 1 segments, any such reference has to match the
+    query exactly in at least one segment. Looking up the query segments
+    therefore yields a (small) superset of all references that can score
+    >= min_score.
+    """
+
+    def __init__(self, seqs, costs, min_score, match=2, max_selectivity=0.05):
+        l = len(costs)
+        # smallest possible score loss for a mismatch at each position
+        # (see hamming(): no match bonus, cost, but +1 for A at cost 0)
+        loss = np.sort(match + costs - (costs == 0))
+        budget = match * l - min_score
+        self.max_mismatches = int((np.cumsum(loss) <= budget).sum())
+        n_seg = self.max_mismatches + 1
+        self.segments = []
+        self.lookups = []
+        bounds = np.linspace(0, l, n_seg + 1).round().astype(int)
+        # expected fraction of references retrieved for a random query.
+        # If the segments are too short, scanning everything is faster.
+        self.selectivity = (0.25 ** np.diff(bounds)).sum()
+        self.usable = (n_seg <= l) and (self.selectivity <= max_selectivity)
+        if not self.usable:
+            return
+
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            lookup = defaultdict(list)
+            for i, seq in enumerate(seqs):
+                lookup[seq[start:end]].append(i)
+
+            self.segments.append((start, end))
+            self.lookups.append(
+                dict([(k, np.array(v, dtype=np.int64)) for k, v in lookup.items()])
+            )
+
+    def candidates(self, query):
+        hits = []
+        for (start, end), lookup in zip(self.segments, self.lookups):
+            hit = lookup.get(query[start:end], None)
+            if hit is not None:
+                hits.append(hit)
+
+        if not hits:
+            return np.array([], dtype=np.int64)
+
+        return np.unique(np.concatenate(hits))
+
+
+def load_targets(fname):
+    names = []
+    seqs = []
+    if fname:
+        for rec in SeqIO.parse(fname, "fasta"):
+            names.append(rec.id.split()[0])
+            seqs.append(str(rec.seq).upper())
+
+    return np.array(names), np.array(seqs)
+
+
 class BarcodeMatcher:
-    def __init__(self, fname, length_specific=True, place="left"):
+    def __init__(self, fname, length_specific=True, place="left", threshold=None):
         self.logger = logging.getLogger("BarcodeMatcher")
         self.length_specific = length_specific
+        self.n_seed_hit = 0
+        self.n_seed_fallback = 0
         self.names, self.seqs = self.load_targets(fname)
         self.slen = np.array([len(s) for s in self.seqs])
         if len(self.names) == 0:
@@ -93,20 +271,41 @@ class BarcodeMatcher:
 
                 self.costs[l] = cost
 
+            # references of each length as 2D uint8 arrays of base codes and
+            # their one-hot encoding. This allows to score an entire batch of
+            # queries against all references with a single matrix product.
+            self.ref_codes = {}
+            self.ref_onehot = {}
+            for l, lmask in self.slen_masks.items():
+                codes = encode_bases(self.seqs[lmask], l)
+                self.ref_codes[l] = codes
+                self.ref_onehot[l] = onehot_bases(codes)
+
+            # optional seed indices to restrict scoring to the references
+            # that can score above the threshold used by match_BC1/2
+            self.seed_index = {}
+            if threshold is not None and length_specific:
+                for l, lmask in self.slen_masks.items():
+                    if not len(lmask):
+                        continue
+
+                    name_len = np.array([len(n) for n in self.names[lmask]])
+                    min_score = 2 * name_len.min() * threshold
+                    index = SeedIndex(self.seqs[lmask], self.costs[l], min_score)
+                    if index.usable:
+                        self.seed_index[l] = (index, min_score)
+                        self.logger.debug(
+                            f"seed index for length {l}: <= {index.max_mismatches} "
+                            f"mismatches allowed, segments {index.segments}"
+                        )
+
             self.logger.debug(
                 f"initialized from {len(self.names)} sequences from lmin={self.lmin} to lmax={self.lmax}"
             )
 
     def load_targets(self, fname):
         self.logger.debug(f"loading target sequences from '{fname}'")
-        names = []
-        seqs = []
-        if fname:
-            for rec in SeqIO.parse(fname, "fasta"):
-                names.append(rec.id.split()[0])
-                seqs.append(str(rec.seq).upper())
-
-        return np.array(names), np.array(seqs)
+        return load_targets(fname)
 
     def align_na(self, query, debug=False):
         return (
@@ -116,6 +315,25 @@ class BarcodeMatcher:
         )
 
     def align(self, query, debug=False):
+        if not self.length_specific:
+            return self.align_scan(query, debug=debug)
+
+        names, seqs, scores = self.align_batch([query])[0]
+        if debug:
+            lq = min(len(query), self.lmax)
+            lmask = self.slen_masks[lq]
+            all_scores = self.score_batch([query[:lq]], lq)[0]
+            print("Q  ", query)
+            for i in all_scores.argsort()[::-1]:
+                print("*  ", self.seqs[lmask][i], all_scores[i])
+
+        return names, seqs, scores
+
+    def align_scan(self, query, debug=False):
+        """
+        Reference implementation: score query against the selected reference
+        barcodes one by one, using hamming().
+        """
         results = []
         scores = []
         # select set of barcode sequences to align with
@@ -126,8 +344,8 @@ class BarcodeMatcher:
                 [-1],
             )
 
+        lq = min(len(query), self.lmax)
         if self.length_specific:
-            lq = min(len(query), self.lmax)
             lmask = self.slen_masks[lq]
             seqs_sel = self.seqs[lmask]
             names_sel = self.names[lmask]
@@ -157,23 +375,196 @@ class BarcodeMatcher:
         ties = scores == scores[i]
         return names_sel[ties], seqs_sel[ties], scores[ties]
 
+    def query_weights(self, queries, lq):
+        """
+        score = sum(mismatch penalties) + sum(match * (2 - mismatch penalty)).
+        The first term only depends on the query, the second is the dot
+        product of the weighted, one-hot encoded query with the one-hot
+        encoded reference. Returns both for a list of queries of length lq.
+        """
+        costs = self.costs[lq]
+        codes = encode_bases(queries, lq)
+        # per-position score of a mismatch, including the BC2 start tweak
+        # from hamming()
+        penalty = -costs[np.newaxis, :] + ((codes == BASE_CODE_A) & (costs == 0))
+        weights = onehot_bases(codes) * np.repeat(2 - penalty, N_BASE_CODES, axis=1)
+
+        return penalty.sum(axis=1), weights
+
+    def score_batch(self, queries, lq):
+        """
+        Vectorized equivalent of hamming() for a list of queries, which all
+        must have length lq. Returns a (len(queries), n_refs) matrix of scores
+        against all references of length lq.
+        """
+        base, weights = self.query_weights(queries, lq)
+        return base[:, np.newaxis] + weights @ self.ref_onehot[lq].T
+
+    def align_seeded(self, queries, lq, index, min_score, max_cells=2**22):
+        """
+        Score each query only against the candidates retrieved from the seed
+        index. Returns a list with (names, seqs, scores) for each query, or None
+        if no candidate reached min_score. In that case only the exhaustive
+        scan can reproduce the exact best-scoring (sub-threshold) hits.
+        """
+        results = [None] * len(queries)
+        cands = [index.candidates(q) for q in queries]
+        n_cand = np.array([len(c) for c in cands], dtype=np.int64)
+        if not n_cand.sum():
+            return results
+
+        ref_codes = self.ref_codes[lq]
+        lmask = self.slen_masks[lq]
+        names_sel = self.names[lmask]
+        seqs_sel = self.seqs[lmask]
+        costs = self.costs[lq]
+
+        # score (query, candidate) pairs directly on the base codes,
+        # in batches of queries to bound memory
+        codes = encode_bases(queries, lq)
+        penalty = -costs[np.newaxis, :] + ((codes == BASE_CODE_A) & (costs == 0))
+        base = penalty.sum(axis=1)
+        gain = 2 - penalty
+
+        ends = np.cumsum(n_cand)
+        starts = ends - n_cand
+        b = 0
+        while b < len(queries):
+            e = b + 1
+            while e < len(queries) and (ends[e] - starts[b]) * lq < max_cells:
+                e += 1
+
+            qi = np.repeat(np.arange(b, e), n_cand[b:e])
+            ri = np.concatenate(cands[b:e])
+            match = codes[qi] == ref_codes[ri]
+            scores = base[qi] + (match * gain[qi]).sum(axis=1)
+
+            offset = starts[b]
+            for i in range(b, e):
+                if not n_cand[i]:
+                    continue
+
+                row = scores[starts[i] - offset : ends[i] - offset]
+                best = row.max()
+                if best >= min_score:
+                    # every reference reaching min_score is a candidate,
+                    # so the best hit and all ties are exactly the same as
+                    # from the exhaustive scan
+                    tie = row == best
+                    ref = cands[i][tie]
+                    results[i] = names_sel[ref], seqs_sel[ref], row[tie]
+            b = e
+
+        return results
+
+    def align_batch(self, queries, max_cells=2**22):
+        """
+        Align a list of queries at once. Returns a list of
+        (names, seqs, scores) tuples with the best, tied matches for each
+        query, exactly like align() does for a single query.
+        """
+        if not len(self.names):
+            # matching is disabled
+            return [self.align_na(query) for query in queries]
+
+        results = [None] * len(queries)
+        by_len = defaultdict(list)
+        for i, query in enumerate(queries):
+            if len(query) < self.lmin:
+                results[i] = ([NO_CALL], [NO_CALL], [-1])
+            else:
+                by_len[min(len(query), self.lmax)].append(i)
+
+        for lq, idx in by_len.items():
+            lmask = self.slen_masks[lq]
+            if not len(lmask):
+                for i in idx:
+                    results[i] = ([NO_CALL], [NO_CALL], [-1])
+                continue
+
+            if lq in self.seed_index:
+                index, min_score = self.seed_index[lq]
+                seeded = self.align_seeded(
+                    [queries[i][:lq] for i in idx], lq, index, min_score
+                )
+                fallback = []
+                for i, res in zip(idx, seeded):
+                    if res is None:
+                        fallback.append(i)
+                    else:
+                        results[i] = res
+
+                self.n_seed_hit += len(idx) - len(fallback)
+                self.n_seed_fallback += len(fallback)
+                idx = fallback
+
+            names_sel = self.names[lmask]
+            seqs_sel = self.seqs[lmask]
+            # limit the size of the score matrix held in memory
+            n_batch = max(1, max_cells // max(len(lmask), 1))
+            for b in range(0, len(idx), n_batch):
+                bidx = idx[b : b + n_batch]
+                scores = self.score_batch([queries[i][:lq] for i in bidx], lq)
+                ties = scores == scores.max(axis=1)[:, np.newaxis]
+                for i, row, tie in zip(bidx, scores, ties):
+                    results[i] = names_sel[tie], seqs_sel[tie], row[tie]
+
+        return results
+
 
 class TieBreaker:
-    def __init__(self, fname, place="left"):
+    def __init__(self, fname, place="left", threshold=None, shared=None):
         self.logger = logging.getLogger("TieBreaker")
-        self.matcher = BarcodeMatcher(fname, place=place)
+        self.matcher = BarcodeMatcher(fname, place=place, threshold=threshold)
         self.query_count = defaultdict(float)
         self.bc_count = defaultdict(float)
-        self.cache = {}
+        # with a SharedAlignmentCache, the local cache only holds what
+        # could not be stored in shared memory
+        self.shared = shared
+        self.cache = dict(shared.overflow) if shared is not None else {}
+        self.prefetched = {}
         self.n_hit = 0
         self.n_align = 0
 
+    def lookup(self, query):
+        result = self.cache.get(query, None)
+        if result is None and self.shared is not None:
+            result = self.shared.get(query)
+
+        return result
+
+    def prefetch(self, queries):
+        """
+        Align all queries which are not cached yet in one vectorized batch.
+        The raw results are kept aside until align() asks for them, so that
+        the cache statistics are the same as without prefetching.
+        """
+        if not len(self.matcher.names):
+            # nothing to align against, align() falls back to align_na()
+            return
+
+        todo = sorted(
+            set(
+                [
+                    q
+                    for q in queries
+                    if not (q in self.prefetched or self.lookup(q) is not None)
+                ]
+            )
+        )
+        for query, res in zip(todo, self.matcher.align_batch(todo)):
+            self.prefetched[query] = res
+
     def align(self, query, debug=False, w=1):
         self.query_count[query] += w
-        if not query in self.cache:
+        result = self.lookup(query)
+        if result is None:
             self.n_align += w
 
-            names, seqs, scores = self.matcher.align(query, debug)
+            if query in self.prefetched and not debug:
+                names, seqs, scores = self.prefetched.pop(query)
+            else:
+                names, seqs, scores = self.matcher.align(query, debug)
             if debug:
                 for n, s, S in zip(names, seqs, scores):
                     print(f"{n}\t{s}\t{S}")
@@ -185,11 +576,13 @@ class TieBreaker:
                 # potentially do more involved resolving?
                 result = (NO_CALL, NO_CALL, scores[0])
 
-            self.cache[query] = result
+            if self.shared is None or not self.shared.put(query, result):
+                self.cache[query] = result
 
         else:
             self.n_hit += w
-            result = self.cache[query]
+            # another worker may have aligned it since we prefetched
+            self.prefetched.pop(query, None)
 
         self.bc_count[result[0]] += w
         self.bc_count["total"] += w
@@ -206,8 +599,150 @@ class TieBreaker:
         else:
             return results[i], queries[i]
 
-    def load_cache(self, fname):
-        self.logger.debug(f"pre-populating alignment cache from '{fname}'")
+
+class SharedAlignmentCache:
+    """
+    Barcode alignment cache in shared memory, which all worker processes
+    can read and fill while they run. Queries of up to 29 nt consisting only
+    of ACGT are 2-bit encoded together with their length into a 64 bit key
+    and stored in an open-addressing hash table with linear probing. The
+    value is the index of the reference barcode (negative for NO_CALL) and
+    the alignment score.
+
+    Writes are serialized by a lock and the value is written before the key,
+    so that lock-free readers never see a key without its value. Queries
+    that can not be encoded (or anything once the table is full) are not
+    stored and put() returns False, so that the caller can fall back to a
+    process-local cache. Must be created before the worker processes.
+    """
+
+    max_len = 29
+    to_digits = str.maketrans("ACGT", "0123")
+    from_digits = str.maketrans("0123", "ACGT")
+
+    def __init__(self, names, seqs, size=2**21, max_load=0.7):
+        self.logger = logging.getLogger("SharedAlignmentCache")
+        bits = max(int(np.ceil(np.log2(max(size, 2)))), 1)
+        self.capacity = 2**bits
+        self.shift = 64 - bits
+        self.mask = self.capacity - 1
+        self.max_used = int(self.capacity * max_load)
+
+        self.names = list(names)
+        self.seqs = list(seqs)
+        self.ref_index = {(n, s): i for i, (n, s) in enumerate(zip(names, seqs))}
+        # cache entries which were loaded, but do not fit into shared memory.
+        # They are inherited by each worker's local cache.
+        self.overflow = {}
+
+        self.raw_keys = mp.RawArray("Q", self.capacity)
+        self.raw_refs = mp.RawArray("i", self.capacity)
+        self.raw_scores = mp.RawArray("d", self.capacity)
+        self.n_used = mp.RawValue("l", 0)
+        self.lock = mp.Lock()
+        self._make_views()
+
+    @classmethod
+    def from_fasta(cls, fname, **kw):
+        names, seqs = load_targets(fname)
+        return cls(names, seqs, **kw)
+
+    def _make_views(self):
+        self.keys = np.frombuffer(self.raw_keys, dtype=np.uint64)
+        self.refs = np.frombuffer(self.raw_refs, dtype=np.int32)
+        self.scores = np.frombuffer(self.raw_scores, dtype=np.float64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ["logger", "keys", "refs", "scores"]:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger("SharedAlignmentCache")
+        self._make_views()
+
+    def __len__(self):
+        return self.n_used.value
+
+    def encode(self, query):
+        "returns the 64 bit key of query or 0 if it can not be encoded"
+        l = len(query)
+        if not (0 < l <= self.max_len) or query.strip("ACGT"):
+            return 0
+
+        return (l << 58) | int(query.translate(self.to_digits), 4)
+
+    def decode(self, key):
+        l = key >> 58
+        digits = np.base_repr(key & ((1 << 58) - 1), 4).zfill(l)
+        return digits.translate(self.from_digits)
+
+    def slot(self, key):
+        # Fibonacci hashing
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self.shift
+
+    def result(self, i):
+        r = self.refs[i]
+        if r == -2:
+            return (NO_CALL, NO_CALL, -1)
+        if r < 0:
+            return (NO_CALL, NO_CALL, self.scores[i])
+
+        return (self.names[r], self.seqs[r], self.scores[i])
+
+    def get(self, query):
+        key = self.encode(query)
+        if not key:
+            return None
+
+        i = self.slot(key)
+        while True:
+            k = self.keys[i]
+            if k == key:
+                return self.result(i)
+            if k == 0:
+                return None
+            i = (i + 1) & self.mask
+
+    def put(self, query, result):
+        key = self.encode(query)
+        if not key:
+            return False
+
+        name, seq, score = result
+        if name == NO_CALL:
+            # -2 marks the plain integer -1 which align_na() & co. return
+            r = -2 if (type(score) is int and score == -1) else -1
+        else:
+            r = self.ref_index.get((name, seq), None)
+            if r is None:
+                return False
+
+        with self.lock:
+            i = self.slot(key)
+            while True:
+                k = self.keys[i]
+                if k == key:
+                    # another process was faster
+                    return True
+                if k == 0:
+                    break
+                i = (i + 1) & self.mask
+
+            if self.n_used.value >= self.max_used:
+                return False
+
+            self.refs[i] = r
+            self.scores[i] = score
+            self.keys[i] = key
+            self.n_used.value += 1
+
+        return True
+
+    def load(self, fname):
+        self.logger.debug(f"pre-populating shared alignment cache from '{fname}'")
         if fname:
             try:
                 df = pd.read_csv(
@@ -220,18 +755,86 @@ class TieBreaker:
                 self.logger.warning(f"error while loading caches: {err}")
             else:
                 for row in df.itertuples():
-                    self.cache[row.query] = (row.name, row.seq, row.score)
+                    # empty queries come back as NaN
+                    if not isinstance(row.query, str) or not row.query:
+                        continue
 
-        self.logger.debug(f"loaded {len(self.cache)} queries.")
+                    result = (row.name, row.seq, row.score)
+                    if not self.put(row.query, result):
+                        self.overflow[row.query] = result
 
+        self.logger.debug(
+            f"loaded {len(self)} queries into shared memory "
+            f"({len(self.overflow)} overflow)."
+        )
 
-def store_cache(fname, cache, query_count, mincount=2):
-    with open(fname, "w") as f:
-        print(cache.keys())
-        for query in sorted(cache.keys()):
-            if query_count[query] >= mincount:
-                name, seq, score = cache[query]
-                f.write(f"{query}\t{seq}\t{name}\t{score}\t{query_count[query]}\n")
+    def encode_counts(self, query_count):
+        """
+        Splits a dictionary of query counts into arrays of keys and counts
+        for everything that can be encoded (compact to send between processes)
+        and a dictionary with the rest.
+        """
+        keys = []
+        counts = []
+        rest = {}
+        for query, count in query_count.items():
+            key = self.encode(query)
+            if key:
+                keys.append(key)
+                counts.append(count)
+            else:
+                rest[query] = count
+
+        return np.array(keys, dtype=np.uint64), np.array(counts), rest
+
+    def store(self, fname, key_counts, local_caches=[], local_counts=[], mincount=2):
+        """
+        Writes the shared table and the process-local caches as tab-separated
+        query, seq, name, score and count, one line per query seen at least
+        mincount times. key_counts is a list of (keys, counts) array pairs as
+        returned by encode_counts().
+        """
+        if key_counts:
+            keys = np.concatenate([k for k, c in key_counts])
+            counts = np.concatenate([c for k, c in key_counts])
+        else:
+            keys = np.array([], dtype=np.uint64)
+            counts = np.array([])
+
+        ukeys, inverse = np.unique(keys, return_inverse=True)
+        ucounts = np.bincount(inverse, weights=counts, minlength=len(ukeys))
+
+        def lookup_counts(keys):
+            j = np.searchsorted(ukeys, keys)
+            found = j < len(ukeys)
+            found[found] = ukeys[j[found]] == keys[found]
+            res = np.zeros(len(keys))
+            res[found] = ucounts[j[found]]
+            return res
+
+        used = (self.keys != 0).nonzero()[0]
+        used = used[np.argsort(self.keys[used])]
+        slot_counts = lookup_counts(self.keys[used])
+
+        local_cache = dict_merge(local_caches)
+        local_count = count_dict_sum(local_counts)
+        local_queries = sorted(local_cache.keys())
+        local_keys = np.array([self.encode(q) for q in local_queries], dtype=np.uint64)
+        for query, count in zip(local_queries, lookup_counts(local_keys)):
+            local_count[query] += count
+
+        with open(fname, "w") as f:
+            for i, count in zip(used, slot_counts):
+                if count >= mincount:
+                    query = self.decode(int(self.keys[i]))
+                    name, seq, score = self.result(i)
+                    f.write(f"{query}\t{seq}\t{name}\t{score}\t{count}\n")
+
+            for query in local_queries:
+                # an empty query can not be read back
+                if query and local_count[query] >= mincount:
+                    name, seq, score = local_cache[query]
+                    f.write(f"{query}\t{seq}\t{name}\t{score}\t{local_count[query]}\n")
 
 
 def report_stats(N, prefix=""):
@@ -239,16 +842,23 @@ def report_stats(N, prefix=""):
         logging.info(f"{prefix}{k}\t{v}\t{100.0 * v/N['total']:.2f}")
 
 
-def match_BC1(bc1_matcher, seq, qstart, tstart, N, debug=False, threshold=0.5):
+def get_bc1_choices(seq, qstart, tstart):
     if tstart == 0:  # the start of opseq primer is intact
-        bc1 = seq[qstart - 8 : qstart]
-        BC1, ref1, score1 = bc1_matcher.align(bc1, debug=debug)
+        return [seq[qstart - 8 : qstart]]
     else:
         # we have a possible deletion, or mutation. Check both options
-        bc1_choices = [
+        return [
             seq[qstart - 8 : qstart],
             seq[qstart - tstart - 8 : qstart - tstart],
         ]  # deletion  # mutation
+
+
+def match_BC1(bc1_matcher, seq, qstart, tstart, N, debug=False, threshold=0.5):
+    bc1_choices = get_bc1_choices(seq, qstart, tstart)
+    if len(bc1_choices) == 1:
+        bc1 = bc1_choices[0]
+        BC1, ref1, score1 = bc1_matcher.align(bc1, debug=debug)
+    else:
         (BC1, ref1, score1), bc1 = bc1_matcher.align_choices(bc1_choices)
 
     N[f"BC1_score_{score1}"] += 1
@@ -290,8 +900,18 @@ def match_BC2(bc2_matcher, seq, qend, tend, N, threshold=0.5):
     return bc2, BC2, ref2, score2
 
 
-def opseq_local_align(
-    seq,
+_primer_aligners = {}
+
+
+def get_primer_aligner(opseq):
+    if not opseq in _primer_aligners:
+        _primer_aligners[opseq] = PrimerAligner(opseq)
+
+    return _primer_aligners[opseq]
+
+
+def opseq_align_batch(
+    seqs,
     opseq="GAATCACGATACGTACACCAGT",
     min_opseq_score=22,
     min_start=8,
@@ -299,345 +919,308 @@ def opseq_local_align(
     allow_start_gap=False,
     allow_end_gap=False,
 ):
-    results = pairwise2.align.localmd(
-        opseq, seq, 2, -1.5, -3, -1, -3, -1, one_alignment_only=True, score_only=False
-    )
-    tstart = 0
-    tend = 0
-    if len(results) < 1:
-        res = None
-    else:
-        res = results[0]
-        qstart = res.start
-        qend = res.end
-        L = len(res.seqB)
-        # print(res)
-        # print(
-        #     f"flags {qstart < min_start} {qend > max_end} {res.score < min_opseq_score}"
-        # )
+    """
+    Local alignment of opseq to a chunk of reads. Returns a list of
+    (res, tstart, tend) for each read, where res is a PrimerAlignment, or
+    None if the alignment was rejected. tstart and tend are the number of
+    opseq bases missing at the start/end of the alignment. They are only
+    determined (and only lead to rejection) if start/end gaps are not
+    allowed.
+    """
+    aligner = get_primer_aligner(opseq)
+    scores, starts, ends, tstarts, tends = aligner.align_batch(seqs)
+    results = []
+    for seq, score, qstart, qend, tstart, tend in zip(
+        seqs, scores, starts.tolist(), ends.tolist(), tstarts.tolist(), tends.tolist()
+    ):
         if (
             (min_start and (qstart < min_start))
             or (max_end and (qend > max_end))
-            or (res.score < min_opseq_score)
+            or (score < min_opseq_score)
         ):
-            res = None
-        else:
-            # check for start/end gaps
-            # backtrack from qstart in seqA until we hit '-'
-            if not allow_start_gap:
-                while res.seqA[qstart - tstart - 1] != "-":
-                    if qstart - tstart - 1 <= 0:
-                        tstart = -1
-                        res = None
-                        break
-                    tstart += 1
-
-            if res is not None and not allow_end_gap:
-                # and scan forward from qend until we hit '-'
-                while res.seqA[qend + tend] != "-":
-                    if qend + tend >= len(res.seqA) - 8:
-                        tend = -1
-                        res = None
-                        break
-                    tend += 1
-    # print("end results", res, tstart, tend)
-    return res, tstart, tend
-
-
-def process_ordered_results(res_queue, args, Qerr, abort_flag):
-    with ExceptionLogging("collector", Qerr=Qerr, exc_flag=abort_flag) as el:
-        import heapq
-        import time
-
-        heap = []
-        n_chunk_needed = 0
-        t0 = time.time()
-        t1 = t0
-        n_rec = 0
+            results.append((None, 0, 0))
+            continue
 
-        logger = el.logger
-        out = Output(args)
+        if allow_start_gap:
+            tstart = 0
+        elif tstart >= qstart:
+            # the missing opseq start can not be explained by a
+            # mutated/deleted part of the read
+            results.append((None, -1, 0))
+            continue
 
-        for n_chunk, results in queue_iter(res_queue, abort_flag):
-            heapq.heappush(heap, (n_chunk, results))
+        if allow_end_gap:
+            tend = 0
+        elif tend and (len(seq) - qend - tend < 8):
+            # not enough sequence left after the missing opseq end
+            results.append((None, tstart, -1))
+            continue
 
-            # as long as the root of the heap is the next needed chunk
-            # pass results on to storage
-            while heap and (heap[0][0] == n_chunk_needed):
-                n_chunk, results = heapq.heappop(heap)  # retrieves heap[0]
-                for assigned, record in results:
-                    # print("record in process_ordered_results", record)
-                    out.write(assigned, record)
-                    n_rec += 1
+        res = PrimerAlignment(score, qstart, qend, tstart, tend, seq)
+        results.append((res, tstart, tend))
 
-                n_chunk_needed += 1
+    return results
 
-            # debug output on average throughput
-            t2 = time.time()
-            if t2 - t1 > 30:
-                dT = t2 - t0
-                rate = n_rec / dT
-                logger.info(
-                    "processed {0} reads in {1:.0f} seconds (average {2:.0f} reads/second).".format(
-                        n_rec, dT, rate
-                    )
-                )
-                t1 = t2
 
-        out.close()
-        # by the time None pops from the queue, all chunks
-        # should have been processed!
-        if not abort_flag.value:
-            assert len(heap) == 0
-        else:
-            logger.warning(
-                f"{len(heap)} chunks remained on the heap due to missing data upon abort."
-            )
+def opseq_local_align(seq, **kw):
+    return opseq_align_batch([seq], **kw)[0]
+
 
-        dT = time.time() - t0
-        logger.info(
-            "finished processing {0} reads in {1:.0f} seconds (average {2:.0f} reads/second)".format(
-                n_rec, dT, n_rec / dT
+def write_results(results, args, rates=None):
+    """
+    Sink for parallel_map(): writes the chunks of output records, as
+    produced by the workers, in order. Returns the number of records.
+    """
+    logger = logging.getLogger("collector")
+    out = Output(args)
+    t0 = time.time()
+    t1 = t0
+    n_rec = 0
+    for chunk in results:
+        t_write = time.time()
+        n = out.write_chunk(chunk)
+        n_rec += n
+        if rates:
+            rates.add("collector", n, time.time() - t_write)
+
+        # debug output on average throughput
+        t2 = time.time()
+        if t2 - t1 > 30:
+            dT = t2 - t0
+            rate = n_rec / dT
+            logger.info(
+                "processed {0} reads in {1:.0f} seconds (average {2:.0f} reads/second).".format(
+                    n_rec, dT, rate
+                )
             )
+            if rates:
+                logger.info(rates.report(n_workers=args.parallel))
+            t1 = t2
+
+    out.close()
+    dT = time.time() - t0
+    logger.info(
+        "finished processing {0} reads in {1:.0f} seconds (average {2:.0f} reads/second)".format(
+            n_rec, dT, n_rec / dT
         )
+    )
+    if rates:
+        logger.info(rates.report(n_workers=args.parallel))
+
+    return n_rec
 
 
-def process_fastq(Qfq, args, Qerr, abort_flag):
+def fastq_chunks(args, rates=None):
     """
-    reads from two fastq files, groups the input into chunks for
-    faster parallel processing, and puts these on a mp.Queue()
+    Source for parallel_map(): reads from two fastq files and groups the
+    input into chunks for faster parallel processing. With
+    --transport=raw, chunks are blocks of unparsed FASTQ bytes.
     """
-    with ExceptionLogging("dispatcher", Qerr=Qerr, exc_flag=abort_flag) as el:
-        for chunk in chunkify(read_source(args)):
-            logging.debug(f"placing {chunk[0]} {len(chunk[1])} in queue")
-            if put_or_abort(Qfq, chunk, abort_flag):
-                el.logger.warning("shutdown flag was raised!")
-                break
-
+    if args.transport == "raw":
+        src = raw_source(args)
+    else:
+        src = chunkify(read_source(args), n_chunk=args.chunk_size)
 
-def count_dict_sum(sources):
-    dst = defaultdict(float)
-    for src in sources:
-        for k, v in src.items():
-            dst[k] += v
+    t0 = time.time()
+    for n_chunk, chunk in src:
+        if args.transport == "raw":
+            n = chunk[0].count(b"\n") // 4
+        else:
+            n = len(chunk)
 
-    return dst
+        if rates:
+            rates.add("dispatcher", n, time.time() - t0)
 
+        logging.debug(f"dispatching chunk {n_chunk} of {n} reads")
+        yield chunk
+        t0 = time.time()
 
-def dict_merge(sources):
-    dst = {}
-    for src in sources:
-        dst.update(src)
-    return dst
 
+def process_combinatorial(chunks, args, shared1=None, shared2=None, rates=None):
+    """
+    Worker for parallel_map(): assigns combinatorial barcodes to chunks of
+    reads and yields the output records. Returns counts and, with
+    --update-cache, the alignment cache contents.
+    """
+    logger = logging.getLogger("worker")
+    logger.debug(f"process_combinatorial starting up with args={args}")
+    threshold = None if args.no_seed_index else args.threshold
+    # the caches were pre-populated by the main process
+    bc1_matcher = TieBreaker(
+        args.bc1_ref, place="left", threshold=threshold, shared=shared1
+    )
+    bc2_matcher = TieBreaker(
+        args.bc2_ref, place="right", threshold=threshold, shared=shared2
+    )
 
-def process_combinatorial(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
-    with ExceptionLogging("worker", Qerr=Qerr, exc_flag=abort_flag) as el:
-        el.logger.debug(
-            f"process_combinatorial starting up with Qfq={Qfq}, Qres={Qres} and args={args}"
+    out = Output(args, open_files=False)
+    N = defaultdict(int)
+    for reads in chunks:
+        t0 = time.time()
+        reads = unpack_reads(reads)
+        logger.debug(f"received chunk of {len(reads)} reads")
+        # align opseq sequence to seq of read1
+        alns = opseq_align_batch(
+            [r1.rstrip() for fqid, r1, fqid2, r2, qual2 in reads],
+            opseq=args.opseq,
+            min_opseq_score=args.min_opseq_score,
+            allow_end_gap=True,  # TODO more permanent fix for this quick'n'dirty hack to get short illumina read to work
         )
-        bc1_matcher = TieBreaker(args.bc1_ref, place="left")
-        bc2_matcher = TieBreaker(args.bc2_ref, place="right")
-        bc1_matcher.load_cache(args.bc1_cache)
-        bc2_matcher.load_cache(args.bc2_cache)
+        # score all BC1 candidates of this chunk in one go
+        bc1_queries = []
+        for res, tstart, tend in alns:
+            if res is not None:
+                bc1_queries.extend(get_bc1_choices(res.seqB, res.start, tstart))
+        bc1_matcher.prefetch(bc1_queries)
 
-        out = Output(args, open_files=False)
-        N = defaultdict(int)
-        for n_chunk, reads in queue_iter(Qfq, abort_flag):
-            el.logger.debug(f"received chunk {n_chunk} of {len(reads)} reads")
-            results = []
-            for fqid, r1, fqid2, r2, qual2 in reads:
-                N["total"] += 1
-                out_d = dict(qname=fqid, r1=r1, r2=r2, r2_qual=qual2, r2_qname=fqid2)
-                # fallback values for bc1/bc2 so that some BC diversity
-                # is maintained for debugging purposes in case we can not
-                # assign a decent & unambiguous match
-                # lower case bc is for original, uncorrected sequence
-                out_d["bc1"] = r1[:12]
-                out_d["bc2"] = r2[-12:]
-                # upper case BC is for assigned, corrected sequence
-                out_d["BC1"] = args.na
-                out_d["BC2"] = args.na
-
-                # align opseq sequence to seq of read1
-                aln = opseq_local_align(
-                    r1.rstrip(),
-                    opseq=args.opseq,
-                    min_opseq_score=args.min_opseq_score,
-                    allow_end_gap=True,  # TODO more permanent fix for this quick'n'dirty hack to get short illumina read to work
+        results = []
+        for (fqid, r1, fqid2, r2, qual2), aln in zip(reads, alns):
+            N["total"] += 1
+            out_d = dict(qname=fqid, r1=r1, r2=r2, r2_qual=qual2, r2_qname=fqid2)
+            # fallback values for bc1/bc2 so that some BC diversity
+            # is maintained for debugging purposes in case we can not
+            # assign a decent & unambiguous match
+            # lower case bc is for original, uncorrected sequence
+            out_d["bc1"] = r1[:12]
+            out_d["bc2"] = r2[-12:]
+            # upper case BC is for assigned, corrected sequence
+            out_d["BC1"] = args.na
+            out_d["BC2"] = args.na
+
+            res, tstart, tend = aln
+            # print("OPSEQ", res, tstart, tend)
+            if res is None:
+                N["opseq_broken"] += 1
+                assigned = False
+            else:
+                # identify barcodes
+                bc1, BC1, ref1, score1 = match_BC1(
+                    bc1_matcher,
+                    res.seqB,
+                    res.start,
+                    tstart,
+                    N,
+                    threshold=args.threshold,
                 )
-                res, tstart, tend = aln
-                # print("OPSEQ", res, tstart, tend)
-                if res is None:
-                    N["opseq_broken"] += 1
-                    assigned = False
+                # bc2, BC2, ref2, score2 = match_BC2(
+                #     bc2_matcher, res.seqB, res.end, tend, N, threshold=args.threshold
+                # )
+                bc2, BC2, ref2, score2 = "na", "NA", "na", -1
+
+                # slo = sQSeq.lower()
+                # sout = slo[:qstart] + sQSeq[qstart:qend] + slo[qend:]
+                # print(sout, qstart, qend, tstart, tend, bc1, bc2)
+                # print(f"bc1: {bc1} -> {ref1} -> {BC1} score={50.0*score1/len(bc1):.1f} %")
+                # print(f"bc2: {bc2} -> {ref2} -> {BC2} score={50.0*score2/len(bc2):.1f} %")
+
+                # best matching pieces of sequence
+                out_d["bc1"] = bc1
+                out_d["bc2"] = bc2
+                # best attempt at assignment
+                out_d["BC1"] = BC1
+                out_d["BC2"] = BC2
+
+                if BC1 != NO_CALL:  # and BC2 != NO_CALL:
+                    N["called"] += 1
+                    assigned = True
                 else:
-                    # identify barcodes
-                    bc1, BC1, ref1, score1 = match_BC1(
-                        bc1_matcher,
-                        res.seqB,
-                        res.start,
-                        tstart,
-                        N,
-                        threshold=args.threshold,
-                    )
-                    # bc2, BC2, ref2, score2 = match_BC2(
-                    #     bc2_matcher, res.seqB, res.end, tend, N, threshold=args.threshold
-                    # )
-                    bc2, BC2, ref2, score2 = "na", "NA", "na", -1
-
-                    # slo = sQSeq.lower()
-                    # sout = slo[:qstart] + sQSeq[qstart:qend] + slo[qend:]
-                    # print(sout, qstart, qend, tstart, tend, bc1, bc2)
-                    # print(f"bc1: {bc1} -> {ref1} -> {BC1} score={50.0*score1/len(bc1):.1f} %")
-                    # print(f"bc2: {bc2} -> {ref2} -> {BC2} score={50.0*score2/len(bc2):.1f} %")
-
-                    # best matching pieces of sequence
-                    out_d["bc1"] = bc1
-                    out_d["bc2"] = bc2
-                    # best attempt at assignment
-                    out_d["BC1"] = BC1
-                    out_d["BC2"] = BC2
-
-                    if BC1 != NO_CALL:  # and BC2 != NO_CALL:
-                        N["called"] += 1
-                        assigned = True
-                    else:
-                        assigned = False
+                    assigned = False
 
-                out_d["assigned"] = assigned
-                rec = out.make_record(**out_d)
-                results.append((assigned, rec))
+            out_d["assigned"] = assigned
+            rec = out.make_record(**out_d)
+            results.append((assigned, rec))
 
-            Qres.put((n_chunk, results))
+        results = out.pack(results)
+        if rates:
+            rates.add("workers", len(reads), time.time() - t0)
 
-        N["BC1_cache_hit"] = bc1_matcher.n_hit
-        N["BC2_cache_hit"] = bc2_matcher.n_hit
+        yield results
 
-        # return our counts and observations
-        # via these list proxies
-        el.logger.debug("synchronizing cache and counts")
-        Ns, qcaches1, qcaches2, qcounts1, qcounts2, bccounts1, bccounts2 = stat_lists
-        Ns.append(N)
-        qcaches1.append(bc1_matcher.cache)
-        qcaches2.append(bc2_matcher.cache)
-        qcounts1.append(bc1_matcher.query_count)
-        qcounts2.append(bc2_matcher.query_count)
-        bccounts1.append(bc1_matcher.bc_count)
-        bccounts2.append(bc2_matcher.bc_count)
+    N["BC1_cache_hit"] = bc1_matcher.n_hit
+    N["BC2_cache_hit"] = bc2_matcher.n_hit
+    # how many alignments could be resolved by the seed index alone
+    N["BC1_seed_hit"] = bc1_matcher.matcher.n_seed_hit
+    N["BC2_seed_hit"] = bc2_matcher.matcher.n_seed_hit
+    N["BC1_seed_fallback"] = bc1_matcher.matcher.n_seed_fallback
+    N["BC2_seed_fallback"] = bc2_matcher.matcher.n_seed_fallback
 
+    # return our counts and observations
+    stats = dict(N=N, bccount1=bc1_matcher.bc_count, bccount2=bc2_matcher.bc_count)
+    if args.update_cache:
+        # the shared caches are already visible to the main process.
+        # Only local leftovers and compact query counts need to be sent.
+        stats["qcache1"] = bc1_matcher.cache
+        stats["qcache2"] = bc2_matcher.cache
+        stats["qcount1"] = shared1.encode_counts(bc1_matcher.query_count)
+        stats["qcount2"] = shared2.encode_counts(bc2_matcher.query_count)
 
-def log_qerr(qerr):
-    "helper function for reporting errors in sub processes"
-    for name, lines in qerr:
-        for line in lines:
-            logging.error(f"subprocess {name} exception {line}")
+    return stats
 
 
 def main_combinatorial(args):
-
-    # queues for communication between processes
-    Qfq = mp.Queue(
-        args.parallel * 5
-    )  # FASTQ reads from process_fastq->process_combinatorial
-    Qres = mp.Queue(
-        args.parallel * 25
-    )  # extracted BCs from process_combinatorial->collector
-    Qerr = mp.Queue()  # child-processes can report errors back to the main process here
-
-    # Proxy objects to allow workers to report statistics about the run
-    manager = mp.Manager()
-    abort_flag = mp.Value("b")
-    abort_flag.value = False
-    qcaches1 = manager.list()
-    qcaches2 = manager.list()
-    qcounts1 = manager.list()
-    qcounts2 = manager.list()
-    bccounts1 = manager.list()
-    bccounts2 = manager.list()
-    Ns = manager.list()
-    stat_lists = [Ns, qcaches1, qcaches2, qcounts1, qcounts2, bccounts1, bccounts2]
-
-    with ExceptionLogging("main_combinatorial", exc_flag=abort_flag) as el:
-
-        # read FASTQ in chunks and put them in Qfq
-        dispatcher = mp.Process(
-            target=process_fastq, name="dispatcher", args=(Qfq, args, Qerr, abort_flag)
-        )
-
-        dispatcher.start()
-        el.logger.info("Started dispatch")
-
-        # workers consume chunks of FASTQ from Qfq,
-        # process them, and put the results in Qres
-        workers = []
-        for i in range(args.parallel):
-            w = mp.Process(
-                target=process_combinatorial,
-                name=f"worker_{i}",
-                args=(Qfq, Qres, args, Qerr, abort_flag, stat_lists),
-            )
-            w.start()
-            workers.append(w)
-
-        el.logger.info("Started workers")
-        collector = mp.Process(
-            target=process_ordered_results,
-            name="output",
-            args=(Qres, args, Qerr, abort_flag),
-        )
-        collector.start()
-        el.logger.info("Started collector")
-        # wait until all sequences have been thrown onto Qfq
-        qfq, qerr = join_with_empty_queues(dispatcher, [Qfq, Qerr], abort_flag)
-        el.logger.info("The dispatcher exited")
-        if qfq or qerr:
-            el.logger.info(f"{len(qfq)} chunks were drained from Qfq upon abort.")
-            log_qerr(qerr)
-
-        # signal all workers to finish
-        el.logger.info("Signalling all workers to finish")
-        for n in range(args.parallel):
-            Qfq.put(None)  # each worker consumes exactly one None
-
-        for w in workers:
-            # make sure all results are on Qres by waiting for
-            # workers to exit. Or, empty queues if aborting.
-            qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
-            if qres or qerr:
-                el.logger.info(f"{len(qres)} chunks were drained from Qres upon abort.")
-                log_qerr(qerr)
-
-        el.logger.info(
-            "All worker processes have joined. Signalling collector to finish."
+    # alignment caches in shared memory, filled by all workers together
+    shared1 = SharedAlignmentCache.from_fasta(args.bc1_ref, size=args.cache_size)
+    shared2 = SharedAlignmentCache.from_fasta(args.bc2_ref, size=args.cache_size)
+    shared1.load(args.bc1_cache)
+    shared2.load(args.bc2_cache)
+
+    rates = StageRates()
+
+    with ExceptionLogging("main_combinatorial") as el:
+        check_transport(args)
+        _, stats, n_rec = parallel_map(
+            partial(fastq_chunks, args, rates=rates),
+            partial(
+                process_combinatorial,
+                args=args,
+                shared1=shared1,
+                shared2=shared2,
+                rates=rates,
+            ),
+            partial(write_results, args=args, rates=rates),
+            n_workers=args.parallel,
+            name="main_combinatorial",
         )
-        # signal the collector to stop
-        Qres.put(None)
+        el.logger.info("All processes have joined. Merging worker statistics.")
 
-        # and wait until all output has been generated
-        collector.join()
-        el.logger.info("Collector has joined. Merging worker statistics.")
-
-        N = count_dict_sum(Ns)
+        N = count_dict_sum([st["N"] for st in stats])
         if N["total"]:
             el.logger.info(
                 f"Run completed. Overall combinatorial barcode assignment "
                 f"rate was {100.0 * N['called']/N['total']}"
             )
+            for bc in ["BC1", "BC2"]:
+                n_seed = N[f"{bc}_seed_hit"] + N[f"{bc}_seed_fallback"]
+                if n_seed:
+                    el.logger.info(
+                        f"{bc} seed index resolved {100.0 * N[f'{bc}_seed_hit']/n_seed:.2f} % "
+                        f"of {n_seed} alignments without exhaustive scan"
+                    )
         else:
             el.logger.error("No reads were processed!")
 
+        for bc, shared in [("BC1", shared1), ("BC2", shared2)]:
+            el.logger.info(
+                f"{bc} shared alignment cache holds {len(shared)} queries "
+                f"({100.0 * len(shared)/shared.capacity:.2f} % of capacity)"
+            )
+
         if args.update_cache:
-            qcount1 = count_dict_sum(qcounts1)
-            qcount2 = count_dict_sum(qcounts2)
-            cache1 = dict_merge(qcaches1)
-            cache2 = dict_merge(qcaches2)
-            store_cache(args.bc1_cache, cache1, qcount1)
-            store_cache(args.bc2_cache, cache2, qcount2)
+            for fname, shared, i in [
+                (args.bc1_cache, shared1, 1),
+                (args.bc2_cache, shared2, 2),
+            ]:
+                qcounts = [st[f"qcount{i}"] for st in stats]
+                shared.store(
+                    fname,
+                    [(k, c) for k, c, rest in qcounts],
+                    [st[f"qcache{i}"] for st in stats],
+                    [rest for k, c, rest in qcounts],
+                )
 
         if args.save_stats:
-            bccount1 = count_dict_sum(bccounts1)
-            bccount2 = count_dict_sum(bccounts2)
+            bccount1 = count_dict_sum([st["bccount1"] for st in stats])
+            bccount2 = count_dict_sum([st["bccount2"] for st in stats])
             with open(args.save_stats, "w") as f:
                 for k, v in sorted(N.items()):
                     f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
@@ -653,18 +1236,110 @@ def main_combinatorial(args):
                     )
 
 
-def process_dropseq(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
-    with ExceptionLogging("worker", Qerr=Qerr, exc_flag=abort_flag) as el:
-        el.logger.debug(
-            f"process_dropseq starting up with Qfq={Qfq}, Qres={Qres} and args={args}"
+def process_dropseq(chunks, args, rates=None):
+    """
+    Worker for parallel_map(): extracts cell barcode and UMI from chunks of
+    reads and yields the output records. Returns counts.
+    """
+    logging.getLogger("worker").debug(f"process_dropseq starting up with args={args}")
+    out = Output(args, open_files=False)
+    N = defaultdict(int)
+    for reads in chunks:
+        t0 = time.time()
+        reads = unpack_reads(reads)
+        results = []
+        extracted = out.format_batch(reads)
+        for (fqid, r1, fqid2, r2, qual2), (raw, cell, UMI) in zip(reads, extracted):
+            N["total"] += 1
+            rec = out.make_record(
+                assigned=True,
+                qname=fqid,
+                r1=r1,
+                r2=r2,
+                r2_qual=qual2,
+                r2_qname=fqid2,
+                raw=raw,
+                cell=cell,
+                UMI=UMI,
+            )
+            results.append((True, rec))
+
+        results = out.pack(results)
+        if rates:
+            rates.add("workers", len(reads), time.time() - t0)
+
+        yield results
+
+    return dict(N=N, cb_counts=out.raw_cb_counts)
+
+
+def main_dropseq(args):
+    if args.streaming:
+        return main_dropseq_streaming(args)
+
+    rates = StageRates()
+    with ExceptionLogging("main_dropseq") as el:
+        check_transport(args)
+        _, stats, n_rec = parallel_map(
+            partial(fastq_chunks, args, rates=rates),
+            partial(process_dropseq, args=args, rates=rates),
+            partial(write_results, args=args, rates=rates),
+            n_workers=args.parallel,
+            name="main_dropseq",
         )
-        out = Output(args, open_files=False)
+        el.logger.info("All processes have joined. Merging worker statistics.")
+
+        N = count_dict_sum([st["N"] for st in stats])
+        cb_count = PackedCounter()
+        for st in stats:
+            cb_count.merge(st["cb_counts"])
+
+        store_dropseq_results(args, N, cb_count, el.logger)
+
+    return N
+
+
+def store_dropseq_results(args, N, cb_count, logger):
+    if N["total"]:
+        logger.info(f"Run completed, {N['total']} reads processed.")
+    else:
+        logger.error("No reads were processed!")
+
+    if args.save_cell_barcodes:
+        cb_count.write(args.save_cell_barcodes)
+
+    if args.save_stats:
+        with open(args.save_stats, "w") as f:
+            for k, v in sorted(N.items()):
+                f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
+
+
+def main_dropseq_streaming(args):
+    """
+    Single-process version of main_dropseq(). Without barcode matching,
+    there is so little work per read that shipping reads between processes
+    costs more than it saves. Instead, decompression of the input runs in
+    unpigz subprocesses and BGZF compression of the output in threads
+    (see BGZFWriter), while this process only parses reads, slices out
+    cell barcodes and UMIs and builds the BAM records.
+    """
+    with ExceptionLogging("main_dropseq_streaming") as el:
+        check_transport(args)
+        if args.transport == "raw":
+            src = raw_source(args, threads=max(args.parallel // 2, 1))
+        else:
+            src = chunkify(read_source(args), n_chunk=args.chunk_size)
+
+        out = Output(args)
         N = defaultdict(int)
-        for n_chunk, reads in queue_iter(Qfq, abort_flag):
-            el.logger.debug(f"received chunk {n_chunk} of {len(reads)} reads")
+        t0 = time.time()
+        t1 = t0
+        for n_chunk, reads in src:
+            reads = unpack_reads(reads)
             results = []
-            for fqid, r1, fqid2, r2, qual2 in reads:
-                N["total"] += 1
+            for (fqid, r1, fqid2, r2, qual2), (raw, cell, UMI) in zip(
+                reads, out.format_batch(reads)
+            ):
                 rec = out.make_record(
                     assigned=True,
                     qname=fqid,
@@ -672,121 +1347,26 @@ def process_dropseq(Qfq, Qres, args, Qerr, abort_flag, stat_lists):
                     r2=r2,
                     r2_qual=qual2,
                     r2_qname=fqid2,
+                    raw=raw,
+                    cell=cell,
+                    UMI=UMI,
                 )
                 results.append((True, rec))
 
-            Qres.put((n_chunk, results))
-
-        # return our counts and observations
-        # via these list proxies
-        el.logger.debug("synchronizing cache and counts")
-        Ns = stat_lists[0]
-        Ns.append(N)
-
-        cb_counts = stat_lists[1]
-        cb_counts.append(out.raw_cb_counts)
+            N["total"] += out.write_chunk(out.pack(results))
 
+            t2 = time.time()
+            if t2 - t1 > 30:
+                el.logger.info(
+                    f"processed {N['total']} reads in {t2 - t0:.0f} seconds "
+                    f"(average {N['total'] / (t2 - t0):.0f} reads/second)."
+                )
+                t1 = t2
 
-def main_dropseq(args):
-    # queues for communication between processes
-    Qfq = mp.Queue(
-        args.parallel * 5
-    )  # FASTQ reads from process_fastq->process_combinatorial
-    Qres = mp.Queue(
-        args.parallel * 25
-    )  # extracted BCs from process_combinatorial->collector
-    Qerr = mp.Queue()  # child-processes can report errors back to the main process here
-
-    # Proxy objects to allow workers to report statistics about the run
-    manager = mp.Manager()
-    abort_flag = mp.Value("b")
-    abort_flag.value = False
-    Ns = manager.list()
-    cb_counts = manager.list()
-    stat_lists = [Ns, cb_counts]
-
-    with ExceptionLogging("main_dropseq", exc_flag=abort_flag) as el:
-
-        # read FASTQ in chunks and put them in Qfq
-        dispatcher = mp.Process(
-            target=process_fastq, name="dispatcher", args=(Qfq, args, Qerr, abort_flag)
-        )
-
-        dispatcher.start()
-        el.logger.info("Started dispatch")
-
-        # workers consume chunks of FASTQ from Qfq,
-        # process them, and put the results in Qres
-        workers = []
-        for i in range(args.parallel):
-            w = mp.Process(
-                target=process_dropseq,
-                name=f"worker_{i}",
-                args=(Qfq, Qres, args, Qerr, abort_flag, stat_lists),
-            )
-            w.start()
-            workers.append(w)
-
-        el.logger.info("Started workers")
-        collector = mp.Process(
-            target=process_ordered_results,
-            name="output",
-            args=(Qres, args, Qerr, abort_flag),
-        )
-        collector.start()
-        el.logger.info("Started collector")
-        # wait until all sequences have been thrown onto Qfq
-        qfq, qerr = join_with_empty_queues(dispatcher, [Qfq, Qerr], abort_flag)
-        el.logger.info("The dispatcher exited")
-        if qfq or qerr:
-            el.logger.info(f"{len(qfq)} chunks were drained from Qfq upon abort.")
-            log_qerr(qerr)
-
-        # signal all workers to finish
-        el.logger.info("Signalling all workers to finish")
-        for n in range(args.parallel):
-            Qfq.put(None)  # each worker consumes exactly one None
-
-        for w in workers:
-            # make sure all results are on Qres by waiting for
-            # workers to exit. Or, empty queues if aborting.
-            qres, qerr = join_with_empty_queues(w, [Qres, Qerr], abort_flag)
-            if qres or qerr:
-                el.logger.info(f"{len(qres)} chunks were drained from Qres upon abort.")
-                log_qerr(qerr)
-
-        el.logger.info(
-            "All worker processes have joined. Signalling collector to finish."
-        )
-        # signal the collector to stop
-        Qres.put(None)
-
-        # and wait until all output has been generated
-        collector.join()
-        el.logger.info("Collector has joined. Merging worker statistics.")
-
-        N = count_dict_sum(Ns)
-        if N["total"]:
-            el.logger.info(f"Run completed, {N['total']} reads processed.")
-        else:
-            el.logger.error("No reads were processed!")
-        # el.logger.debug(print(str(N.keys())[:200]))
-        cb_count = count_dict_sum(cb_counts)
-        if args.save_cell_barcodes:
-            el.logger.info(
-                f"writing {len(cb_count)} barcode counts to '{args.save_cell_barcodes}'"
-            )
-            import gzip
-
-            with gzip.open(args.save_cell_barcodes, "wt") as f:
-                f.write("cell_bc\traw_read_count\n")
-                for bc, count in sorted(cb_count.items()):
-                    f.write(f"{bc}\t{count}\n")
-
-        if args.save_stats:
-            with open(args.save_stats, "w") as f:
-                for k, v in sorted(N.items()):
-                    f.write(f"freq\t{k}\t{v}\t{100.0 * v/max(N['total'], 1):.2f}\n")
+        out.close()
+        # same number formatting as the merged worker counts
+        N = count_dict_sum([N])
+        store_dropseq_results(args, N, out.raw_cb_counts, el.logger)
 
     return N
 
@@ -805,18 +1385,35 @@ class Output:
         self.f_cell_raw = compile(self.cell_raw, "<string cell_raw>", "eval")
         self.f_cell = compile(self.cell, "<string cell>", "eval")
         self.f_UMI = compile(self.UMI, "<string UMI>", "eval")
+        # extraction plans are faster still. None if we need eval()
+        self.p_cell_raw = compile_expression(self.cell_raw)
+        self.p_cell = compile_expression(self.cell)
+        self.p_UMI = compile_expression(self.UMI)
+        self.plans = [self.p_cell_raw, self.p_cell, self.p_UMI]
+        self.batchable = all([p is not None and p.batchable for p in self.plans])
 
         self.fq_qual = args.fq_qual
         self.bc_na = args.na
-        self.raw_cb_counts = defaultdict(int)
+        self.raw_cb_counts = PackedCounter()
         self.count_cb = bool(args.save_cell_barcodes)
 
         self.tags = []
         for tag in args.bam_tags.split(","):
             self.tags.append(tag.split(":"))
 
+        # with raw transport, workers pack records of a chunk into bytes,
+        # which the collector writes without any further processing
+        self.binary = args.transport == "raw"
+        self.same_out = args.out_unassigned == args.out_assigned
+        self.out_format = args.out_format
+        self.compression_level = args.compression_level
+        self.compression_threads = args.compression_threads
+
         if args.out_format == "fastq":
-            fopen = lambda x: open(x, "w")
+            if self.binary:
+                fopen = lambda x: open(x, "wb")
+            else:
+                fopen = lambda x: open(x, "w")
             self._write_record = self.write_fastq
             self._make_record = self.make_fastq_record
 
@@ -838,7 +1435,7 @@ class Output:
                 ],
             }
             self.bam_header = pysam.AlignmentHeader.from_dict(header)
-            fopen = lambda x: pysam.AlignmentFile(x, "wbu", header=header)
+            fopen = self.open_bam
             self._write_record = self.write_bam
             self._make_record = self.make_bam_record
         else:
@@ -846,7 +1443,7 @@ class Output:
 
         if open_files:
             self.out_assigned = fopen(args.out_assigned)
-            if args.out_unassigned != args.out_assigned:
+            if not self.same_out:
                 self.out_unassigned = fopen(args.out_unassigned)
             else:
                 self.out_unassigned = self.out_assigned
@@ -860,18 +1457,28 @@ class Output:
             return True
 
     def make_bam_record(self, **kw):
-        # sys.stderr.write(f"r2_qual={r2_qual}\n")
-        a = pysam.AlignedSegment(self.bam_header)
+        # binary BAM record, ready to be written. No detour via
+        # pysam.AlignedSegment and SAM text.
         # STAR does not like spaces in read names so we have to split
-        a.query_name = kw["r2_qname"].split()[0]
-        a.query_sequence = kw["r2"]
-        a.flag = 4
-        a.query_qualities = pysam.qualitystring_to_array(kw["r2_qual"])
-        a.tags = [(name, templ.format(**kw)) for name, templ in self.tags]
+        rec = encode_unaligned(
+            kw["r2_qname"].split()[0],
+            kw["r2"],
+            kw["r2_qual"],
+            [(name, templ.format(**kw)) for name, templ in self.tags],
+        )
         if self.count_cb:
-            self.raw_cb_counts[kw["cell"]] += 1
+            self.raw_cb_counts.add(kw["cell"])
 
-        return a.to_string()
+        return rec
+
+    def open_bam(self, fname):
+        # level 0 is the same as pysam's "wbu" (uncompressed BAM)
+        return BAMWriter(
+            fname,
+            self.bam_header,
+            level=self.compression_level,
+            threads=self.compression_threads,
+        )
 
     def make_fastq_record(self, **kw):
         seq = kw["cell"] + kw["UMI"]
@@ -879,12 +1486,14 @@ class Output:
         return f"@{kw['qname']}\n{seq}\n+\n{qual}\n"
 
     def make_record(self, assigned=True, **kw):
-        kw["raw"], kw["cell"], kw["UMI"] = self.format(**kw)
+        if not "cell" in kw:
+            # not already extracted by format_batch()
+            kw["raw"], kw["cell"], kw["UMI"] = self.format(**kw)
         kw["assigned"] = "A" if assigned else "U"
         return self._make_record(**kw)
 
     def write_bam(self, out, rec):
-        out.write(pysam.AlignedSegment.fromstring(rec, self.bam_header))
+        out.write(rec)
 
     def write_fastq(self, out, rec):
         out.write(rec)
@@ -895,6 +1504,44 @@ class Output:
         else:
             self._write_record(self.out_unassigned, record)
 
+    def pack(self, results):
+        """
+        With raw transport, turn the list of (assigned, record) of one chunk
+        into (n_records, assigned bytes, unassigned bytes). If both go to
+        the same output everything is kept in one blob to preserve the order.
+        """
+        if not self.binary:
+            return results
+
+        if self.out_format == "bam":
+            join = b"".join
+        else:
+            join = lambda recs: "".join(recs).encode("ascii")
+
+        if self.same_out:
+            return len(results), join([rec for assigned, rec in results]), b""
+
+        return (
+            len(results),
+            join([rec for assigned, rec in results if assigned]),
+            join([rec for assigned, rec in results if not assigned]),
+        )
+
+    def write_chunk(self, results):
+        "write all records of a chunk and return how many there were"
+        if not self.binary:
+            for assigned, record in results:
+                self.write(assigned, record)
+
+            return len(results)
+
+        n, assigned, unassigned = results
+        self.out_assigned.write(assigned)
+        if unassigned:
+            self.out_unassigned.write(unassigned)
+
+        return n
+
     def format(
         self,
         qname="qname1",
@@ -914,26 +1561,72 @@ class Output:
         if BC2 is None:
             BC2 = self.na
 
+        values = dict(
+            qname=qname,
+            r2_qname=r2_qname,
+            r2_qual=r2_qual,
+            bc1=bc1,
+            bc2=bc2,
+            BC1=BC1,
+            BC2=BC2,
+            r1=r1,
+            r2=r2,
+        )
         # slightly concerned about security here...
         # at least all () and ; raise an assertion in __init__
-        cell = eval(self.f_cell)
-        raw = eval(self.f_cell_raw)
-        UMI = eval(self.f_UMI)
-        # cell = eval(self.cell)
-        # raw = eval(self.cell_raw)
-        # UMI = eval(self.UMI)
+        if self.p_cell is not None:
+            cell = self.p_cell.extract(values)
+        else:
+            cell = eval(self.f_cell)
 
+        if self.p_cell_raw is not None:
+            raw = self.p_cell_raw.extract(values)
+        else:
+            raw = eval(self.f_cell_raw)
+
+        if self.p_UMI is not None:
+            UMI = self.p_UMI.extract(values)
+        else:
+            UMI = eval(self.f_UMI)
+
+        self.check_format(cell, UMI)
+        return raw, cell, UMI
+
+    def check_format(self, cell, UMI):
         if (cell is None) or (UMI is None):
             raise ValueError(
                 f"one of cell=eval('{self.cell}')='{cell}' "
                 f"UMI=eval('{self.UMI}')='{UMI}' evaluated to None"
             )
 
-        return raw, cell, UMI
+    def format_batch(self, reads):
+        """
+        (raw, cell, UMI) for a chunk of (fqid, r1, fqid2, r2, qual2) tuples.
+        If the expressions only use r1/r2 and the reads have equal length,
+        all of them are extracted at once from byte matrices.
+        """
+        if self.batchable and reads:
+            variables = set.union(*[p.variables for p in self.plans])
+            matrices = {}
+            if "r1" in variables:
+                matrices["r1"] = read_matrix([r[1] for r in reads])
+            if "r2" in variables:
+                matrices["r2"] = read_matrix([r[3] for r in reads])
+
+            if matrices and all([M is not None for M in matrices.values()]):
+                raw, cell, UMI = [p.extract_batch(matrices) for p in self.plans]
+                self.check_format(cell[0], UMI[0])
+                return list(zip(raw, cell, UMI))
+
+        return [
+            self.format(qname=fqid, r2_qname=fqid2, r2_qual=qual2, r1=r1, r2=r2)
+            for fqid, r1, fqid2, r2, qual2 in reads
+        ]
 
     def close(self):
         self.out_assigned.close()
-        self.out_unassigned.close()
+        if not self.same_out:
+            self.out_unassigned.close()
 
 
 # class Process(mp.Process):
@@ -1062,6 +1755,49 @@ def parse_args():
     parser.add_argument(
         "--bc2-cache", default="", help="load cached BC2 alignments from here"
     )
+    parser.add_argument(
+        "--no-seed-index",
+        default=False,
+        action="store_true",
+        help="disable the k-mer seed index and always score queries against all reference barcodes (default=False)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=2**21,
+        type=int,
+        help="number of queries that fit into each of the BC1/BC2 alignment caches which are shared by all workers (default=2097152)",
+    )
+    parser.add_argument(
+        "--transport",
+        default="raw",
+        choices=["raw", "records"],
+        help="'raw' sends unparsed FASTQ blocks to the workers and packed output records back to the collector. 'records' sends parsed reads and individual records (default=raw)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=1000,
+        type=int,
+        help="number of reads processed by a worker at a time (default=1000)",
+    )
+    parser.add_argument(
+        "--compression-level",
+        default=0,
+        type=int,
+        help="zlib compression level of BAM output. 0 is uncompressed BAM, e.g. for piping into other tools (default=0)",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        default=4,
+        type=int,
+        help="number of threads compressing BAM output (default=4)",
+    )
+    parser.add_argument(
+        "--no-streaming",
+        dest="streaming",
+        default=True,
+        action="store_false",
+        help="without barcode matching (dropseq, visium, ...), use the multi-process pipeline instead of the single-process streaming mode (default=False)",
+    )
     parser.add_argument(
         "--update-cache",
         default=False,
@@ -1,5 +1,6 @@
 import pysam
 import numpy as np
+import os
 import sys
 import logging
 import argparse
@@ -25,14 +26,15 @@ class AlignmentClassifier:
     def __init__(
         self,
         sample_name,
-        bam_in,
+        bam_in=None,
         gene_assign_mode="chrom",
         chrom_to_gene={},
         ignore_gf=["INTRONIC", "INTERGENIC"],
     ):
         self.logger = logging.getLogger(f"AlignmentClassifier({sample_name})")
         self.sample_name = sample_name
-        self.bam = pysam.AlignmentFile(bam_in, check_sq=False)
+        # without bam_in, alignments from elsewhere can be classify()'ed
+        self.bam = pysam.AlignmentFile(bam_in, check_sq=False) if bam_in else None
         self.gene_names = {}
         self.chrom_to_gene = chrom_to_gene
         self.ignore_gf = set(ignore_gf)
@@ -45,7 +47,7 @@ class AlignmentClassifier:
 
     def fast_refname(self, aln):
         if not aln.tid in self.gene_names:
-            chrom = self.bam.get_reference_name(aln.tid)
+            chrom = aln.reference_name
             gene = self.chrom_to_gene.get(chrom, chrom)
             self.gene_names[aln.tid] = gene
 
@@ -72,11 +74,14 @@ class AlignmentClassifier:
         self.uniq_reads.add(u)
         return u
 
+    def classify(self, aln):
+        return ClassifiedAlignment(
+            self, aln, self.get_gene(aln), is_dup=not self.is_uniq(aln)
+        )
+
     def __iter__(self):
         for aln in self.bam.fetch(until_eof=True):
-            yield ClassifiedAlignment(
-                self, aln, self.get_gene(aln), is_dup=not self.is_uniq(aln)
-            )
+            yield self.classify(aln)
 
 
 class ClassifiedAlignment:
@@ -319,6 +324,472 @@ class DGE:
         ).all()
 
 
+def popcount64(x):
+    "number of set bits of each uint64 in x"
+    return np.unpackbits(x.view(np.uint8)).reshape(len(x), 64).sum(axis=1)
+
+
+def umi_distance(x, Y):
+    """
+    Number of mismatching bases between the packed UMI x and each of the
+    packed UMIs Y (see PackedDGE.pack_umis()). UMIs of different length
+    and those that could not be packed are 64 mismatches apart.
+    """
+    d = Y ^ x
+    # for UMIs of the same length the marker bits cancel out
+    same = (d < Y) & (d < x) & (((Y | x) & PackedDGE.unpacked_flag) == 0)
+    mismatch = (d | (d >> np.uint64(1))) & np.uint64(0x5555555555555555)
+    dist = popcount64(mismatch)
+    dist[~same] = 64
+    return dist
+
+
+def collapse_umis(umis, reads, edit_distance=1):
+    """
+    Number of molecules behind the distinct packed UMIs of one gene in one
+    cell, as Drop-seq tools' DigitalExpression counts them: in order of
+    decreasing read count, each UMI absorbs all remaining UMIs within
+    edit_distance substitutions. Unlike DigitalExpression, which counts an
+    N as one mismatch, UMIs containing N can not be packed and are never
+    merged with any other UMI.
+    """
+    order = np.lexsort((umis, -reads))
+    umis = umis[order]
+    alive = np.ones(len(umis), dtype=bool)
+    n = 0
+    for i in range(len(umis)):
+        if not alive[i]:
+            continue
+
+        n += 1
+        alive[i + 1 :] &= umi_distance(umis[i], umis[i + 1 :]) > edit_distance
+
+    return n
+
+
+class PackedDGE:
+    """
+    Memory-efficient replacement of DGE. Cells, genes and channels are
+    interned to int ids and UMIs are 2-bit packed into uint64 (see
+    spacemake.preprocess.counts.pack_2bit). Reads are collected in a
+    buffer and, once buffer_size are reached, reduced to a sorted run of
+    unique (cell, gene, channel) key and UMI arrays with the number of
+    reads behind each. Like in an LSM tree, a run is only merged with the
+    previous one once that is not much larger, so that each record takes
+    part in a logarithmic number of merges. make_DGEs() builds the same
+    AnnData as DGE.make_DGEs() straight from these arrays.
+
+    With max_mem (bytes) set, the runs in memory are merged and written to
+    disk as one sorted run whenever they outgrow the budget. make_DGEs() then merges the
+    runs block by block, so that memory stays bounded by max_mem plus the
+    size of the final count matrices, whatever the number of reads.
+    """
+
+    # bit layout of the combined key: cell | gene | channel
+    channel_bits = 4
+    gene_bits = 24
+    # packed UMIs carry a marker bit above their 2-bit code, so that UMIs
+    # of different lengths can not collide. UMIs that can not be packed
+    # (N bases, too long) get an id with the top bit set instead.
+    unpacked_flag = np.uint64(1 << 63)
+    # bytes per record in memory: key, umi, reads plus sort temporaries
+    record_size = 64
+    # runs in memory are merged while the older one is at most this many
+    # times larger than the newer one
+    merge_ratio = 2
+
+    def __init__(
+        self, main_channel="count", buffer_size=2**20, max_mem=0, tmp_dir=None
+    ):
+        self.main_channel = main_channel
+        self.buffer_size = buffer_size
+        self.max_mem = max_mem
+        self.tmp_dir = tmp_dir
+        self.tmp = None
+        self.runs = []
+        self.n_spilled = 0
+        if max_mem:
+            # the buffered reads count against the budget as well
+            self.buffer_size = max(
+                min(buffer_size, max_mem // 4 // self.record_size), 1
+            )
+        self.cell_ids = {}
+        self.gene_ids = {}
+        self.channel_ids = {main_channel: 0}
+        self.umi_ids = {}
+        self.buf_keys = []
+        self.buf_umis = []
+        # sorted (keys, umis, reads) runs in memory, from old (large) to new
+        self.mem_runs = []
+
+    @property
+    def channels(self):
+        return set(self.channel_ids.keys())
+
+    def _intern(self, ids, name, bits=None):
+        i = len(ids)
+        if bits is not None and i >= (1 << bits):
+            raise ValueError(
+                f"PackedDGE can not handle more than {1 << bits} of '{name}'"
+            )
+
+        ids[name] = i
+        return i
+
+    def add_read(self, gene, cell, umi, channel="count"):
+        """
+        Same as DGE.add_read(), but PCR duplicates are only resolved when
+        the buffer is flushed and hence not reported.
+        """
+        cell_id = self.cell_ids.get(cell)
+        if cell_id is None:
+            cell_id = self._intern(self.cell_ids, cell)
+
+        gene_id = self.gene_ids.get(gene)
+        if gene_id is None:
+            gene_id = self._intern(self.gene_ids, gene, self.gene_bits)
+
+        channel_id = self.channel_ids.get(channel)
+        if channel_id is None:
+            channel_id = self._intern(self.channel_ids, channel, self.channel_bits)
+
+        self.buf_keys.append(
+            (((cell_id << self.gene_bits) | gene_id) << self.channel_bits) | channel_id
+        )
+        self.buf_umis.append(umi)
+        if len(self.buf_keys) >= self.buffer_size:
+            self.flush()
+
+    def pack_umis(self, umis):
+        "uint64 codes of a list of UMI strings"
+        from spacemake.preprocess.counts import pack_2bit, MAX_PACKED_LEN
+
+        codes = np.empty(len(umis), dtype=np.uint64)
+        lengths = np.array([len(u) for u in umis])
+        for l in np.unique(lengths).tolist():
+            if lengths[0] == l and (lengths == l).all():
+                idx = np.arange(len(umis))
+                group = umis
+            else:
+                idx = np.flatnonzero(lengths == l)
+                group = [umis[i] for i in idx.tolist()]
+
+            ok = np.zeros(len(group), dtype=bool)
+            if 0 < l < MAX_PACKED_LEN:
+                buf = "".join(group).encode("ascii", errors="replace")
+                M = np.frombuffer(buf, dtype=np.uint8).reshape(len(group), l)
+                keys, ok = pack_2bit(M)
+                codes[idx] = keys | (np.uint64(1) << np.uint64(2 * l))
+
+            for j in np.flatnonzero(~ok).tolist():
+                umi = group[j]
+                umi_id = self.umi_ids.get(umi)
+                if umi_id is None:
+                    umi_id = self._intern(self.umi_ids, umi)
+
+                codes[idx[j]] = self.unpacked_flag | np.uint64(umi_id)
+
+        return codes
+
+    @staticmethod
+    def reduce_records(keys, umis, reads):
+        "sorted, unique (key, umi) records with the sum of their reads"
+        order = np.lexsort((umis, keys))
+        keys = keys[order]
+        umis = umis[order]
+        starts = np.flatnonzero(
+            np.r_[True, (keys[1:] != keys[:-1]) | (umis[1:] != umis[:-1])]
+        )
+        return keys[starts], umis[starts], np.add.reduceat(reads[order], starts)
+
+    def merge_mem_runs(self, n):
+        "merge the n newest runs in memory into one"
+        runs = self.mem_runs[-n:]
+        self.mem_runs[-n:] = [
+            self.reduce_records(*[np.concatenate(x) for x in zip(*runs)])
+        ]
+
+    def flush(self):
+        "pack the buffered reads into a new sorted run and merge runs of similar size"
+        if not self.buf_keys:
+            return
+
+        self.mem_runs.append(
+            self.reduce_records(
+                np.array(self.buf_keys, dtype=np.uint64),
+                self.pack_umis(self.buf_umis),
+                np.ones(len(self.buf_keys), dtype=np.int64),
+            )
+        )
+        self.buf_keys = []
+        self.buf_umis = []
+
+        runs = self.mem_runs
+        while len(runs) > 1 and len(runs[-2][0]) <= self.merge_ratio * len(runs[-1][0]):
+            self.merge_mem_runs(2)
+
+        n_records = sum([len(keys) for keys, umis, reads in runs])
+        if self.max_mem and n_records * self.record_size > self.max_mem:
+            self.spill()
+
+    def spill(self):
+        "merge the runs in memory and write them to disk as one sorted run"
+        import tempfile
+
+        if self.tmp is None:
+            self.tmp = tempfile.TemporaryDirectory(
+                prefix="PackedDGE_", dir=self.tmp_dir
+            )
+
+        self.merge_mem_runs(len(self.mem_runs))
+        run = []
+        for name, data in zip(["keys", "umis", "reads"], self.mem_runs.pop()):
+            fname = os.path.join(self.tmp.name, f"run{len(self.runs)}.{name}.npy")
+            np.save(fname, data)
+            run.append(fname)
+
+        self.runs.append(run)
+        self.n_spilled += int(data.sum())
+
+    def __len__(self):
+        "number of reads added"
+        n_mem = sum([int(reads.sum()) for keys, umis, reads in self.mem_runs])
+        return len(self.buf_keys) + n_mem + self.n_spilled
+
+    @staticmethod
+    def count_block(keys, umis, reads, edit_distance=0):
+        """
+        UMI and read counts for each unique key of a block that holds all
+        records of its keys. Copies of the same (key, umi) record from
+        different runs are counted once. With edit_distance > 0, UMIs of the
+        same key are collapsed first (see collapse_umis()).
+        """
+        keys, umis, reads = PackedDGE.reduce_records(keys, umis, reads)
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        umi_counts = np.diff(np.r_[starts, len(keys)])
+        read_counts = np.add.reduceat(reads, starts)
+        if edit_distance:
+            for i in np.flatnonzero(umi_counts > 1).tolist():
+                a = starts[i]
+                b = a + umi_counts[i]
+                umi_counts[i] = collapse_umis(umis[a:b], reads[a:b], edit_distance)
+
+        return keys[starts], umi_counts, read_counts
+
+    def merge_runs(self, edit_distance=0):
+        """
+        k-way merge of the runs on disk and in memory. Each
+        round takes up to one block from every run, but only up to the
+        smallest key among the last records of these blocks (including all
+        of its records), so that all records of a key end up in the same
+        round.
+        """
+        runs = [[np.load(fname, mmap_mode="r") for fname in run] for run in self.runs]
+        runs.extend(self.mem_runs)
+
+        if self.max_mem:
+            block = max(self.max_mem // self.record_size // len(runs), 1024)
+        else:
+            block = self.buffer_size
+
+        pos = [0] * len(runs)
+        results = []
+        while True:
+            active = [i for i, run in enumerate(runs) if pos[i] < len(run[0])]
+            if not active:
+                break
+
+            bound = min(
+                [runs[i][0][min(pos[i] + block, len(runs[i][0])) - 1] for i in active]
+            )
+            parts = []
+            for i in active:
+                keys, umis, reads = runs[i]
+                end = pos[i] + np.searchsorted(keys[pos[i] :], bound, side="right")
+                parts.append(
+                    (
+                        np.asarray(keys[pos[i] : end]),
+                        np.asarray(umis[pos[i] : end]),
+                        np.asarray(reads[pos[i] : end]),
+                    )
+                )
+                pos[i] = end
+
+            block_arrays = [np.concatenate(x) for x in zip(*parts)]
+            results.append(self.count_block(*block_arrays, edit_distance))
+
+        if not results:
+            return [np.zeros(0, dtype=np.uint64)] + [np.zeros(0, dtype=np.int64)] * 2
+
+        return [np.concatenate(x) for x in zip(*results)]
+
+    def counts(self, edit_distance=0):
+        """
+        Unique (cell, gene, channel) keys with their number of distinct
+        UMIs and reads.
+        """
+        self.flush()
+        if self.runs:
+            return self.merge_runs(edit_distance)
+
+        if not self.mem_runs:
+            return [np.zeros(0, dtype=np.uint64)] + [np.zeros(0, dtype=np.int64)] * 2
+
+        self.merge_mem_runs(len(self.mem_runs))
+        keys, umis, reads = self.mem_runs[0]
+        if edit_distance:
+            return self.count_block(keys, umis, reads, edit_distance)
+
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        umi_counts = np.diff(np.r_[starts, len(keys)])
+        read_counts = np.add.reduceat(reads, starts)
+        return keys[starts], umi_counts, read_counts
+
+    def counted(self, edit_distance=0):
+        """
+        counts() together with the names behind the ids. Small enough to be
+        sent back from a worker process (see merge_counted()).
+        """
+        keys, umi_counts, read_counts = self.counts(edit_distance)
+        return dict(
+            main_channel=self.main_channel,
+            cells=list(self.cell_ids.keys()),
+            genes=list(self.gene_ids.keys()),
+            channels=list(self.channel_ids.keys()),
+            keys=keys,
+            umi_counts=umi_counts,
+            read_counts=read_counts,
+        )
+
+    @classmethod
+    def decode_keys(cls, keys):
+        "(cell, gene, channel) id arrays"
+        channel_mask = np.uint64((1 << cls.channel_bits) - 1)
+        gene_mask = np.uint64((1 << cls.gene_bits) - 1)
+        channel = (keys & channel_mask).astype(np.int64)
+        gene = ((keys >> np.uint64(cls.channel_bits)) & gene_mask).astype(np.int64)
+        cell = (keys >> np.uint64(cls.channel_bits + cls.gene_bits)).astype(np.int64)
+        return cell, gene, channel
+
+    @classmethod
+    def encode_keys(cls, cell, gene, channel):
+        keys = cell.astype(np.uint64) << np.uint64(cls.gene_bits)
+        keys |= gene.astype(np.uint64)
+        keys <<= np.uint64(cls.channel_bits)
+        keys |= channel.astype(np.uint64)
+        return keys
+
+    @classmethod
+    def merge_counted(cls, parts):
+        """
+        Combines the counted() results of several PackedDGE instances that
+        have seen disjoint sets of cells (see quant_worker()).
+        """
+        parts = list(parts)
+        main_channel = parts[0]["main_channel"] if parts else "count"
+        cells = []
+        genes = {}
+        channels = {main_channel: 0}
+        merged = defaultdict(list)
+        for part in parts:
+            cell, gene, channel = cls.decode_keys(part["keys"])
+            gene_map = np.array(
+                [genes.setdefault(g, len(genes)) for g in part["genes"]], dtype=np.int64
+            )
+            channel_map = np.array(
+                [channels.setdefault(c, len(channels)) for c in part["channels"]],
+                dtype=np.int64,
+            )
+            if len(genes) > (1 << cls.gene_bits):
+                raise ValueError(
+                    f"PackedDGE can not handle more than {1 << cls.gene_bits} genes"
+                )
+
+            merged["keys"].append(
+                cls.encode_keys(cell + len(cells), gene_map[gene], channel_map[channel])
+            )
+            merged["umi_counts"].append(part["umi_counts"])
+            merged["read_counts"].append(part["read_counts"])
+            cells.extend(part["cells"])
+
+        return dict(
+            main_channel=main_channel,
+            cells=cells,
+            genes=list(genes.keys()),
+            channels=list(channels.keys()),
+            keys=np.concatenate(merged["keys"] or [np.zeros(0, dtype=np.uint64)]),
+            umi_counts=np.concatenate(
+                merged["umi_counts"] or [np.zeros(0, dtype=np.int64)]
+            ),
+            read_counts=np.concatenate(
+                merged["read_counts"] or [np.zeros(0, dtype=np.int64)]
+            ),
+        )
+
+    @staticmethod
+    def ranks(names):
+        "maps int ids to the position of their name in sorted order"
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[np.argsort(np.array(names, dtype=object), kind="stable")] = np.arange(
+            len(names)
+        )
+        return sorted(names), rank
+
+    @classmethod
+    def counted_to_adata(cls, counted):
+        """
+        The AnnData of DGE.make_DGEs() from counted() or merge_counted()
+        results.
+        """
+        import scipy.sparse
+        import anndata
+
+        obs, cell_rank = cls.ranks(counted["cells"])
+        var, gene_rank = cls.ranks(counted["genes"])
+        n_cells = len(obs)
+        n_genes = len(var)
+        cell, gene, channel = cls.decode_keys(counted["keys"])
+        umi_counts = counted["umi_counts"]
+        read_counts = counted["read_counts"]
+
+        # every layer has an entry for each (cell, gene) pair seen in any
+        # channel, just like DGE.make_DGEs(). Ordered by (row, col) this is
+        # the CSR layout already.
+        pair = cell_rank[cell] * n_genes + gene_rank[gene]
+        pairs, inv = np.unique(pair, return_inverse=True)
+        rows = pairs // n_genes
+        indices = (pairs % n_genes).astype(np.int32)
+        indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=n_cells))].astype(
+            np.int32
+        )
+
+        def to_csr(counts, channel_id):
+            data = np.zeros(len(pairs), dtype=np.int64)
+            mask = channel == channel_id
+            data[inv[mask]] = counts[mask]
+            return scipy.sparse.csr_matrix(
+                (data, indices, indptr), shape=(n_cells, n_genes)
+            )
+
+        main_channel = counted["main_channel"]
+        main_id = counted["channels"].index(main_channel)
+        adata = anndata.AnnData(to_csr(umi_counts, main_id))
+        adata.obs_names = obs
+        adata.var_names = var
+        adata.layers[f"reads_{main_channel}"] = to_csr(read_counts, main_id)
+        for channel_id, name in enumerate(counted["channels"]):
+            if channel_id == main_id:
+                continue
+
+            adata.layers[name] = to_csr(umi_counts, channel_id)
+            adata.layers[f"reads_{name}"] = to_csr(read_counts, channel_id)
+
+        return adata
+
+    def make_DGEs(self):
+        return self.counted_to_adata(self.counted())
+
+
 # def assess_reads_per_UMI(ann_umis, ann_reads):
 #     rpu = (
 #         np.array(ann_reads.X.sum(axis=1), dtype=float).ravel()
@@ -399,6 +870,32 @@ def parse_cmdline():
         help="output a single-cell digital gene expression matrix with UMI COUNTS",
         default="",
     )
+    parser.add_argument(
+        "--parallel",
+        default=1,
+        type=int,
+        help="number of worker processes. Alignments are distributed by cell barcode, "
+        "so that each worker counts a disjoint set of cells (default=1)",
+    )
+    parser.add_argument(
+        "--n-chunk",
+        default=1000,
+        type=int,
+        help="number of alignments sent to a worker at a time with --parallel (default=1000)",
+    )
+    parser.add_argument(
+        "--max-mem",
+        default=0,
+        type=int,
+        help="approximate memory budget (MB) for counting, shared by all workers. Beyond "
+        "that, sorted runs of the counts are spilled to disk and merged in the end "
+        "(default=0 -> off)",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="directory for the runs spilled with --max-mem (default=system temp dir)",
+    )
     parser.add_argument(
         "--layers",
         default="reads",
@@ -461,34 +958,40 @@ def count_everything(ca):
     return True
 
 
-if __name__ == "__main__":
-    args = parse_cmdline()
+COUNT_FUNCS = {
+    "ligation_product": count_ligation_product,
+    "targeted_primer": count_targeted_primer,
+    "everything": count_everything,
+}
+
+
+def load_translation(fname):
+    "two-column lookup table with columns 'original' and 'target'"
+    import pandas as pd
 
     lkup = {}
-    if args.translate:
-        for row in pd.read_csv(args.translate, sep="\t").itertuples():
+    if fname:
+        for row in pd.read_csv(fname, sep="\t").itertuples():
             lkup[row.original] = row.target
 
-    if args.parse_gn:
-        gene_mode = "gn_tag"
-    else:
-        gene_mode = "chrom"
+    return lkup
 
-    ignore = args.ignore_gf.split(",")
 
-    count_func = {
-        "ligation_product": count_ligation_product,
-        "targeted_primer": count_targeted_primer,
-        "everything": count_everything,
-    }[args.count_func]
-    dge = DGE()
-    for ca in AlignmentClassifier(
+def make_classifier(args, bam_in=None, lkup={}):
+    return AlignmentClassifier(
         args.sample_name,
-        args.bam_in,
+        bam_in,
         chrom_to_gene=lkup,
-        gene_assign_mode=gene_mode,
-        ignore_gf=ignore,
-    ):
+        gene_assign_mode="gn_tag" if args.parse_gn else "chrom",
+        ignore_gf=args.ignore_gf.split(","),
+    )
+
+
+def count_alignments(classified, dge, args):
+    "flags each ClassifiedAlignment and adds it to the dge in all matching channels"
+    count_func = COUNT_FUNCS[args.count_func]
+    channels = ["count", "short", "reverse", "primer"]
+    for ca in classified:
         ca = (
             # .check_qname(keywords=["TSO", "polyA"])
             ca.check_tags(
@@ -504,16 +1007,110 @@ if __name__ == "__main__":
         # print(ca.n_match, "flags=", ca.flags)
         # print(ca.short, ca.primer, ca.reverse, ca.count)
 
-        channels = ["count", "short", "reverse", "primer"]
         for c in channels:
             if getattr(ca, c):
                 # print(ca.aln)
                 # print("counting as", c)
                 dge.add_read(gene=ca.gene, cell=ca.cell, umi=ca.umi, channel=c)
 
-        # print("next")
-    if args.output_DGE and len(dge.DGE_reads):
-        adata = dge.make_DGEs()
+    return dge
+
+
+## parallel_map() parts for quant --parallel
+def read_BAM_by_cell(bam_in, n_workers=2, n_chunk=1000, threads=2):
+    """
+    source: the BAM header (meta data) first, then chunks of raw BAM records
+    as (worker, blob). All records of a cell barcode go to the same worker.
+    Only the CB tag is looked up here, the records are not decoded.
+    """
+    import zlib
+    from spacemake.bam import BAMReader, record_offsets, record_tag
+
+    bam = BAMReader(bam_in, threads=threads)
+    yield dict(header_text=bam.header_text, references=bam.references)
+
+    chunks = [[] for i in range(n_workers)]
+    for blob in bam.chunks(n_chunk):
+        offsets = record_offsets(blob)
+        for a, b in zip(offsets, offsets[1:]):
+            rec = blob[a:b]
+            cell = record_tag(rec, b"CB")
+            i = zlib.crc32(b"NA" if cell is None else cell) % n_workers
+            chunk = chunks[i]
+            chunk.append(rec)
+            if len(chunk) >= n_chunk:
+                yield i, b"".join(chunk)
+                chunks[i] = []
+
+    bam.close()
+    for i, chunk in enumerate(chunks):
+        if chunk:
+            yield i, b"".join(chunk)
+
+
+def quant_worker(chunks, args=None, lkup={}, meta=None):
+    """
+    worker: counts the alignments of its share of cells. The raw records of
+    each chunk are classified directly (see spacemake.bam.RawAlignment),
+    without going through pysam. Yields the number of records per chunk and
+    returns PackedDGE.counted()
+    """
+    from spacemake.bam import RawAlignment, record_offsets
+
+    classifier = make_classifier(args, lkup=lkup)
+    dge = PackedDGE(max_mem=args.max_mem * 2**20 // args.parallel, tmp_dir=args.tmp_dir)
+
+    ref_names = [name for name, l_ref in meta["references"]]
+    for blob in chunks:
+        offsets = record_offsets(blob)
+        alignments = [
+            RawAlignment(blob[a:b], ref_names) for a, b in zip(offsets, offsets[1:])
+        ]
+        count_alignments(map(classifier.classify, alignments), dge, args)
+        yield len(alignments)
+
+    return dge.counted()
+
+
+def count_records(results, meta=None):
+    "sink: total number of records"
+    return sum(results)
+
+
+def main(args):
+    logger = logging.getLogger("spacemake.quant")
+    lkup = load_translation(args.translate)
+    if args.parallel > 1:
+        from functools import partial
+        from spacemake.parallel import parallel_map
+
+        _, worker_counts, n = parallel_map(
+            partial(
+                read_BAM_by_cell,
+                args.bam_in,
+                n_workers=args.parallel,
+                n_chunk=args.n_chunk,
+            ),
+            partial(quant_worker, args=args, lkup=lkup),
+            count_records,
+            n_workers=args.parallel,
+            ordered=False,
+            with_meta=True,
+            meta_to_workers=True,
+            routed=True,
+            name="quant",
+        )
+        logger.info(f"counted {n} alignments with {args.parallel} workers")
+        counted = PackedDGE.merge_counted(worker_counts)
+        has_reads = len(counted["keys"]) > 0
+    else:
+        dge = PackedDGE(max_mem=args.max_mem * 2**20, tmp_dir=args.tmp_dir)
+        count_alignments(make_classifier(args, args.bam_in, lkup), dge, args)
+        counted = dge.counted()
+        has_reads = len(dge) > 0
+
+    if args.output_DGE and has_reads:
+        adata = PackedDGE.counted_to_adata(counted)
         # dge.check_DGEs_vs_margin_counts(ann_umis, ann_reads)
         # print("storing AnnData object")
         adata.write(args.output_DGE)
@@ -523,6 +1120,11 @@ if __name__ == "__main__":
         #     f"### reads-to-UMI ratio quartiles: {assess_reads_per_UMI(ann_umis, ann_reads)} \n"
         # )
 
+
+if __name__ == "__main__":
+    args = parse_cmdline()
+    main(args)
+
     # # print("starting")
     # counts = defaultdict(int)
     # discarded = defaultdict(lambda: defaultdict(int))  # key is [reason][miRNA] -> count
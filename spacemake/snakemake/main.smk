@@ -15,7 +15,7 @@ import numpy as np
 import math
 import scanpy as sc
 
-from spacemake.preprocess import dge_to_sparse_adata, attach_barcode_file,\
+from spacemake.preprocess import attach_barcode_file,\
     parse_barcode_file, load_external_dge, attach_puck_variables, attach_puck
 from spacemake.spatial import create_meshed_adata, puck_collection
 from spacemake.project_df import ProjectDF
@@ -296,11 +296,12 @@ rule tag_reads_bc_umi:
         "--cell-raw='{params.bc.cell_raw}' "
         "--out-format=bam "
         "--out-unassigned={output.unassigned} "
-        "--out-assigned=/dev/stdout "
+        "--out-assigned={output.assigned} "
+        "--compression-level=6 "
+        "--compression-threads={threads} "
         "--UMI='{params.bc.UMI}' "
         "--bam-tags='{params.bc.bam_tags}' "
         "--min-opseq-score={params.bc.min_opseq_score} "
-        "| samtools view -bh /dev/stdin > {output.assigned} "
 
 rule run_fastqc:
     input:
@@ -445,6 +446,9 @@ rule create_spatial_barcode_whitelist:
 rule create_dge:
     # creates the dge. depending on if the dge has _cleaned in the end it will require the
     # topBarcodesClean.txt file or just the regular topBarcodes.txt
+    # spatial dges are split from create_dge_all_tiles instead
+    wildcard_constraints:
+        n_beads = '[0-9]+'
     input:
         unpack(get_top_barcodes),
         unpack(get_dge_input_bam)
@@ -465,16 +469,62 @@ rule create_dge:
         """
         mkdir -p {params.dge_root}
 
-        {dropseq_tools}/DigitalExpression \
-        -m 16g \
-        I= {input.reads}\
-        O= {output.dge} \
-        SUMMARY= {output.dge_summary} \
-        CELL_BC_FILE={input.top_barcodes} \
-        CELL_BARCODE_TAG={params.cell_barcode_tag} \
-        MOLECULAR_BARCODE_TAG={params.umi_tag} \
-        TMP_DIR={global_tmp} \
-        {params.dge_extra_params}
+        python -m spacemake.digital_expression \
+            --bam-in {input.reads} \
+            --output {output.dge} \
+            --summary {output.dge_summary} \
+            --cell-bc-file {input.top_barcodes} \
+            --cell-tag {params.cell_barcode_tag} \
+            --umi-tag {params.umi_tag} \
+            --max-mem 4000 \
+            --tmp-dir {global_tmp} \
+            {params.dge_extra_params}
+        """
+
+rule create_dge_all_tiles:
+    # creates the dges of all tiles (pucks) of a spatial sample with a single
+    # pass over the BAM, instead of one pass per tile
+    input:
+        unpack(get_all_spatial_barcodes),
+        unpack(get_dge_input_bam)
+    output:
+        temp(directory(dge_out_tiles))
+    params:
+        tile_ids = lambda wildcards: get_spatial_puck_barcode_file_ids(wildcards),
+        dge_extra_params = lambda wildcards: get_dge_extra_params(wildcards),
+        cell_barcode_tag = lambda wildcards: get_bam_tag_names(
+            project_id = wildcards.project_id,
+            sample_id = wildcards.sample_id)['{cell}'],
+        umi_tag = lambda wildcards: get_bam_tag_names(
+            project_id = wildcards.project_id,
+            sample_id = wildcards.sample_id)['{UMI}']
+    threads: 1
+    shell:
+        """
+        python -m spacemake.digital_expression \
+            --bam-in {input.reads} \
+            --output-dir {output} \
+            --tile-bc-files {input.tile_barcodes} \
+            --tile-ids {params.tile_ids} \
+            --cell-tag {params.cell_barcode_tag} \
+            --umi-tag {params.umi_tag} \
+            --max-mem 4000 \
+            --tmp-dir {global_tmp} \
+            {params.dge_extra_params}
+        """
+
+rule create_spatial_dge:
+    wildcard_constraints:
+        n_beads = 'spatial'
+    input:
+        dge_out_tiles
+    output:
+        dge=dge_out,
+        dge_summary=dge_out_summary
+    shell:
+        """
+        cp {input}/{wildcards.puck_barcode_file_id}.raw.h5ad {output.dge}
+        cp {input}/{wildcards.puck_barcode_file_id}.summary.txt {output.dge_summary}
         """
 
 rule create_h5ad_dge:
@@ -488,9 +538,8 @@ rule create_h5ad_dge:
         if wildcards.is_external == '.external':
             adata = load_external_dge(input['dge'])
         else:
-            adata = dge_to_sparse_adata(
-                input['dge'],
-                input['dge_summary'])
+            # written by spacemake.digital_expression, metrics are attached already
+            adata = sc.read_h5ad(input['dge'])
         # attach barcodes
         if 'barcode_file' in input.keys() and wildcards.n_beads == 'spatial':
             adata = attach_barcode_file(adata, input['barcode_file'])
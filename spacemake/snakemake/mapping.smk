@@ -52,6 +52,13 @@ bt2_index_file = bt2_index_param + '.1.bt2'
 
 species_reference_sequence = 'species_data/{species}/{ref_name}/sequence.fa'
 species_reference_annotation = 'species_data/{species}/{ref_name}/annotation.gtf'
+species_reference_compiled_annotation = 'species_data/{species}/{ref_name}/compiled_annotation'
+species_reference_compiled_annotation_file = species_reference_compiled_annotation + '/compiled_index.bin'
+
+# gene-tagging of alignments: Drop-seq tools' TagReadWithGeneFunction (default)
+# or the spacemake.annotator module, using a compiled annotation index
+default_tagger = "dropseq"
+taggers = ["dropseq", "spacemake"]
 
 # used to fetch all info needed to create a BAM file
 MAP_RULES_LKUP = {}
@@ -126,7 +133,7 @@ def mapstr_to_targets(mapstr, left="uBAM", final="final"):
 
     The input to the first mappings is always the uBAM - the CB and UMI tagged, pre-processed, 
     but unmapped reads.
-    map-rules are composed of two or three paramters, separated by ':'.
+    map-rules are composed of two to four paramters, separated by ':'.
     The first two parameters for the mapping are <mapper>:<reference>. The target BAM will have 
     the name <reference>.<mapper>.bam.
     Optionally, a triplet can be used <mapper>:<reference>:<symlink> where the presence of <symlink> 
@@ -134,6 +141,10 @@ def mapstr_to_targets(mapstr, left="uBAM", final="final"):
     shorthand or common hook expected by other stages of SPACEMAKE. A special symlink name is "final"
     which is required by downstream stages of SPACEMAKE. If no "final" is specified, the last map-rule
     automatically is selected and symlinked as "final".
+    An optional fourth parameter <mapper>:<reference>:<symlink>:<tagger> selects the tool used
+    for gene-tagging the alignments: "dropseq" (TagReadWithGeneFunction, the default) or
+    "spacemake" (the spacemake.annotator module). <symlink> may be left empty, 
+    e.g. STAR:genome::spacemake
     Note, due to the special importance of "final", it may get modified to contain other flags of the run-mode
     that are presently essential for SPACEMAKE to have in the file name ("final.bam" may in fact be 
     "final.polyA_adapter_trimmed.bam")
@@ -178,18 +189,29 @@ def mapstr_to_targets(mapstr, left="uBAM", final="final"):
         mr = dotdict()
         lr = None
 
+        tagger = default_tagger
         if len(parts) == 2:
             mapper, ref = parts
             link_name = None
         elif len(parts) == 3:
             mapper, ref, link_name = parts
-            link_name = link_name.replace("final", final)
+        elif len(parts) == 4:
+            mapper, ref, link_name, tagger = parts
         else:
             raise ValueError(f"map_strategy contains a map-rule with unexpected number of parameters: {parts}")
 
+        if link_name:
+            link_name = link_name.replace("final", final)
+        else:
+            link_name = None
+
+        if tagger not in taggers:
+            raise ValueError(f"map_strategy contains a map-rule with unknown tagger '{tagger}'. Choose from {taggers}")
+
         mr.input_name = left
         mr.mapper = mapper
         mr.ref_name = ref
+        mr.tagger = tagger
         mr.out_name = f"{ref}.{mapper}"
 
         if link_name:
@@ -287,8 +309,12 @@ def get_mapped_BAM_output(default_strategy="STAR:genome:final"):
             mr.ann_path = species_d[mr.ref_name].get("annotation", None)
             if mr.ann_path:
                 mr.ann_final = wc_fill(species_reference_annotation, mr)
+                mr.ann_compiled = wc_fill(species_reference_compiled_annotation, mr)
+                mr.ann_compiled_file = wc_fill(species_reference_compiled_annotation_file, mr)
             else:
                 mr.ann_final = []
+                mr.ann_compiled = []
+                mr.ann_compiled_file = []
 
             default_STAR_INDEX = wc_fill(star_index, mr)
             default_BT2_INDEX = wc_fill(bt2_index_param, mr)
@@ -365,22 +391,46 @@ def get_map_inputs(wc, mapper="STAR"):
     if hasattr(mr, "ann_final"):
         d['annotation'] = mr.ann_final
 
+    if mr.tagger == "spacemake":
+        d['compiled_annotation'] = mr.ann_compiled_file
+
     return d
 
-def get_map_params(wc, output, mapper="STAR"):
+def get_map_params(wc, output, threads=1, mapper="STAR"):
     wc = dotdict(wc.items())
     wc.mapper = mapper
     mr = get_map_rule(wc)
     annotation_cmd = f"| samtools view --threads=4 -bh /dev/stdin > {output}"
+    map_threads = threads
     # this is a stub for "no annotation tagging"
     if hasattr(mr, "ann_final"):
         ann = mr.ann_final
         if ann and ann.lower().endswith(".gtf"):
-            tagging_cmd =  "| {dropseq_tools}/TagReadWithGeneFunction I=/dev/stdin O={mr.out_path} ANNOTATIONS_FILE={mr.ann_final}"
-            annotation_cmd = tagging_cmd.format(dropseq_tools=dropseq_tools, mr=mr)
+            if mr.tagger == "spacemake":
+                # emits the same tags as TagReadWithGeneFunction. Mapper and
+                # annotator run in the same pipe and share the threads
+                # reserved by the rule: a quarter goes to the annotator (one
+                # each for BAM decompression and compression, the rest
+                # for annotation workers), the rest to the mapper.
+                ann_threads = max(threads // 4, 3)
+                map_threads = max(threads - ann_threads, 1)
+                tagging_cmd = (
+                    "| python -m spacemake.annotator --dropseqtools"
+                    " --gtf {mr.ann_final} --compiled {mr.ann_compiled} --use-compiled"
+                    " --threads-work {n_work} --threads-read 1 --threads-write 1"
+                    " --bam-out-level 6"
+                    " --bam-in /dev/stdin --bam-out {mr.out_path}"
+                )
+            else:
+                tagging_cmd =  "| {dropseq_tools}/TagReadWithGeneFunction I=/dev/stdin O={mr.out_path} ANNOTATIONS_FILE={mr.ann_final}"
+
+            annotation_cmd = tagging_cmd.format(
+                dropseq_tools=dropseq_tools, mr=mr, n_work=ann_threads - 2
+            )
 
     return {
         'annotation_cmd' : annotation_cmd,
+        'map_threads' : map_threads,
         'annotation' : mr.ann_final,
         'index' : mr.map_index_param,
         'flags' : mr.map_flags,
@@ -422,7 +472,7 @@ rule map_reads_bowtie2:
         bam=bt2_mapped_bam
     log: bt2_mapped_bam + ".log"
     params:
-        auto = lambda wc, output: get_map_params(wc, output, mapper='bowtie2'),
+        auto = lambda wc, output, threads: get_map_params(wc, output, threads, mapper='bowtie2'),
     threads: 32 
     shell:
         # 1) decompress unmapped reads from existing BAM
@@ -434,7 +484,7 @@ rule map_reads_bowtie2:
         "| samtools view --no-PG --threads=2 -Sbu" 
         " "
         # 3) align reads with bowtie2, *preserving the original BAM tags*
-        "| bowtie2 -p {threads} --reorder --mm"
+        "| bowtie2 -p {params.auto[map_threads]} --reorder --mm"
         "  -x {params.auto[index]} -b /dev/stdin --preserve-tags"
         "  {params.auto[flags]} 2> {log}"
         " "
@@ -503,7 +553,7 @@ rule map_reads_STAR:
         # this needs to be removed for memory sharing
         # " --sjdbGTFfile {params.auto[annotation]}"
         " --outFileNamePrefix {params.star_prefix}"
-        " --runThreadN {threads}"
+        " --runThreadN {params.auto[map_threads]}"
         " "
         "| python {repo_dir}/scripts/splice_bam_header.py"
         " --in-ubam {input.bam}"
@@ -541,6 +591,23 @@ rule prepare_species_reference_annotation:
 		else:
 			shell('ln -sr {input} {output}')
 
+rule compile_species_reference_annotation:
+    input:
+        species_reference_annotation
+    output:
+        species_reference_compiled_annotation_file
+    params:
+        compiled=species_reference_compiled_annotation
+    threads: 4
+    run:
+        from spacemake.annotator import GenomeAnnotation
+
+        os.makedirs(params.compiled, exist_ok=True)
+        ga = GenomeAnnotation.from_GTF(
+            input[0], cache=os.path.join(params.compiled, "gtf_cache.npz")
+        )
+        ga.compile(params.compiled, n_workers=threads)
+
 # TODO: transition to species_reference_file and map_index_param
 # and get rid of INDEX_FASTA_LKUP
 rule create_bowtie2_index:
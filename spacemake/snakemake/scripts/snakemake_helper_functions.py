@@ -507,28 +507,22 @@ def get_run_modes_from_sample(project_id, sample_id):
 
 
 def get_dge_extra_params(wildcards):
+    # options of spacemake.digital_expression. Defaults as in DigitalExpression:
+    # exonic (CODING, UTR) reads with mapping quality >= 10, counting UMIs
     dge_type = wildcards.dge_type
 
     extra_params = ""
 
-    if dge_type == ".exon":
-        extra_params = ""
-    elif dge_type == ".intron":
-        extra_params = "LOCUS_FUNCTION_LIST=null LOCUS_FUNCTION_LIST=INTRONIC"
-    elif dge_type == ".all":
-        extra_params = "LOCUS_FUNCTION_LIST=INTRONIC"
-    if dge_type == ".Reads_exon":
-        extra_params = "OUTPUT_READS_INSTEAD=true"
-    elif dge_type == ".Reads_intron":
-        extra_params = (
-            "OUTPUT_READS_INSTEAD=true LOCUS_FUNCTION_LIST=null"
-            + "LOCUS_FUNCTION_LIST=INTRONIC"
-        )
-    elif dge_type == ".Reads_all":
-        extra_params = "OUTPUT_READS_INSTEAD=true LOCUS_FUNCTION_LIST=INTRONIC"
+    if dge_type in [".intron", ".Reads_intron"]:
+        extra_params = "--locus-function INTRONIC"
+    elif dge_type in [".all", ".Reads_all"]:
+        extra_params = "--locus-function CODING,UTR,INTRONIC"
+
+    if dge_type.startswith(".Reads_"):
+        extra_params = extra_params + " --reads-instead"
 
     if wildcards.mm_included == ".mm_included":
-        extra_params = extra_params + " READ_MQ=0"
+        extra_params = extra_params + " --read-mq 0"
 
     return extra_params
 
@@ -594,6 +588,32 @@ def get_top_barcodes(wildcards):
         return {"top_barcodes": top_barcodes_clean}
 
 
+def get_spatial_puck_barcode_file_ids(wildcards):
+    # all tiles (pucks) of a sample which have spatial barcodes
+    return [
+        pbf_id
+        for pbf_id in project_df.get_puck_barcode_ids_and_files(
+            project_id=wildcards.project_id, sample_id=wildcards.sample_id
+        )[0]
+        if project_df.is_spatial(
+            project_id=wildcards.project_id,
+            sample_id=wildcards.sample_id,
+            puck_barcode_file_id=pbf_id,
+        )
+    ]
+
+
+def get_all_spatial_barcodes(wildcards):
+    return {
+        "tile_barcodes": expand(
+            spatial_barcodes,
+            project_id=wildcards.project_id,
+            sample_id=wildcards.sample_id,
+            puck_barcode_file_id=get_spatial_puck_barcode_file_ids(wildcards),
+        )
+    }
+
+
 def get_parsed_puck_file(wildcards):
     is_spatial = project_df.is_spatial(
         project_id=wildcards.project_id,
@@ -108,13 +108,15 @@ dge_root = data_root + "/dge"
 dge_out_prefix = dge_root + "/dge"
 dge_out_suffix = "{dge_type}{dge_cleaned}{polyA_adapter_trimmed}{mm_included}"
 dge_out = (
-    dge_out_prefix + dge_out_suffix + ".{n_beads}_beads_{puck_barcode_file_id}.txt.gz"
+    dge_out_prefix + dge_out_suffix + ".{n_beads}_beads_{puck_barcode_file_id}.raw.h5ad"
 )
 dge_out_summary = (
     dge_out_prefix
     + dge_out_suffix
     + ".{n_beads}_beads_{puck_barcode_file_id}.summary.txt"
 )
+# the raw DGEs of all tiles of a spatial sample, created in a single pass
+dge_out_tiles = dge_out_prefix + dge_out_suffix + ".spatial_beads_all_tiles"
 
 # processed dge
 h5ad_dge_suffix = "{is_external}.h5ad"
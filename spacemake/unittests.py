@@ -4,6 +4,7 @@ import os
 import os.path
 import sys
 import subprocess
+import time
 import yaml
 import pandas as pd
 
@@ -108,6 +109,945 @@ def load_bam_hashes(path):
     return results
 
 
+## parts for ParallelTests. Module level, so that sub-processes can use them
+def _numbers_source(n_chunks=20, n_workers=1, meta=None):
+    if meta is not None:
+        yield meta
+
+    for i in range(n_chunks):
+        chunk = list(range(10 * i, 10 * i + 10))
+        yield (i % n_workers, chunk) if n_workers > 1 else chunk
+
+    return n_chunks
+
+
+def _square_worker(chunks, kill_at=None, meta=None):
+    import random
+    import signal
+
+    n = 0
+    for chunk in chunks:
+        if chunk[0] == kill_at:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+        # shuffle the order in which results arrive
+        time.sleep(random.random() * 0.01)
+        yield meta, [x * x for x in chunk]
+        n += 1
+
+    return n
+
+
+def _list_sink(results, meta=None):
+    return meta, list(results)
+
+
+class ParallelTests(unittest.TestCase):
+    expect = [[x * x for x in range(10 * i, 10 * i + 10)] for i in range(20)]
+
+    def run_map(self, n_workers=3, **kw):
+        from functools import partial
+        from spacemake.parallel import parallel_map
+
+        source_kw = dict(n_workers=n_workers) if kw.get("routed") else {}
+        if kw.get("with_meta"):
+            source_kw["meta"] = "header"
+
+        return parallel_map(
+            partial(_numbers_source, **source_kw),
+            partial(_square_worker, kill_at=kw.pop("kill_at", None)),
+            _list_sink,
+            n_workers=n_workers,
+            **kw,
+        )
+
+    def test_ordered(self):
+        src_ret, worker_ret, (meta, results) = self.run_map()
+        self.assertEqual(src_ret, 20)
+        self.assertEqual(sum(worker_ret), 20)
+        self.assertEqual([res for m, res in results], self.expect)
+
+    def test_unordered(self):
+        src_ret, worker_ret, (meta, results) = self.run_map(ordered=False)
+        self.assertEqual(sorted([res for m, res in results]), self.expect)
+
+    def test_routed(self):
+        src_ret, worker_ret, (meta, results) = self.run_map(routed=True)
+        # chunk i goes to worker i % 3
+        self.assertEqual(worker_ret, [7, 7, 6])
+        self.assertEqual([res for m, res in results], self.expect)
+
+    def test_with_meta(self):
+        src_ret, worker_ret, (meta, results) = self.run_map(
+            with_meta=True, meta_to_workers=True
+        )
+        self.assertEqual(meta, "header")
+        self.assertEqual([m for m, res in results], ["header"] * 20)
+        self.assertEqual([res for m, res in results], self.expect)
+
+    def test_killed_worker(self):
+        # a worker killed by a signal can not raise the abort flag itself
+        for routed in [False, True]:
+            t0 = time.time()
+            with self.assertRaises(RuntimeError):
+                self.run_map(routed=routed, kill_at=50)
+
+            self.assertTrue(time.time() - t0 < 30)
+
+
+class BAMTests(unittest.TestCase):
+    header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": "chr1", "LN": 100000}]}
+
+    def test_unaligned_roundtrip(self):
+        import tempfile
+        import random
+        import pysam
+        from spacemake.bam import (
+            BAMWriter,
+            BAMReader,
+            encode_unaligned,
+            decode_record,
+            pack_unaligned,
+            record_offsets,
+        )
+
+        rng = random.Random(1)
+        reads = []
+        for i in range(2000):
+            # odd and even lengths, N bases, missing qualities
+            seq = "".join([rng.choice("ACGTN") for j in range(rng.randint(1, 60))])
+            qual = "".join([chr(33 + rng.randint(2, 40)) for j in seq])
+            if i % 7 == 0:
+                qual = "*"
+            tags = [("CB", "ACGT" * (i % 3)), ("MI", i)]
+            reads.append((f"read_{i}", seq, qual, tags, 4 if i % 5 else 77))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "u.bam")
+            with BAMWriter(fname, "@HD\tVN:1.6", threads=2) as out:
+                for name, seq, qual, tags, flag in reads:
+                    out.write(encode_unaligned(name, seq, qual, tags, flag=flag))
+
+            bam = pysam.AlignmentFile(fname, check_sq=False)
+            for aln, (name, seq, qual, tags, flag) in zip(
+                bam.fetch(until_eof=True), reads
+            ):
+                self.assertEqual(aln.query_name, name)
+                self.assertEqual(aln.query_sequence, seq)
+                self.assertEqual(aln.flag, flag)
+                if qual == "*":
+                    self.assertEqual(aln.query_qualities, None)
+                else:
+                    self.assertEqual(
+                        pysam.qualities_to_qualitystring(aln.query_qualities), qual
+                    )
+                self.assertEqual(aln.get_tags(), [(t, str(v)) for t, v in tags])
+
+            # decode_record() and pack_unaligned() are inverse
+            blobs = list(BAMReader(fname, threads=2).chunks(300))
+            self.assertEqual(len(blobs), 7)
+            n = 0
+            for blob in blobs:
+                offsets = record_offsets(blob)
+                for a, b in zip(offsets, offsets[1:]):
+                    flag, name, seq, qual, tags = decode_record(blob[a:b])
+                    self.assertEqual(seq, reads[n][1])
+                    self.assertEqual(
+                        pack_unaligned(name, seq, qual, tags, flag), blob[a:b]
+                    )
+                    n += 1
+
+            self.assertEqual(n, len(reads))
+
+    def test_aligned_records(self):
+        import tempfile
+        import array
+        import pysam
+        from spacemake.bam import (
+            BAMReader,
+            BAMWriter,
+            encode_tags,
+            record_offsets,
+            record_blocks,
+            record_tag,
+            append_tags,
+            RawAlignment,
+        )
+
+        cigars = ["30M", "5S25M", "10M100N15M5S", "3S7M2I8M3D10M", "4H30M", "15=1X14="]
+        alignments = []
+        for i in range(600):
+            aln = pysam.AlignedSegment()
+            aln.query_name = f"read_{i}"
+            aln.query_sequence = "ACGTA" * 6
+            aln.query_qualities = [30] * 30
+            aln.reference_id = 0
+            aln.reference_start = 17 * i
+            aln.cigarstring = cigars[i % len(cigars)]
+            aln.flag = [0, 16, 256][i % 3]
+            tags = [
+                ("NM", i),
+                ("XB", array.array("h", range(i % 4))),
+                ("XF", 0.5),
+                ("XA", "A", "A"),
+                ("XZ", "CBZ"),
+            ]
+            if i % 2:
+                tags.append(("CB", f"cell_{i}"))
+            aln.set_tags(tags + [("MI", "UMI")])
+            alignments.append(aln)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "a.bam")
+            with pysam.AlignmentFile(fname, "wb", header=self.header) as bam:
+                for aln in alignments:
+                    bam.write(aln)
+
+            reader = BAMReader(fname)
+            self.assertEqual(reader.references, [("chr1", 100000)])
+            records = []
+            for blob in reader.chunks(64):
+                offsets = record_offsets(blob)
+                self.assertTrue(len(offsets) - 1 <= 64)
+                records.extend([blob[a:b] for a, b in zip(offsets, offsets[1:])])
+            reader.close()
+
+            self.assertEqual(len(records), len(alignments))
+            tagged = []
+            for rec, aln in zip(records, alignments):
+                ref_id, flag, blocks = record_blocks(rec)
+                self.assertEqual(ref_id, 0)
+                self.assertEqual(flag, aln.flag)
+                self.assertEqual(blocks, aln.get_blocks())
+                cell = record_tag(rec, b"CB")
+                if aln.has_tag("CB"):
+                    self.assertEqual(cell.decode(), aln.get_tag("CB"))
+                else:
+                    self.assertEqual(cell, None)
+                self.assertEqual(record_tag(rec, b"MI"), b"UMI")
+
+                raw = RawAlignment(rec, ["chr1"])
+                self.assertEqual(raw.reference_name, "chr1")
+                self.assertEqual(raw.is_reverse, aln.is_reverse)
+                self.assertEqual(raw.qname, aln.qname)
+                self.assertEqual(raw.cigartuples, aln.cigartuples)
+                self.assertEqual(raw.query_sequence, aln.query_sequence)
+                self.assertEqual(raw.has_tag("CB"), aln.has_tag("CB"))
+                self.assertEqual(raw.get_tag("XZ"), aln.get_tag("XZ"))
+                self.assertEqual(
+                    raw.get_tags(),
+                    [
+                        (t, v)
+                        for t, v, typ in aln.get_tags(with_value_type=True)
+                        if typ == "Z"
+                    ],
+                )
+                tagged.append(append_tags(rec, encode_tags([("gn", "gene_A")])))
+
+            out_name = os.path.join(tmp, "tagged.bam")
+            with BAMWriter(
+                out_name, reader.header_text, reader.references, threads=2
+            ) as out:
+                out.write(b"".join(tagged))
+
+            bam = pysam.AlignmentFile(out_name)
+            for a, b in zip(bam.fetch(until_eof=True), alignments):
+                self.assertEqual(a.cigarstring, b.cigarstring)
+                self.assertEqual(a.get_tags()[:-1], b.get_tags())
+                self.assertEqual(a.get_tag("gn"), "gene_A")
+
+
+class AnnotatorTests(unittest.TestCase):
+    gtf = os.path.abspath(f"{base_dir}/test_data/test_genome.gtf.gz")
+
+    def test_sweep_decompose(self):
+        from spacemake.annotator import GenomeAnnotation, decompose
+
+        ga = GenomeAnnotation.from_GTF(self.gtf)
+        sweep = dict(ga.decompose_strands())
+        sweep_pool = dict(ga.decompose_strands(n_workers=2))
+        for strand_key, nc in ga.strand_map.items():
+            expect = [(int(s), int(e), idx) for s, e, idx in decompose(nc)]
+            self.assertTrue(len(expect) > 0)
+            self.assertEqual(sweep[strand_key], expect)
+            self.assertEqual(sweep_pool[strand_key], expect)
+
+    def random_queries(self, ga, n=5000, seed=1):
+        "(chrom, strand, blocks) with 1-3 blocks, also on unknown chromosomes"
+        import random
+
+        rng = random.Random(seed)
+        chroms = sorted(set([chrom for chrom, strand in ga.strand_keys])) + ["chrX"]
+        queries = []
+        for i in range(n):
+            x = sorted(rng.sample(range(1000), 2 * rng.randint(1, 3)))
+            blocks = list(zip(x[0::2], x[1::2]))
+            queries.append((rng.choice(chroms), rng.choice("+-"), blocks))
+
+        return queries
+
+    @staticmethod
+    def as_tuples(res):
+        return tuple([tuple(x) for x in res])
+
+    def test_compiled_lookup(self):
+        from spacemake.annotator import GenomeAnnotation
+
+        ga = GenomeAnnotation.from_GTF(self.gtf)
+        gc = ga.compile()
+        queries = self.random_queries(ga)
+        results = gc.engine.query_batch(queries)
+        n_hits = 0
+        n_multi = 0
+        for (chrom, strand, blocks), res in zip(queries, results):
+            # CompiledClassifier on the segments found through the NCLS
+            idx = gc.query_idx_blocks(chrom, strand, blocks)
+            expect = self.as_tuples(gc.processor(sorted(idx)))
+            self.assertEqual(self.as_tuples(res), expect)
+            n_hits += len(res[0]) > 0
+            n_multi += len(res[0]) > 1
+
+        # the test genome is annotated on the minus strands only
+        self.assertTrue(n_hits > len(queries) / 10)
+        self.assertTrue(n_multi > 0)
+
+    def test_compiled_index_roundtrip(self):
+        import pickle
+        import tempfile
+        from spacemake.annotator import GenomeAnnotation, CompiledLookup
+
+        ga = GenomeAnnotation.from_GTF(self.gtf)
+        queries = self.random_queries(ga, seed=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            gc = ga.compile(path=tmp)
+            expect = [self.as_tuples(res) for res in gc.query_batch(queries)]
+
+            loaded = GenomeAnnotation.from_compiled_index(tmp)
+            self.assertTrue(loaded.matches_source(self.gtf))
+            self.assertEqual(sorted(loaded.strand_keys), sorted(ga.strand_keys))
+            # memory-mapped engines pickle as the name of their file
+            engine = pickle.loads(pickle.dumps(loaded.engine))
+            self.assertEqual(engine.fname, CompiledLookup.get_filename(tmp))
+            for lookup in [loaded, engine]:
+                results = [self.as_tuples(res) for res in lookup.query_batch(queries)]
+                self.assertEqual(results, expect)
+
+            with open(os.path.join(tmp, "not_an_index.bin"), "wb") as f:
+                f.write(b"\0" * 100)
+
+            with self.assertRaises(ValueError):
+                CompiledLookup.load(os.path.join(tmp, "not_an_index.bin"))
+
+    def write_bam(self, fname, ga, n=3000, seed=3):
+        "aligned reads on the test genome, with many exact duplicates"
+        import random
+        import pysam
+
+        rng = random.Random(seed)
+        chroms = sorted(set([chrom for chrom, strand in ga.strand_keys]))
+        header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": c, "LN": 1000} for c in chroms]}
+        cigars = ["30M", "10M200N20M", "5S25M", "15M100N5M50N10M"]
+        positions = [(rng.randrange(2), rng.randrange(700)) for i in range(300)]
+        with pysam.AlignmentFile(fname, "wb", header=header) as bam:
+            for i in range(n):
+                aln = pysam.AlignedSegment()
+                aln.query_name = f"read_{i}"
+                aln.query_sequence = "A" * 30
+                aln.flag = rng.choice([0, 16, 0, 16, 4])
+                if aln.flag != 4:
+                    aln.reference_id, aln.reference_start = rng.choice(positions)
+                    aln.cigarstring = rng.choice(cigars)
+                aln.set_tags([("CB", "ACGT")])
+                bam.write(aln)
+
+    @staticmethod
+    def read_tags(fname):
+        import pysam
+
+        bam = pysam.AlignmentFile(fname, check_sq=False)
+        return [(aln.query_name, aln.get_tags()) for aln in bam.fetch(until_eof=True)]
+
+    def test_annotate_BAM(self):
+        import tempfile
+        from spacemake.annotator import GenomeAnnotation
+
+        ga = GenomeAnnotation.from_GTF(self.gtf)
+        with tempfile.TemporaryDirectory() as tmp:
+            ga.compile(path=tmp)
+            gc = GenomeAnnotation.from_compiled_index(tmp)
+            src = os.path.join(tmp, "in.bam")
+            self.write_bam(src, ga)
+            for dropseq in [False, True]:
+                out = os.path.join(tmp, "out.bam")
+                gc.annotate_BAM(src, out, memo_size=0, dropseq=dropseq)
+                expect = self.read_tags(out)
+                for memo_size in [0, 10, 100000]:
+                    gc.annotate_BAM(src, out, memo_size=memo_size, dropseq=dropseq)
+                    self.assertEqual(self.read_tags(out), expect)
+                    n = gc.annotate_BAM_parallel(
+                        src,
+                        out,
+                        n_workers=2,
+                        n_chunk=100,
+                        memo_size=memo_size,
+                        dropseq=dropseq,
+                    )
+                    self.assertEqual(n, 3000)
+                    self.assertEqual(self.read_tags(out), expect)
+
+                names = set([tag for name, tags in expect for tag, value in tags])
+                if dropseq:
+                    self.assertEqual(names, set(["CB", "gn", "gs", "gf", "XF"]))
+                    for name, tags in expect:
+                        tags = dict(tags)
+                        if "gn" in tags:
+                            self.assertTrue(tags["XF"] in tags["gf"].split(","))
+                            genes = list(
+                                zip(tags["gn"].split(","), tags["gs"].split(","))
+                            )
+                            self.assertEqual(len(genes), len(set(genes)))
+                else:
+                    self.assertEqual(names, set(["CB", "gF", "gN", "gS", "gT"]))
+
+    def test_tag_memo(self):
+        from spacemake.annotator import TagMemo
+
+        memo = TagMemo(size=2)
+        memo.put("a", 1)
+        memo.put("b", 2)
+        self.assertEqual(memo.get("a"), 1)
+        # "b" is the least recently used
+        memo.put("c", 3)
+        self.assertEqual(memo.get("b"), None)
+        self.assertEqual(memo.get("c"), 3)
+        self.assertEqual(memo.stats(), dict(hits=2, misses=1, evictions=1))
+        other = TagMemo()
+        other.add_stats(memo.stats())
+        other.add_stats(memo.stats())
+        self.assertEqual(other.summary(), "memo hit-rate 66.7% (2 evictions)")
+
+
+class FastqTests(unittest.TestCase):
+    def test_shared_cache_roundtrip(self):
+        import tempfile
+        from spacemake.preprocess.fastq import SharedAlignmentCache, NO_CALL
+
+        cache = SharedAlignmentCache(["bc_a", "bc_b"], ["ACGTACGT", "TTTTGGGG"])
+        self.assertTrue(cache.put("ACGTACGA", ("bc_a", "ACGTACGT", 14.5)))
+        self.assertTrue(cache.put("CCCCCCCC", (NO_CALL, NO_CALL, -1)))
+        keys, counts, rest = cache.encode_counts(
+            {"ACGTACGA": 3, "CCCCCCCC": 2, "": 5, "ACGTNCGA": 4}
+        )
+        # what does not fit the shared table ends up in a worker's local cache
+        local = {"": (NO_CALL, NO_CALL, -1), "ACGTNCGA": ("bc_a", "ACGTACGT", 12.0)}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "bc1_cache.tsv")
+            cache.store(fname, [(keys, counts)], [local], [rest])
+            loaded = SharedAlignmentCache(["bc_a", "bc_b"], ["ACGTACGT", "TTTTGGGG"])
+            loaded.load(fname)
+
+        self.assertEqual(loaded.get("ACGTACGA"), ("bc_a", "ACGTACGT", 14.5))
+        self.assertEqual(loaded.get("CCCCCCCC")[:2], (NO_CALL, NO_CALL))
+        self.assertEqual(loaded.overflow, {"ACGTNCGA": ("bc_a", "ACGTACGT", 12.0)})
+        self.assertEqual(len(loaded), 2)
+
+
+class CutadaptBAMTests(unittest.TestCase):
+    adapters = {
+        "right": [("polyA", "A" * 20), ("SMART", "AAGCAGTGGTATCAACGCAGAGTGAATGGG")],
+        "left": [("SMART_5", "AAGCAGTGGTATCAACGCAGAGTGAATGGG")],
+    }
+
+    def random_reads(self, n=1000, seed=1):
+        import array
+        import random
+        from spacemake.cutadapt_bam import SimpleRead
+
+        rng = random.Random(seed)
+        reads = []
+        for i in range(n):
+            l = rng.randint(0, 90)
+            seq = [rng.choice("ACGT") for j in range(l)]
+            if rng.random() < 0.3:
+                seq[rng.randint(0, l) :] = "A" * 25
+            if rng.random() < 0.2:
+                seq = list(self.adapters["left"][0][1][rng.randint(0, 10) :]) + seq
+            qual = [rng.choice([2, 11, 25, 30, 37, 37, 37, 37]) for c in seq]
+            reads.append(
+                SimpleRead(f"read_{i}", "".join(seq), array.array("B", qual), {})
+            )
+
+        return reads
+
+    def reference(self, reads, min_qual, min_length):
+        "the per-read trimming of earlier versions, with cutadapt called directly"
+        import numpy as np
+        from collections import defaultdict
+        from spacemake.cutadapt_bam import load_adapters
+
+        right, left = load_adapters(self.fa["right"], self.fa["left"])
+        stats = defaultdict(int)
+        total = defaultdict(int)
+        lhist = defaultdict(int)
+        out = []
+        for read in reads:
+            seq = read.query_sequence
+            start = 0
+            end = len(seq)
+            stats["N_input"] += 1
+            total["bp_input"] += end
+            names3 = []
+            trimmed3 = []
+            names5 = []
+            trimmed5 = []
+            qtrim = np.array(read.query_qualities) < min_qual
+            if qtrim.sum():
+                new_end = end - (qtrim[::-1].argmax() + 1)
+                trimmed3.append(end - new_end)
+                names3.append("Q")
+                stats["N_Qtrimmed"] += 1
+                total["bp_Qtrimmed"] += end - new_end
+                total["bp_trimmed"] += end - new_end
+                end = new_end
+
+            if end - start >= min_length:
+                for name, adap_seq, adap in right:
+                    match = adap.match_to(seq[start:end])
+                    if match:
+                        new_end = min(end, match.rstart)
+                        trimmed3.append(end - new_end)
+                        names3.append(name)
+                        stats["N_" + name] += 1
+                        total["bp_" + name] += end - new_end
+                        total["bp_trimmed"] += end - new_end
+                        end = new_end
+
+            if end - start >= min_length:
+                for name, adap_seq, adap in left:
+                    match = adap.match_to(seq[start:end])
+                    if match:
+                        new_start = max(start, match.rstop)
+                        trimmed5.append(new_start - start)
+                        names5.append(name)
+                        stats["N_" + name] += 1
+                        total["bp_" + name] += new_start - start
+                        total["bp_trimmed"] += new_start - start
+                        start = new_start
+
+            if end - start >= min_length:
+                stats["N_kept"] += 1
+                total["bp_kept"] += end
+                lhist[end] += 1
+                tags = {}
+                if names3:
+                    tags["A3"] = ",".join(names3)
+                    tags["T3"] = ",".join([str(x) for x in trimmed3])
+                if names5:
+                    tags["A5"] = ",".join(names5)
+                    tags["T5"] = ",".join([str(x) for x in trimmed5])
+                out.append(
+                    (seq[start:end], list(read.query_qualities[start:end]), tags)
+                )
+            else:
+                stats["N_discarded"] += 1
+                total["bp_discarded"] += end
+
+        return out, stats, total, lhist
+
+    def test_process_reads(self):
+        import argparse
+        import tempfile
+        from collections import defaultdict
+        from spacemake.bam import encode_unaligned
+        from spacemake.cutadapt_bam import (
+            AdapterMatcher,
+            RawRead,
+            SimpleRead,
+            process_reads,
+            quality_trim_ends,
+        )
+
+        reads = self.random_reads()
+        with tempfile.TemporaryDirectory() as tmp:
+            self.fa = {}
+            for side, adapters in self.adapters.items():
+                self.fa[side] = os.path.join(tmp, f"{side}.fa")
+                with open(self.fa[side], "w") as f:
+                    for name, seq in adapters:
+                        f.write(f">{name}\n{seq}\n")
+
+            args = argparse.Namespace(
+                adapters_right=self.fa["right"],
+                adapters_left=self.fa["left"],
+                min_qual=20,
+                min_length=18,
+                n_chunk=100,
+                match_cache_size=100,
+            )
+            expect, *expect_counts = self.reference(reads, 20, 18)
+            matcher = AdapterMatcher(self.fa["right"], self.fa["left"], 100)
+
+        # the same reads as raw BAM records, as with --transport raw
+        raw = [
+            RawRead(
+                encode_unaligned(
+                    r.query_name,
+                    r.query_sequence,
+                    "".join([chr(33 + q) for q in r.query_qualities]),
+                )
+            )
+            for r in reads
+        ]
+        self.assertEqual(
+            quality_trim_ends(reads, 20).tolist(), quality_trim_ends(raw, 20).tolist()
+        )
+
+        for source in [reads, raw]:
+            counts = [defaultdict(int) for i in range(3)]
+            out = [
+                (r.query_sequence, list(r.query_qualities), r.tags)
+                for r in process_reads(source, args, *counts, matcher=matcher)
+            ]
+            self.assertEqual(out, expect)
+            self.assertEqual(counts, expect_counts)
+
+        self.assertTrue(expect_counts[0]["N_Qtrimmed"] > 0)
+        self.assertTrue(expect_counts[0]["N_polyA"] > 0)
+        self.assertTrue(expect_counts[0]["N_SMART_5"] > 0)
+        self.assertTrue(matcher.cache_stats()["match_cache_hit"] > 0)
+
+
+class ExtractionPlanTests(unittest.TestCase):
+    expressions = [
+        "r1[0:12]",
+        "r1[8:20][::-1]",
+        "r1[-8:]",
+        "r1[20:8:-2]",
+        "r2[::-1][:9]",
+        "r1[3]",
+        "r2[-1]",
+        "'ACGT'",
+        "None",
+        "r1[0:12] + r2[:8]",
+        "r1[:4] + 'NN' + r2[-3:][::-1] + r1[5]",
+    ]
+
+    def test_extract(self):
+        import random
+        from spacemake.preprocess.extract import (
+            ExtractionPlan,
+            compile_expression,
+            read_matrix,
+        )
+
+        rng = random.Random(1)
+        r1s = ["".join([rng.choice("ACGTN") for i in range(30)]) for j in range(50)]
+        r2s = ["".join([rng.choice("ACGTN") for i in range(90)]) for j in range(50)]
+        matrices = dict(r1=read_matrix(r1s), r2=read_matrix(r2s))
+        for expr in self.expressions:
+            plan = ExtractionPlan(expr)
+            self.assertTrue(plan.batchable)
+            expect = [eval(expr, {}, dict(r1=r1, r2=r2)) for r1, r2 in zip(r1s, r2s)]
+            single = [plan.extract(dict(r1=r1, r2=r2)) for r1, r2 in zip(r1s, r2s)]
+            self.assertEqual(single, expect)
+            self.assertEqual(plan.extract_batch(matrices), expect)
+
+        # barcode matches can only be extracted read by read
+        plan = ExtractionPlan("BC1 + r1[:4]")
+        self.assertFalse(plan.batchable)
+        self.assertEqual(plan.extract(dict(BC1="TTT", r1="ACGTA")), "TTTACGT")
+
+        # everything else is left to eval()
+        for expr in ["r1.lower()", "r1[0:i]", "r1 * 2", "r1[0:12"]:
+            self.assertEqual(compile_expression(expr), None)
+
+        self.assertEqual(read_matrix(["ACG", "AC"]), None)
+
+
+class PrimerAlignerTests(unittest.TestCase):
+    primer = "GAATCACGATACGTACACCAGT"
+
+    def random_reads(self, seed=42):
+        import random
+
+        rng = random.Random(seed)
+
+        def mutate(s, rate=0.05):
+            res = []
+            for c in s:
+                r = rng.random()
+                if r < rate / 3:
+                    continue  # deletion
+                elif r < 2 * rate / 3:
+                    res.append(rng.choice("ACGT"))  # mismatch
+                elif r < rate:
+                    res.append(c + rng.choice("ACGT"))  # insertion
+                else:
+                    res.append(c)
+            return "".join(res)
+
+        def rnd(l):
+            return "".join([rng.choice("ACGT") for i in range(l)])
+
+        reads = [rnd(12) + mutate(self.primer) + rnd(30) for i in range(400)]
+        return reads + [rnd(60) for i in range(40)] + ["", "ACGTN"]
+
+    def test_pairwise2_parity(self):
+        import warnings
+        from spacemake.preprocess.align import PrimerAligner
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            from Bio import pairwise2
+
+        reads = self.random_reads()
+        aligner = PrimerAligner(self.primer)
+        score, start, end, tstart, tend = aligner.align_batch(reads)
+        n_start = 0
+        for i, read in enumerate(reads):
+            alns = pairwise2.align.localmd(
+                self.primer, read, 2, -1.5, -3, -1, -3, -1, one_alignment_only=True
+            )
+            if not alns:
+                self.assertEqual(score[i], 0)
+                continue
+
+            aln = alns[0]
+            self.assertEqual(aln.score, score[i])
+            # read coordinate of the alignment start. Equally good alignments
+            # may be picked differently on ties
+            n_start += aln.start - aln.seqB[: aln.start].count("-") == start[i]
+
+            single = aligner.align(read)
+            self.assertEqual(single.score, score[i])
+            self.assertEqual((single.start, single.end), (start[i], end[i]))
+
+        self.assertTrue(n_start >= 0.95 * len(reads))
+        self.assertEqual(len(aligner.align_batch([])[0]), 0)
+
+
+class QuantTests(unittest.TestCase):
+    def random_reads(self, n=20000, seed=1):
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        umis = ["".join(rng.choice(list("ACGTN"), l)) for l in [8] * 200 + [40] * 5]
+        channels = ["count", "short", "reverse", "primer"]
+        for i in range(n):
+            yield (
+                f"gene_{rng.integers(0, 100)}",
+                f"cell_{rng.integers(0, 100)}",
+                umis[rng.integers(0, len(umis))],
+                channels[rng.choice(4, p=[0.7, 0.1, 0.1, 0.1])],
+            )
+
+    def assertEqualDGE(self, a, b):
+        self.assertEqual(list(a.obs_names), list(b.obs_names))
+        self.assertEqual(list(a.var_names), list(b.var_names))
+        self.assertEqual(sorted(a.layers.keys()), sorted(b.layers.keys()))
+        for x, y in [(a.X, b.X)] + [(a.layers[l], b.layers[l]) for l in a.layers]:
+            self.assertEqual(x.shape, y.shape)
+            self.assertEqual(x.dtype, y.dtype)
+            self.assertTrue((x.indptr == y.indptr).all())
+            self.assertTrue((x.indices == y.indices).all())
+            self.assertTrue((x.data == y.data).all())
+
+    def test_packed_dge(self):
+        from spacemake.quant import DGE, PackedDGE
+
+        dge = DGE()
+        packed = PackedDGE(buffer_size=1000)
+        for gene, cell, umi, channel in self.random_reads():
+            dge.add_read(gene, cell, umi, channel=channel)
+            packed.add_read(gene, cell, umi, channel=channel)
+
+        self.assertEqual(len(packed), 20000)
+        self.assertEqualDGE(dge.make_DGEs(), packed.make_DGEs())
+
+    def test_packed_dge_spill(self):
+        from spacemake.quant import PackedDGE
+
+        reads = list(self.random_reads())
+        packed = PackedDGE()
+        spilled = PackedDGE(max_mem=3000 * PackedDGE.record_size)
+        for gene, cell, umi, channel in reads:
+            packed.add_read(gene, cell, umi, channel=channel)
+            spilled.add_read(gene, cell, umi, channel=channel)
+
+        self.assertEqual(len(spilled), 20000)
+        adata = spilled.make_DGEs()
+        self.assertTrue(len(spilled.runs) > 1)
+        self.assertEqualDGE(packed.make_DGEs(), adata)
+
+    def test_merge_counted(self):
+        from spacemake.quant import PackedDGE
+
+        packed = PackedDGE()
+        shards = [PackedDGE() for i in range(3)]
+        for gene, cell, umi, channel in self.random_reads():
+            packed.add_read(gene, cell, umi, channel=channel)
+            shards[hash(cell) % 3].add_read(gene, cell, umi, channel=channel)
+
+        merged = PackedDGE.merge_counted([dge.counted() for dge in shards])
+        self.assertEqualDGE(packed.make_DGEs(), PackedDGE.counted_to_adata(merged))
+
+    def test_collapse_umis(self):
+        import numpy as np
+        from spacemake.quant import PackedDGE, collapse_umis
+
+        packed = PackedDGE()
+        umis = packed.pack_umis(["AAAA", "AAAT", "AATT", "CCCC", "AAAN", "AAAAA"])
+        self.assertEqual(collapse_umis(umis[:4], np.array([5, 1, 1, 3])), 3)
+        self.assertEqual(collapse_umis(umis[:4], np.array([1, 5, 1, 3])), 2)
+        # UMIs with N or of different length are never merged
+        self.assertEqual(collapse_umis(umis, np.ones(6, dtype=int)), 5)
+
+        # spilled runs are collapsed the same as in memory
+        spilled = PackedDGE(max_mem=3000 * PackedDGE.record_size)
+        for gene, cell, umi, channel in self.random_reads():
+            packed.add_read(gene, cell, umi, channel=channel)
+            spilled.add_read(gene, cell, umi, channel=channel)
+
+        a = packed.counted(edit_distance=1)
+        b = spilled.counted(edit_distance=1)
+        self.assertTrue(len(spilled.runs) > 1)
+        self.assertTrue((a["umi_counts"] <= packed.counted()["umi_counts"]).all())
+        self.assertEqualDGE(
+            PackedDGE.counted_to_adata(a), PackedDGE.counted_to_adata(b)
+        )
+
+    def test_split_counted(self):
+        from spacemake.quant import PackedDGE
+        from spacemake.digital_expression import BarcodeIndex, split_counted
+
+        # 6 nt barcodes, the last one can not be packed
+        barcodes = {
+            f"cell_{i}": "".join(["ACGT"[(i >> (2 * j)) & 3] for j in range(6)])
+            for i in range(99)
+        }
+        barcodes["cell_99"] = "ACGTNA"
+
+        # cells 0..59 on tile 0, 40..99 on tile 1, none on tile 2
+        cell_tiles = {}
+        for i in range(100):
+            cell_tiles[f"cell_{i}"] = [t for t in [0, 1] if 40 * t <= i < 60 + 40 * t]
+
+        whitelists = [
+            [bc for c, bc in barcodes.items() if t in cell_tiles[c]] for t in range(3)
+        ]
+        tile_index = BarcodeIndex(whitelists)
+        self.assertEqual(len(tile_index), 100)
+        self.assertTrue("ACGTNA" in tile_index)
+        self.assertTrue(barcodes["cell_7"] in tile_index)
+        self.assertFalse("TTTTTT" in tile_index)
+        self.assertFalse("ACGTNC" in tile_index)
+
+        packed = PackedDGE()
+        tiles = [PackedDGE() for t in range(3)]
+        for gene, cell, umi, channel in self.random_reads():
+            packed.add_read(gene, barcodes[cell], umi, channel=channel)
+            for t in cell_tiles[cell]:
+                tiles[t].add_read(gene, barcodes[cell], umi, channel=channel)
+
+        split = list(split_counted(packed.counted(), tile_index, 3))
+        self.assertEqual([t for t, counted in split], [0, 1, 2])
+        self.assertEqual(len(split[2][1]["keys"]), 0)
+        for t in [0, 1]:
+            self.assertEqualDGE(
+                tiles[t].make_DGEs(), PackedDGE.counted_to_adata(split[t][1])
+            )
+
+
+class DigitalExpressionTests(unittest.TestCase):
+    # cell, UMI, reverse, flag, mapping quality, (gn, gs, gf) or None
+    reads = [
+        ("AAAA", "AAAAAAAA", False, 0, 255, ("G1", "+", "CODING")),
+        # one substitution away from the UMI above -> same molecule
+        ("AAAA", "AAAAAAAC", False, 0, 255, ("G1", "+", "CODING")),
+        # only G2 is on the strand of the read
+        ("AAAA", "TTTTTTTT", True, 16, 255, ("G1,G2", "+,-", "CODING,CODING")),
+        # exonic G2 takes precedence over intronic G1
+        ("AAAA", "GGGGGGGG", False, 0, 255, ("G1,G2", "+,+", "INTRONIC,UTR")),
+        # two intronic genes -> ambiguous
+        ("AAAA", "CCCCAAAA", False, 0, 255, ("G1,G3", "+,+", "INTRONIC,INTRONIC")),
+        ("AAAA", "CCCCTTTT", False, 0, 255, None),
+        ("CCCC", "CCCCCCCC", False, 0, 255, ("G3", "+", "INTRONIC")),
+        # wrong strand, low mapping quality, secondary, unmapped
+        ("CCCC", "ACACACAC", False, 0, 255, ("G3", "-", "CODING")),
+        ("CCCC", "GTGTGTGT", False, 0, 3, ("G3", "+", "CODING")),
+        ("CCCC", "TGTGTGTG", False, 256, 255, ("G3", "+", "CODING")),
+        ("CCCC", "CACACACA", False, 4, 255, ("G3", "+", "CODING")),
+        # not on the whitelist, no cell barcode
+        ("GGGG", "AAAAAAAA", False, 0, 255, ("G1", "+", "CODING")),
+        (None, "AAAAAAAA", False, 0, 255, ("G1", "+", "CODING")),
+    ]
+
+    def write_bam(self, fname):
+        import pysam
+
+        header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": "chr1", "LN": 10000}]}
+        with pysam.AlignmentFile(fname, "wb", header=header) as bam:
+            for i, (cell, umi, rev, flag, mq, genes) in enumerate(self.reads):
+                aln = pysam.AlignedSegment()
+                aln.query_name = f"read_{i}"
+                aln.query_sequence = "A" * 20
+                aln.reference_id = 0
+                aln.reference_start = 100 * i
+                aln.cigarstring = "20M"
+                aln.flag = flag
+                aln.mapping_quality = mq
+                tags = [("MI", umi)]
+                if cell:
+                    tags.append(("CB", cell))
+                if genes:
+                    tags.extend(zip(["gn", "gs", "gf"], genes))
+                aln.set_tags(tags)
+                bam.write(aln)
+
+    def test_digital_expression(self):
+        import tempfile
+        from spacemake.digital_expression import (
+            DigitalExpression,
+            counted_to_matrix,
+            write_summary,
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bam_in = os.path.join(tmp, "tagged.bam")
+            self.write_bam(bam_in)
+            de = DigitalExpression(
+                whitelist=["AAAA", "CCCC"],
+                locus_functions=["CODING", "UTR", "INTRONIC"],
+            ).count(bam_in)
+            X, genes, summary = counted_to_matrix(de.counted())
+            fname = os.path.join(tmp, "dge.summary.txt")
+            write_summary(summary, fname, cmd="digital_expression")
+            with open(fname) as f:
+                lines = f.read().splitlines()
+
+        self.assertEqual(
+            de.stats,
+            dict(n_aln=13, n_skipped=3, n_no_cell=2, n_no_gene=3, n_counted=5),
+        )
+        self.assertEqual(list(genes), ["G1", "G2", "G3"])
+        self.assertEqual(summary["cell_bc"], ["AAAA", "CCCC"])
+        self.assertEqual(X.toarray().tolist(), [[1, 2, 0], [0, 0, 1]])
+
+        # format of the DigitalExpression SUMMARY=
+        self.assertTrue(lines[0].startswith("## htsjdk.samtools.metrics.StringHeader"))
+        self.assertEqual(lines[1], "# digital_expression")
+        self.assertTrue(lines[5].endswith("DigitalExpression$DESummary"))
+        self.assertEqual(
+            lines[6:],
+            [
+                "CELL_BARCODE\tNUM_GENIC_READS\tNUM_TRANSCRIPTS\tNUM_GENES",
+                "AAAA\t4\t3\t2",
+                "CCCC\t1\t1\t1",
+            ],
+        )
+
+
 class SpaceMakeCmdlineTests(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
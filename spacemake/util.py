@@ -96,6 +96,140 @@ def read_fq(fname, skim=0):
     logger.info(f"processed {i} FASTQ records from '{fname}'")
 
 
+def open_decompressed(fname, threads=1):
+    """
+    Opens a gzipped file for binary reading. With threads > 1, decompression
+    runs in a separate unpigz (or gzip) process, so that it happens in
+    parallel to whatever consumes the data. Falls back to the gzip module
+    if neither tool is available.
+    """
+    import gzip
+    import shutil
+    import subprocess
+
+    cmd = None
+    if threads > 1:
+        if shutil.which("unpigz"):
+            cmd = ["unpigz", "-c", "-p", str(threads), fname]
+        elif shutil.which("gzip"):
+            cmd = ["gzip", "-dc", fname]
+
+    if cmd is None:
+        return gzip.open(fname, mode="rb")
+
+    return ProcessReader(cmd)
+
+
+class ProcessReader:
+    """
+    Binary, file-like reader of the output of a (decompression) command.
+    At EOF, waits for the process and raises an OSError if it failed (e.g.
+    on a truncated or corrupt .gz file), just like gzip.open() would.
+    """
+
+    def __init__(self, cmd, bufsize=2**20):
+        import subprocess
+
+        self.cmd = cmd
+        self.proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=bufsize
+        )
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and size != 0:
+            self.check()
+
+        return data
+
+    def check(self):
+        _, err = self.proc.communicate()
+        if self.proc.returncode != 0:
+            raise OSError(
+                f"'{' '.join(self.cmd)}' failed with exit code "
+                f"{self.proc.returncode}: {err.decode(errors='replace').strip()}"
+            )
+
+    def close(self):
+        if self.proc.poll() is None:
+            # closed before EOF
+            self.proc.kill()
+
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_fq_blocks(fname, n_records=1000, bufsize=2**20, threads=1):
+    """
+    Reads FASTQ as raw bytes and yields blocks of exactly n_records complete
+    records (only the last block may hold fewer). The records are not parsed,
+    which makes this a cheap way to hand out work to parallel processes.
+    Use parse_fq_block() to turn a block into (name, seq, qual) lists.
+    threads is passed on to open_decompressed() for gzipped input.
+    """
+    import numpy as np
+
+    logger = logging.getLogger("spacemake.util.read_fq_blocks")
+    if fname.endswith(".gz"):
+        f = open_decompressed(fname, threads=threads)
+    elif type(fname) is str:
+        f = open(fname, "rb")
+    else:
+        f = fname  # assume its a binary stream or file-like object already
+
+    n_lines = 4 * n_records
+    buf = b""
+    newlines = np.zeros(0, dtype=np.int64)
+    n_total = 0
+    while True:
+        data = f.read(bufsize)
+        if data:
+            nl = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+            newlines = np.concatenate([newlines, nl + len(buf)])
+            buf += data
+
+        while len(newlines) >= n_lines:
+            cut = newlines[n_lines - 1] + 1
+            yield buf[:cut]
+            n_total += n_records
+            buf = buf[cut:]
+            newlines = newlines[n_lines:] - cut
+
+        if not data:
+            break
+
+    if buf.strip():
+        if not buf.endswith(b"\n"):
+            buf += b"\n"
+        n_total += buf.count(b"\n") // 4
+        yield buf
+
+    if f is not fname:
+        f.close()
+
+    logger.info(f"processed {n_total} FASTQ records from '{fname}'")
+
+
+def parse_fq_block(block):
+    """
+    Splits a block of raw FASTQ bytes (see read_fq_blocks()) into lists of
+    names, sequences and quality strings, the same way FASTQ_src() does.
+    """
+    lines = block.decode("ascii").split("\n")
+    n = 4 * (len(lines) // 4)
+    names = [name.rstrip()[1:] for name in lines[0:n:4]]
+    seqs = [seq.rstrip() for seq in lines[1:n:4]]
+    quals = [qual.rstrip() for qual in lines[3:n:4]]
+    return names, seqs, quals
+
+
 def dge_to_sparse(dge_path):
     import anndata
     import numpy as np